@@ -0,0 +1,106 @@
+"""
+Per-dialog buffer of internal-agent messages, sent to Chatling as
+`instructions` with the dialog's next customer turn.
+
+Forwarding each agent message as its own context-only Chatling call would
+cost a full LLM call per message. Instead the messages are kept on the
+dialog's chat_mapping row (`agent_context`, migrations/005_agent_context.sql),
+so they survive restarts and go through the same mapping_cache/local_store
+path as the rest of the row. The next real turn reads them with the mapping
+it already fetches and sends them as one instruction; they are cleared once
+Chatling has answered.
+
+The buffer keeps the newest AGENT_CONTEXT_MAX_MESSAGES messages that fit in
+AGENT_CONTEXT_MAX_BYTES (UTF-8); older ones are dropped.
+"""
+import logging
+import os
+from datetime import datetime, timezone
+
+import prompts
+import repository
+
+logger = logging.getLogger("agent-context")
+
+AGENT_CONTEXT_ENABLED = os.getenv("AGENT_CONTEXT_ENABLED", "false").lower() == "true"
+AGENT_CONTEXT_MAX_MESSAGES = int(os.getenv("AGENT_CONTEXT_MAX_MESSAGES", "10"))
+AGENT_CONTEXT_MAX_BYTES = int(os.getenv("AGENT_CONTEXT_MAX_BYTES", "4000"))
+
+FIELD = "agent_context"
+
+_stats = {"buffered": 0, "dropped": 0, "truncated": 0, "no_mapping": 0, "flushed_turns": 0, "flushed_messages": 0}
+
+
+def _size(entry: dict) -> int:
+    return len(entry["text"].encode("utf-8"))
+
+
+def _trim(entries: list[dict]) -> list[dict]:
+    """Newest entries within the count and byte limits, oldest first."""
+    kept, total = [], 0
+    for entry in reversed(entries[-AGENT_CONTEXT_MAX_MESSAGES:]):
+        size = _size(entry)
+        if total + size > AGENT_CONTEXT_MAX_BYTES:
+            if not kept:
+                # a single oversized message keeps its beginning
+                text = entry["text"].encode("utf-8")[:AGENT_CONTEXT_MAX_BYTES].decode("utf-8", errors="ignore")
+                kept.append({**entry, "text": text})
+                _stats["truncated"] += 1
+            break
+        kept.append(entry)
+        total += size
+    _stats["dropped"] += len(entries) - len(kept)
+    return kept[::-1]
+
+
+async def add(dialog_id: str, user_id: str, message: str) -> bool:
+    """Buffer an internal user's message for the dialog's next customer turn."""
+    mapping = await repository.get_chat_mapping(dialog_id)
+    if not mapping:
+        # no customer turn yet, so nothing will pick it up
+        _stats["no_mapping"] += 1
+        logger.info(f"No chat_mapping for dialog {dialog_id}, agent message not buffered")
+        return False
+    entry = {"user_id": str(user_id), "text": message, "at": datetime.now(timezone.utc).isoformat()}
+    entries = _trim([*(mapping.get(FIELD) or []), entry])
+    await repository.update_chat_mapping(dialog_id, {FIELD: entries})
+    _stats["buffered"] += 1
+    logger.info(f"Buffered agent message from user {user_id} for dialog {dialog_id} ({len(entries)} waiting)")
+    return True
+
+
+def pending(mapping: dict | None) -> list[dict]:
+    """Buffered entries on a chat_mapping row."""
+    if not AGENT_CONTEXT_ENABLED or not mapping:
+        return []
+    return mapping.get(FIELD) or []
+
+
+def instruction(entries: list[dict]) -> str:
+    lines = "\n".join(f"Internal user {entry['user_id']}: {entry['text']}" for entry in entries)
+    return f"{prompts.instruction('agent_context')}\n{lines}"
+
+
+async def flushed(dialog_id: str, entries: list[dict]):
+    """Chatling answered with `entries`; drop them, keeping any buffered since."""
+    if not entries:
+        return
+    try:
+        mapping = await repository.get_chat_mapping(dialog_id)
+        remaining = [entry for entry in pending(mapping) if entry not in entries]
+        await repository.update_chat_mapping(dialog_id, {FIELD: remaining})
+    except Exception as e:
+        # the same context goes out again on the next turn
+        logger.error(f"Error clearing agent context for dialog {dialog_id}: {str(e)}")
+        return
+    _stats["flushed_turns"] += 1
+    _stats["flushed_messages"] += len(entries)
+
+
+def stats() -> dict:
+    return {
+        **_stats,
+        "enabled": AGENT_CONTEXT_ENABLED,
+        "max_messages": AGENT_CONTEXT_MAX_MESSAGES,
+        "max_bytes": AGENT_CONTEXT_MAX_BYTES,
+    }
@@ -0,0 +1,173 @@
+"""
+In-process TTL/LRU cache of Chatling answers to standalone questions.
+
+Questions are normalized (case, punctuation, whitespace) and looked up
+exactly. With ANSWER_CACHE_MATCH=similar a miss falls back to a small local
+vector index: every cached question is kept as a character-trigram vector
+and the closest one above ANSWER_CACHE_SIMILARITY is served. Register an
+embedding function with `set_embedder` to use real embeddings instead.
+
+Only a dialog's first question, asked before any Chatling conversation
+exists, is cached or served; chatling.py bypasses the cache when the dialog
+has context. A served answer creates no Chatling conversation, so the
+exchange is remembered per dialog (`record_served`) and written into the
+message of the dialog's first real Chatling turn, which keeps it in the
+conversation history. The remembered exchange lives in memory only: after a
+restart, or on another worker, that turn is missing from the conversation.
+"""
+import logging
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Callable, Optional, Sequence
+
+logger = logging.getLogger("answer-cache")
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "500"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "21600"))
+# exact | similar
+ANSWER_CACHE_MATCH = os.getenv("ANSWER_CACHE_MATCH", "exact").lower()
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.85"))
+# "ok", "yes", "hi" etc. depend on context and are never cached
+ANSWER_CACHE_MIN_CHARS = int(os.getenv("ANSWER_CACHE_MIN_CHARS", "12"))
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+Embedder = Callable[[str], Sequence[float]]
+
+# normalized question -> (expires_at, answer, vector)
+_entries: "OrderedDict[str, tuple[float, str, dict]]" = OrderedDict()
+_embedder: Optional[Embedder] = None
+# dialog_id -> (question, answer) served from the cache, not yet in a Chatling conversation
+_served: "OrderedDict[str, tuple[str, str]]" = OrderedDict()
+_SERVED_MAX_DIALOGS = 10000
+_stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0, "carried": 0}
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _SPACES.sub(" ", _NON_WORD.sub(" ", text)).strip()
+
+
+def _trigrams(normalized: str) -> dict:
+    padded = f"  {normalized} "
+    return dict(Counter(padded[i:i + 3] for i in range(len(padded) - 2)))
+
+
+def _vector(normalized: str) -> dict:
+    if _embedder is None:
+        return _trigrams(normalized)
+    return dict(enumerate(_embedder(normalized)))
+
+
+def _cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(value * b.get(key, 0.0) for key, value in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+def set_embedder(embedder: Optional[Embedder]):
+    """Register a callable mapping a normalized question to a dense vector."""
+    global _embedder
+    _embedder = embedder
+    _entries.clear()
+
+
+def cacheable(question: str) -> bool:
+    return ANSWER_CACHE_ENABLED and ANSWER_CACHE_SIZE > 0 and len(normalize(question)) >= ANSWER_CACHE_MIN_CHARS
+
+
+def bypass():
+    """Count a lookup skipped because the question depends on conversation context."""
+    _stats["bypassed"] += 1
+
+
+def _evict_expired(now: float):
+    expired = [key for key, (expires_at, _, _) in _entries.items() if expires_at < now]
+    for key in expired:
+        del _entries[key]
+
+
+def get(question: str) -> Optional[str]:
+    if not cacheable(question):
+        return None
+    key = normalize(question)
+    now = time.monotonic()
+    entry = _entries.get(key)
+    if entry is not None and entry[0] >= now:
+        _entries.move_to_end(key)
+        _stats["exact_hits"] += 1
+        return entry[1]
+
+    if ANSWER_CACHE_MATCH == "similar":
+        _evict_expired(now)
+        vector = _vector(key)
+        best_key, best_score = None, ANSWER_CACHE_SIMILARITY
+        for cached_key, (_, _, cached_vector) in _entries.items():
+            score = _cosine(vector, cached_vector)
+            if score >= best_score:
+                best_key, best_score = cached_key, score
+        if best_key is not None:
+            _entries.move_to_end(best_key)
+            _stats["similar_hits"] += 1
+            logger.info(f"Answer cache similar hit ({best_score:.2f}): {key!r} ~ {best_key!r}")
+            return _entries[best_key][1]
+
+    _stats["misses"] += 1
+    return None
+
+
+def put(question: str, answer: str):
+    if not cacheable(question) or not answer:
+        return
+    key = normalize(question)
+    vector = _vector(key) if ANSWER_CACHE_MATCH == "similar" else {}
+    _entries[key] = (time.monotonic() + ANSWER_CACHE_TTL_SECONDS, answer, vector)
+    _entries.move_to_end(key)
+    _stats["stores"] += 1
+    while len(_entries) > ANSWER_CACHE_SIZE:
+        _entries.popitem(last=False)
+        _stats["evictions"] += 1
+
+
+def record_served(dialog_id: str, question: str, answer: str):
+    """Remember an answer served to a dialog so its first Chatling turn can carry it."""
+    _served[dialog_id] = (question, answer)
+    _served.move_to_end(dialog_id)
+    while len(_served) > _SERVED_MAX_DIALOGS:
+        _served.popitem(last=False)
+
+
+def served(dialog_id: str) -> Optional[tuple[str, str]]:
+    return _served.get(dialog_id)
+
+
+def carried(dialog_id: str):
+    """The served exchange is now part of a Chatling conversation."""
+    if _served.pop(dialog_id, None) is not None:
+        _stats["carried"] += 1
+
+
+def clear():
+    _entries.clear()
+    _served.clear()
+
+
+def stats() -> dict:
+    hits = _stats["exact_hits"] + _stats["similar_hits"]
+    lookups = hits + _stats["misses"]
+    return {
+        **_stats,
+        "enabled": ANSWER_CACHE_ENABLED,
+        "match": ANSWER_CACHE_MATCH,
+        "size": len(_entries),
+        "served_not_carried": len(_served),
+        "hit_rate": round(hits / lookups, 3) if lookups else None,
+    }
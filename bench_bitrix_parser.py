@@ -0,0 +1,121 @@
+"""
+Benchmark: parsing Bitrix webhook bodies with parse_qs vs bitrix_event.parse.
+
+Uses a recorded ONIMBOTMESSAGEADD body (auth/user/params keys as Bitrix
+sends them, tokens replaced) unless a file with one raw body per line is
+given. Checks both parsers agree on every field before timing them.
+
+    python bench_bitrix_parser.py [iterations] [bodies_file]
+"""
+import sys
+import timeit
+from urllib.parse import parse_qs, urlencode
+
+import bitrix_event
+
+RECORDED_FIELDS = {
+    "event": "ONIMBOTMESSAGEADD",
+    "event_handler_id": "83",
+    "data[BOT][1234][BOT_ID]": "1234",
+    "data[BOT][1234][BOT_CODE]": "finideas_sales_bot",
+    "data[BOT][1234][AUTH][domain]": "finideas.bitrix24.in",
+    "data[BOT][1234][AUTH][client_endpoint]": "https://finideas.bitrix24.in/rest/",
+    "data[BOT][1234][AUTH][server_endpoint]": "https://oauth.bitrix.info/rest/",
+    "data[BOT][1234][AUTH][member_id]": "0123456789abcdef0123456789abcdef",
+    "data[BOT][1234][AUTH][application_token]": "fedcba9876543210fedcba9876543210",
+    "data[PARAMS][FROM_USER_ID]": "7581",
+    "data[PARAMS][MESSAGE]": "Hi, I watched the webinar. How do I complete my KYC & what are the fees?",
+    "data[PARAMS][TO_CHAT_ID]": "90412",
+    "data[PARAMS][MESSAGE_TYPE]": "L",
+    "data[PARAMS][SYSTEM]": "N",
+    "data[PARAMS][URL_PREVIEW]": "Y",
+    "data[PARAMS][SKIP_CONNECTOR]": "N",
+    "data[PARAMS][SILENT_CONNECTOR]": "N",
+    "data[PARAMS][IMPORTANT_CONNECTOR]": "N",
+    "data[PARAMS][PARAMS][CLASS]": "bx-messenger-content-item-ol-output",
+    "data[PARAMS][PARAMS][CONNECTOR_MID][0]": "wamid.HBgMOTE5ODc2NTQzMjEwFQIAEhggQjA1",
+    "data[PARAMS][EXTRA_PARAMS][CONTEXT]": "LIVECHAT",
+    "data[PARAMS][EXTRA_PARAMS][LINE_ID]": "4",
+    "data[PARAMS][CHAT_ID]": "90412",
+    "data[PARAMS][CHAT_TYPE]": "L",
+    "data[PARAMS][CHAT_ENTITY_TYPE]": "LINES",
+    "data[PARAMS][CHAT_ENTITY_ID]": "wz_whatsapp_abc123|4|919876543210|15783",
+    "data[PARAMS][CHAT_ENTITY_DATA_1]": "Y|LEAD|558568|N|N|0|1730000000|0|0|0",
+    "data[PARAMS][CHAT_ENTITY_DATA_2]": "LEAD|558568|COMPANY|0|CONTACT|0|DEAL|0",
+    "data[PARAMS][CHAT_ENTITY_DATA_3]": "",
+    "data[PARAMS][COMMAND_CONTEXT]": "TEXTAREA",
+    "data[PARAMS][MESSAGE_ORIGINAL]": "Hi, I watched the webinar. How do I complete my KYC & what are the fees?",
+    "data[PARAMS][TO_USER_ID]": "0",
+    "data[PARAMS][DIALOG_ID]": "chat90412",
+    "data[PARAMS][MESSAGE_ID]": "4815162",
+    "data[PARAMS][CHAT_AUTHOR_ID]": "0",
+    "data[PARAMS][CHAT_COLOR]": "MINT",
+    "data[PARAMS][CHAT_AVATAR]": "",
+    "data[PARAMS][CHAT_TITLE]": "Rahul - WhatsApp",
+    "data[USER][ID]": "7581",
+    "data[USER][NAME]": "Rahul",
+    "data[USER][FIRST_NAME]": "Rahul",
+    "data[USER][LAST_NAME]": "",
+    "data[USER][WORK_POSITION]": "",
+    "data[USER][GENDER]": "M",
+    "data[USER][IS_BOT]": "N",
+    "data[USER][IS_CONNECTOR]": "Y",
+    "data[USER][IS_NETWORK]": "N",
+    "data[USER][IS_EXTRANET]": "Y",
+    "ts": "1730000123",
+    "auth[access_token]": "0f1e2d3c4b5a69788796a5b4c3d2e1f0",
+    "auth[expires]": "1730003723",
+    "auth[expires_in]": "3600",
+    "auth[scope]": "imbot,im,crm,imopenlines",
+    "auth[domain]": "finideas.bitrix24.in",
+    "auth[server_endpoint]": "https://oauth.bitrix.info/rest/",
+    "auth[status]": "L",
+    "auth[client_endpoint]": "https://finideas.bitrix24.in/rest/",
+    "auth[member_id]": "0123456789abcdef0123456789abcdef",
+    "auth[user_id]": "1234",
+    "auth[refresh_token]": "f0e1d2c3b4a5968778695a4b3c2d1e0f",
+    "auth[application_token]": "fedcba9876543210fedcba9876543210",
+}
+
+_DEFAULTS = bitrix_event.BitrixEvent()
+
+
+def extract_with_parse_qs(body: bytes) -> dict:
+    """What main.py used to do: decode, parse every key, then pick fields."""
+    parsed = parse_qs(body.decode("utf-8", errors="replace"))
+    return {attr: parsed.get(key, [getattr(_DEFAULTS, attr)])[0] for key, attr in bitrix_event._FIELDS.items()}
+
+
+def extract_with_parser(body: bytes) -> dict:
+    event = bitrix_event.parse(body)
+    return {attr: getattr(event, attr) for attr in bitrix_event._FIELDS.values()}
+
+
+def load_bodies() -> list[bytes]:
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "rb") as f:
+            return [line.rstrip(b"\r\n") for line in f if line.strip()]
+    return [urlencode(RECORDED_FIELDS).encode("utf-8")]
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    bodies = load_bodies()
+
+    for body in bodies:
+        expected, actual = extract_with_parse_qs(body), extract_with_parser(body)
+        if expected != actual:
+            diff = {k: (expected[k], actual[k]) for k in expected if expected[k] != actual[k]}
+            raise SystemExit(f"Parsers disagree: {diff}")
+
+    print(f"{len(bodies)} bodies, avg {sum(map(len, bodies)) / len(bodies):.0f} bytes, {iterations} iterations each")
+    results = {}
+    for name, extract in (("parse_qs", extract_with_parse_qs), ("bitrix_event", extract_with_parser)):
+        seconds = timeit.timeit(lambda: [extract(body) for body in bodies], number=iterations)
+        results[name] = seconds / (iterations * len(bodies)) * 1e6
+        print(f"{name:<14}{results[name]:>8.1f} µs/body")
+    print(f"speedup       {results['parse_qs'] / results['bitrix_event']:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Benchmark: Supabase round trips per flow, step by step vs FLOW_RPCS.
+
+Counts the requests each main.py flow sends to Supabase, with the legacy
+multi-step calls and with the one-call RPCs from migrations/004_flow_rpcs.sql:
+  internal_reply - internal user answered: drop pending rows, log it
+  new_dialog     - first message of a dialog: look up / create chat_mapping
+  escalation     - monitor escalated dialogs: set active, delete rows, log it
+
+Requests are counted against a fake client, so no network is needed.
+debug_logs rows queued for the background writer are listed separately;
+with FLOW_RPCS they are written inside the RPC instead.
+
+With DATABASE_URL set (and psycopg installed) the same flows also run as
+SQL against that Postgres: migrations 000 and 004 are applied inside a
+transaction, each flow runs step by step and as its RPC on the same seed
+data (including the no-pending and existing-mapping branches), statements
+are counted, the resulting rows are compared, and everything is rolled
+back. Exits 1 if the two versions disagree.
+
+    python bench_flow_round_trips.py
+    DATABASE_URL=postgresql://postgres@localhost/postgres python bench_flow_round_trips.py
+"""
+import asyncio
+import json
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import main
+import mapping_cache
+import repository
+
+
+class FakeQuery:
+    """A built supabase query; every call chains, execute() is one round trip."""
+
+    def __init__(self, client, name: str, data):
+        self.client = client
+        self.name = name
+        self.data = data
+        self.verb = "rpc" if data is not None else None
+
+    def __getattr__(self, method):
+        def chain(*args, **kwargs):
+            if self.verb is None:
+                self.verb = method
+            return self
+        return chain
+
+    def execute(self):
+        self.client.trips.append(f"{self.verb} {self.name}")
+        if self.verb == "rpc":
+            return SimpleNamespace(data=self.data)
+        if self.verb == "select":
+            return SimpleNamespace(data=[])
+        if self.verb == "delete" and self.name == "pending_messages":
+            return SimpleNamespace(data=PENDING_ROWS)
+        return SimpleNamespace(data=[{"bitrix_dialog_id": "chat1", "chat_status": "active"}])
+
+
+class FakeClient:
+    def __init__(self):
+        self.trips: list[str] = []
+
+    def table(self, name: str):
+        return FakeQuery(self, name, None)
+
+    def rpc(self, name: str, params: dict):
+        data = {
+            "get_or_create_chat_mapping": {**params.get("p_row", {}), "created": True},
+            "reset_pending_messages": PENDING_ROWS,
+            "finish_escalation": [1, 2, 3],
+        }[name]
+        return FakeQuery(self, name, data)
+
+
+PENDING_ROWS = [{"id": 1, "dialog_id": "chat1", "message": "hi"}, {"id": 2, "dialog_id": "chat1", "message": "?"}]
+
+FLOWS = {
+    "internal_reply": lambda n: main.reset_pending_for_internal_reply(f"chat{n}", "24", "ONIMBOTMESSAGEADD"),
+    "new_dialog": lambda n: main.ensure_chat_mapping(f"chat{n}", {"name": "Jane", "phone": None, "email": None}),
+    "escalation": lambda n: main.finish_escalation({f"chat{n}": [1, 2], f"chat{n + 1}": [3]}),
+}
+
+
+async def count_with_fake_client() -> dict[tuple[str, bool], tuple[list[str], int]]:
+    queued = []
+
+    async def queue_log(row: dict):
+        queued.append(row)
+
+    main.log_sink.log = queue_log
+    repository._client = FakeClient()
+    results = {}
+    n = 0
+    for flow, run in FLOWS.items():
+        for flow_rpcs in (False, True):
+            n += 10
+            main.FLOW_RPCS = flow_rpcs
+            mapping_cache.clear()
+            repository._client.trips.clear()
+            queued.clear()
+            await run(n)
+            results[flow, flow_rpcs] = (list(repository._client.trips), len(queued))
+    return results
+
+
+# 🔹 Postgres check: the SQL each flow runs step by step (one statement per
+# PostgREST request, debug_logs as one batched insert) vs its RPC
+
+SEED = """
+insert into chat_mapping (bitrix_dialog_id, chat_status) values ('d1', 'stopped'), ('d2', 'stopped');
+insert into pending_messages (id, dialog_id, message) values
+    (9001, 'd1', 'a'), (9002, 'd1', 'b'), (9003, 'd2', 'c'), (9004, 'd3', 'keep');
+"""
+
+# (flow, dialog): both branches of the reset and of the lookup/insert
+PG_CASES = [
+    ("internal_reply", "d1"),   # pending rows to delete
+    ("internal_reply", "d4"),   # nothing pending: no_pending log row
+    ("new_dialog", "d9"),       # no mapping yet: inserted
+    ("new_dialog", "d1"),       # mapping exists: left as is
+    ("escalation", "d1,d2"),
+]
+
+
+def step_by_step(sql, flow: str, dialog_id: str):
+    if flow == "internal_reply":
+        deleted = sql("delete from pending_messages where dialog_id = %s and not flushed returning id", (dialog_id,))
+        ids = [row[0] for row in deleted]
+        stage, details = ("deleted_pending", {"pending_ids": ids}) if ids else ("no_pending", {"note": "none"})
+        sql("insert into debug_logs (dialog_id, user_id, event, stage, details)"
+            " values (%s, '24', 'ONIMBOTMESSAGEADD', %s, %s::jsonb)",
+            (dialog_id, stage, json.dumps(details)))
+    elif flow == "new_dialog":
+        if not sql("select * from chat_mapping where bitrix_dialog_id = %s", (dialog_id,)):
+            sql("insert into chat_mapping (bitrix_dialog_id, name, chat_status) values (%s, 'Jane', 'active') returning *",
+                (dialog_id,))
+    else:
+        sql("update chat_mapping set chat_status = 'active' where bitrix_dialog_id = any(%s::text[])", (["d1", "d2"],))
+        sql("delete from pending_messages where id = any(%s::bigint[]) returning id", ([9001, 9002, 9003],))
+        sql("insert into debug_logs (dialog_id, user_id, event, stage, details) values"
+            " ('d1', 'system', 'monitor', 'deleted_pending', '{\"msg_ids\": [9001, 9002]}'),"
+            " ('d2', 'system', 'monitor', 'deleted_pending', '{\"msg_ids\": [9003]}')")
+
+
+def as_rpc(sql, flow: str, dialog_id: str):
+    if flow == "internal_reply":
+        sql("select * from reset_pending_messages(%s, '24', 'ONIMBOTMESSAGEADD')", (dialog_id,))
+    elif flow == "new_dialog":
+        sql("select get_or_create_chat_mapping(%s::jsonb)", (json.dumps({"bitrix_dialog_id": dialog_id, "name": "Jane"}),))
+    else:
+        sql("select * from finish_escalation(%s::text[], %s::bigint[])", (["d1", "d2"], [9001, 9002, 9003]))
+
+
+def snapshot(conn) -> tuple:
+    return (
+        conn.execute("select bitrix_dialog_id, name, chat_status from chat_mapping order by 1").fetchall(),
+        conn.execute("select id from pending_messages order by id").fetchall(),
+        conn.execute(
+            "select dialog_id, user_id, event, stage, coalesce(details->'pending_ids', details->'msg_ids')"
+            " from debug_logs order by dialog_id, stage"
+        ).fetchall(),
+    )
+
+
+def check_postgres(dsn: str) -> bool:
+    try:
+        import psycopg
+    except ImportError:
+        print("DATABASE_URL is set but psycopg is not installed (pip install 'psycopg[binary]')")
+        return False
+
+    migrations = Path(__file__).parent / "migrations"
+    ok = True
+    with psycopg.connect(dsn, autocommit=True) as conn:
+        conn.execute("begin")
+        for name in ("000_base_schema.sql", "004_flow_rpcs.sql"):
+            conn.execute((migrations / name).read_text())
+        # the tables may already hold data; it comes back with the final rollback
+        for table in ("debug_logs", "pending_messages", "chat_mapping"):
+            conn.execute(f"delete from {table}")
+        conn.execute(SEED)
+
+        print(f"\nPostgres ({conn.info.host or 'socket'}/{conn.info.dbname}): statements per flow")
+        for flow, dialog_id in PG_CASES:
+            states, counts = [], []
+            for runner in (step_by_step, as_rpc):
+                statements = 0
+
+                def sql(query, params=None):
+                    nonlocal statements
+                    statements += 1
+                    cursor = conn.execute(query, params)
+                    return cursor.fetchall() if cursor.description else []
+
+                conn.execute("savepoint flow")
+                runner(sql, flow, dialog_id)
+                states.append(snapshot(conn))
+                counts.append(statements)
+                conn.execute("rollback to savepoint flow")
+            same = states[0] == states[1]
+            ok &= same
+            print(f"  {flow:<16}{dialog_id:<7}step by step {counts[0]}  rpc {counts[1]}  same result: {'yes' if same else 'NO'}")
+            if not same:
+                print(f"    step by step: {states[0]}\n    rpc:          {states[1]}")
+        conn.execute("rollback")
+    return ok
+
+
+async def run():
+    results = await count_with_fake_client()
+    print("Supabase round trips per flow (fake client)")
+    print(f"  {'flow':<16}{'mode':<14}{'trips':>6}{'queued logs':>13}  requests")
+    for (flow, flow_rpcs), (trips, queued) in results.items():
+        mode = "FLOW_RPCS" if flow_rpcs else "step by step"
+        print(f"  {flow:<16}{mode:<14}{len(trips):>6}{queued:>13}  {', '.join(trips)}")
+
+    dsn = os.getenv("DATABASE_URL")
+    if dsn and not check_postgres(dsn):
+        sys.exit(1)
+    repository.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,65 @@
+"""
+Benchmark: cold-start import time of the app, with a budget.
+
+Runs `python -X importtime -c "import main"` in fresh interpreters, reports
+the median cumulative import time of `main` and the heaviest modules, and
+exits non-zero when the median is over budget or a module that must stay
+lazy (the Supabase SDK) was imported at startup.
+
+    python bench_import_time.py [runs] [budget_ms]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "800"))
+# imported on first use only; loading them at startup is a regression
+MUST_STAY_LAZY = ("supabase", "postgrest", "realtime", "storage3", "supabase_auth", "tiktoken")
+
+
+def measure() -> dict[str, tuple[int, int]]:
+    """module -> (self µs, cumulative µs) for one fresh `import main`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise SystemExit(f"import main failed:\n{result.stderr[-2000:]}")
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else IMPORT_TIME_BUDGET_MS
+
+    samples = [measure() for _ in range(runs)]
+    totals = [sample["main"][1] / 1000 for sample in samples]
+    median_ms = statistics.median(totals)
+    median_run = samples[totals.index(sorted(totals)[len(totals) // 2])]
+
+    print(f"import main: median {median_ms:.0f} ms over {runs} runs "
+          f"(min {min(totals):.0f}, max {max(totals):.0f}), budget {budget_ms:.0f} ms")
+    print("heaviest top-level packages (cumulative ms):")
+    top_level = {name: cumulative for name, (_, cumulative) in median_run.items() if "." not in name and name != "main"}
+    for name, cumulative in sorted(top_level.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {name:<24}{cumulative / 1000:>8.1f}")
+
+    eager = sorted(name for name in median_run if name.split(".")[0] in MUST_STAY_LAZY)
+    if eager:
+        print(f"FAIL: imported at startup but should be lazy: {', '.join(eager[:5])}")
+        sys.exit(1)
+    if median_ms > budget_ms:
+        print(f"FAIL: {median_ms:.0f} ms is over the {budget_ms:.0f} ms budget")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark: storing a burst of stopped-chat messages in pending_messages.
+
+Compares the three PENDING_STORAGE_MODE strategies against an in-memory
+table that charges a fixed latency per round trip:
+  concat - SELECT the row, concatenate in Python, UPDATE the whole text
+  append - INSERT one row per message
+  rpc    - one call that appends server-side
+
+Reports round trips, bytes sent to the database, wall time, and how many
+messages survive when they arrive two at a time.
+
+    python bench_pending_buffer.py [burst_size] [message_chars] [latency_ms]
+"""
+import asyncio
+import sys
+import time
+
+
+class FakeTable:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.rows: dict[int, str] = {}
+        self.next_id = 1
+        self.round_trips = 0
+        self.bytes_sent = 0
+
+    async def _trip(self, payload: str = ""):
+        self.round_trips += 1
+        self.bytes_sent += len(payload.encode("utf-8"))
+        await asyncio.sleep(self.latency)
+
+    async def select_one(self):
+        await self._trip()
+        return next(iter(self.rows.items()), None)
+
+    async def insert(self, message: str):
+        await self._trip(message)
+        self.rows[self.next_id] = message
+        self.next_id += 1
+
+    async def update(self, record_id: int, message: str):
+        await self._trip(message)
+        self.rows[record_id] = message
+
+    async def rpc_append(self, message: str):
+        await self._trip(message)
+        if self.rows:
+            record_id = next(iter(self.rows))
+            self.rows[record_id] = self.rows[record_id] + "\n" + message
+        else:
+            self.rows[self.next_id] = message
+            self.next_id += 1
+
+    def stored_messages(self) -> int:
+        return sum(len(text.split("\n")) for text in self.rows.values())
+
+
+async def store_concat(table: FakeTable, message: str):
+    existing = await table.select_one()
+    if existing is None:
+        await table.insert(message)
+    else:
+        record_id, old_msg = existing
+        await table.update(record_id, (old_msg + "\n" + message).strip())
+
+
+async def store_append(table: FakeTable, message: str):
+    await table.insert(message)
+
+
+async def store_rpc(table: FakeTable, message: str):
+    await table.rpc_append(message)
+
+
+STRATEGIES = {"concat": store_concat, "append": store_append, "rpc": store_rpc}
+
+
+async def run(strategy, burst: int, chars: int, latency: float, pairwise: bool):
+    table = FakeTable(latency)
+    messages = [f"{i:05d}" + "x" * max(chars - 5, 0) for i in range(burst)]
+    start = time.perf_counter()
+    if pairwise:
+        for i in range(0, burst, 2):
+            await asyncio.gather(*(strategy(table, m) for m in messages[i:i + 2]))
+    else:
+        for message in messages:
+            await strategy(table, message)
+    return table, time.perf_counter() - start
+
+
+async def main():
+    burst = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    chars = int(sys.argv[2]) if len(sys.argv) > 2 else 80
+    latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 5) / 1000
+
+    print(f"burst={burst} messages x {chars} chars, {latency * 1000:.0f} ms per round trip")
+    print(f"{'mode':<8}{'round trips':>12}{'KB sent':>10}{'wall s':>8}{'kept (pairs)':>14}")
+    for name, strategy in STRATEGIES.items():
+        table, wall = await run(strategy, burst, chars, latency, pairwise=False)
+        paired, _ = await run(strategy, burst, chars, latency, pairwise=True)
+        print(f"{name:<8}{table.round_trips:>12}{table.bytes_sent / 1024:>10.1f}{wall:>8.2f}"
+              f"{paired.stored_messages():>8}/{burst}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
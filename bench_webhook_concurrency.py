@@ -0,0 +1,77 @@
+"""
+Benchmark: webhook concurrency with blocking vs thread-pooled Supabase calls.
+
+Each simulated webhook performs the same number of Supabase round trips
+as a normal customer message (mapping lookup, debug log, Chatling-side
+lookup). A round trip is simulated with a blocking sleep so no network
+access is needed.
+
+    python bench_webhook_concurrency.py [concurrency] [latency_ms]
+"""
+import asyncio
+import sys
+import time
+
+import repository
+
+ROUND_TRIPS_PER_WEBHOOK = 3
+
+
+class FakeQuery:
+    """Stands in for a built supabase query; execute() blocks like the real one."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency)
+        return None
+
+
+async def webhook_blocking(latency: float):
+    for _ in range(ROUND_TRIPS_PER_WEBHOOK):
+        FakeQuery(latency).execute()
+
+
+async def webhook_pooled(latency: float):
+    for _ in range(ROUND_TRIPS_PER_WEBHOOK):
+        await repository._execute(FakeQuery(latency))
+
+
+async def measure(handler, concurrency: int, latency: float) -> tuple[float, float]:
+    """Return (wall seconds, worst event-loop stall seconds)."""
+    worst_lag = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal worst_lag
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            worst_lag = max(worst_lag, time.perf_counter() - start - 0.005)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await asyncio.gather(*(handler(latency) for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    done = True
+    await tick
+    return wall, worst_lag
+
+
+async def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 50) / 1000
+
+    print(f"{concurrency} concurrent webhooks, {ROUND_TRIPS_PER_WEBHOOK} round trips each, "
+          f"{latency * 1000:.0f} ms per round trip, pool size {repository.SUPABASE_MAX_WORKERS}")
+    for label, handler in (("before (blocking)", webhook_blocking), ("after (thread pool)", webhook_pooled)):
+        wall, lag = await measure(handler, concurrency, latency)
+        print(f"{label:<22} wall={wall:6.2f}s  throughput={concurrency / wall:7.1f} webhooks/s  "
+              f"max loop stall={lag * 1000:7.1f} ms")
+    repository.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,10 +1,21 @@
 import httpx
-from chatling import get_chatling_response
+from chatling import get_chatling_response, stream_chatling_response, CHATLING_STREAMING
+from http_clients import get_bitrix_client
+from chatling_client import ChatlingStreamIncomplete
+from bitrix_event import BitrixEvent
+from logging_setup import PAYLOAD
+import metrics
+import asyncio
+import heapq
+import itertools
 import logging
+import random
 import sys
 import re
 import os
 import json
+import time
+from collections import deque
 from typing import Optional
 
 logger = logging.getLogger("bitrix")
@@ -15,44 +26,175 @@ BOT_ID = os.environ.get("BOT_ID")
 CLIENT_ID = os.environ.get("CLIENT_ID")
 
 
-# Setup logger
-logging.basicConfig(
-    filename="bitrix.log",
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s"
-)
+# Bitrix24 throttles REST calls per portal with a leaky bucket
+BITRIX_RATE_PER_SECOND = float(os.environ.get("BITRIX_RATE_PER_SECOND", "2"))
+BITRIX_BURST = int(os.environ.get("BITRIX_BURST", "50"))
+BITRIX_MAX_RETRIES = int(os.environ.get("BITRIX_MAX_RETRIES", "5"))
+BITRIX_RETRY_BASE_SECONDS = float(os.environ.get("BITRIX_RETRY_BASE_SECONDS", "1"))
 
-async def update_lead_field(lead_id: str, field_name: str, value) -> bool:
+# Streaming relay: "split" sends each flushed part as a new message,
+# "update" edits the first message as the reply grows
+BITRIX_STREAM_MODE = os.environ.get("BITRIX_STREAM_MODE", "split").lower()
+BITRIX_STREAM_FLUSH_SECONDS = float(os.environ.get("BITRIX_STREAM_FLUSH_SECONDS", "1.5"))
+
+# Lower value is sent first
+PRIORITY_REPLY = 0
+PRIORITY_LEAD_UPDATE = 10
+
+
+class BitrixThrottled(Exception):
+    """Bitrix answered QUERY_LIMIT_EXCEEDED and retries ran out."""
+
+
+# 🔹 Outbound scheduler: priority queue drained at the portal's token-bucket rate.
+# queue entries: (priority, sequence, request dict)
+_queue: list[tuple] = []
+_sequence = itertools.count()
+_wakeup: asyncio.Event | None = None
+_dispatcher: asyncio.Task | None = None
+_in_flight: set[asyncio.Task] = set()
+_tokens = float(BITRIX_BURST)
+_tokens_updated = time.monotonic()
+_wait_samples = {PRIORITY_REPLY: deque(maxlen=500), PRIORITY_LEAD_UPDATE: deque(maxlen=500)}
+_scheduler_stats = {"sent": 0, "throttled": 0, "retried": 0, "failed": 0}
+
+
+def _refill_tokens():
+    global _tokens, _tokens_updated
+    now = time.monotonic()
+    _tokens = min(BITRIX_BURST, _tokens + (now - _tokens_updated) * BITRIX_RATE_PER_SECOND)
+    _tokens_updated = now
+
+
+def _enqueue(priority: int, request: dict):
+    heapq.heappush(_queue, (priority, next(_sequence), request))
+    _ensure_dispatcher()
+    _wakeup.set()
+
+
+def _ensure_dispatcher():
+    global _wakeup, _dispatcher
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    if _dispatcher is None or _dispatcher.done():
+        _dispatcher = asyncio.create_task(_dispatch())
+
+
+async def _dispatch():
+    global _tokens
+    while True:
+        if not _queue:
+            _wakeup.clear()
+            await _wakeup.wait()
+            continue
+        _refill_tokens()
+        if _tokens < 1:
+            await asyncio.sleep((1 - _tokens) / BITRIX_RATE_PER_SECOND)
+            continue  # re-check: a higher-priority call may have arrived meanwhile
+        _tokens -= 1
+        priority, _, request = heapq.heappop(_queue)
+        _wait_samples.setdefault(priority, deque(maxlen=500)).append(time.monotonic() - request["enqueued_at"])
+        task = asyncio.create_task(_send(priority, request))
+        _in_flight.add(task)
+        task.add_done_callback(_in_flight.discard)
+
+
+async def _send(priority: int, request: dict):
+    global _tokens
+    future = request["future"]
+    if future.done():  # caller gave up
+        return
+    try:
+        client = get_bitrix_client()
+        res = await client.post(f"{BITRIX_WEBHOOK_URL.rstrip('/')}/{request['method']}.json", json=request["payload"])
+        throttled = res.status_code == 503 or '"QUERY_LIMIT_EXCEEDED"' in res.text
+        if not throttled:
+            res.raise_for_status()
+            _scheduler_stats["sent"] += 1
+            future.set_result(res.json())
+            return
+    except Exception as e:
+        _scheduler_stats["failed"] += 1
+        if not future.done():
+            future.set_exception(e)
+        return
+
+    # 🔹 Throttled: empty the bucket and retry with jittered exponential backoff
+    _scheduler_stats["throttled"] += 1
+    _tokens = 0
+    request["attempts"] += 1
+    if request["attempts"] > BITRIX_MAX_RETRIES:
+        _scheduler_stats["failed"] += 1
+        future.set_exception(BitrixThrottled(f"{request['method']} still throttled after {BITRIX_MAX_RETRIES} retries"))
+        return
+    _scheduler_stats["retried"] += 1
+    delay = BITRIX_RETRY_BASE_SECONDS * 2 ** (request["attempts"] - 1) * random.uniform(0.5, 1.5)
+    logger.warning("Bitrix throttled %s, retry %s in %.1fs", request['method'], request['attempts'], delay)
+    asyncio.get_running_loop().call_later(delay, _enqueue, priority, request)
+
+
+async def call_bitrix(method: str, payload: dict, priority: int = PRIORITY_REPLY) -> dict:
     """
-    Update a custom field in a Bitrix24 lead.
+    Send a Bitrix REST call through the rate-limited scheduler and return its JSON.
+    Raises httpx.HTTPStatusError for error responses and BitrixThrottled when
+    QUERY_LIMIT_EXCEEDED persists past BITRIX_MAX_RETRIES.
     """
-    url = f"{BITRIX_WEBHOOK_URL}/crm.lead.update.json"
-    payload = {
-        "id": lead_id,
-        "fields": {
-            field_name: value
-        }
-    }
+    future = asyncio.get_running_loop().create_future()
+    _enqueue(priority, {
+        "method": method,
+        "payload": payload,
+        "future": future,
+        "attempts": 0,
+        "enqueued_at": time.monotonic(),
+    })
+    return await future
 
-    logging.debug(f"Updating lead → {lead_id}, field → {field_name}, value → {value}")
-    logging.debug(f"Payload being sent → {payload}")
 
+async def stop_scheduler():
+    global _dispatcher
+    if _dispatcher is not None:
+        _dispatcher.cancel()
+        await asyncio.gather(_dispatcher, *_in_flight, return_exceptions=True)
+        _dispatcher = None
 
 
-    async with httpx.AsyncClient() as client:
-        try:
-            res = await client.post(url, json=payload)
-            logging.debug(f"Bitrix response status → {res.status_code}")
-            logging.debug(f"Bitrix response body → {res.text}")
-            res.raise_for_status()
-            data = res.json()
-            if "error" in data:
-                print("Bitrix API Error:", data["error_description"])
-                return False
-            return data.get("result", False)
-        except Exception as e:
-            logging.error(f"Error updating lead {lead_id}: {e}")
-            return False
+def _percentile(samples, pct: float) -> float | None:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 3)
+
+
+def scheduler_stats() -> dict:
+    _refill_tokens()
+    waits = {
+        "reply" if priority == PRIORITY_REPLY else "lead_update" if priority == PRIORITY_LEAD_UPDATE else str(priority): {
+            "p50_seconds": _percentile(samples, 0.5),
+            "p95_seconds": _percentile(samples, 0.95),
+            "max_seconds": round(max(samples), 3) if samples else None,
+        }
+        for priority, samples in _wait_samples.items()
+    }
+    return {**_scheduler_stats, "queued": len(_queue), "tokens": round(_tokens, 1), "queue_wait": waits}
+
+@metrics.timed("bitrix_batch")
+async def call_bitrix_batch(commands: dict[str, str]) -> dict:
+    """
+    Run up to 50 REST commands in one Bitrix `batch` call.
+    `commands` maps a key to a method with its query string, e.g.
+    {"lead_1": "crm.lead.update?id=1&fields[UF_CRM_X]=1"}.
+    Returns {"result": {...}, "result_error": {...}} keyed like `commands`.
+    """
+    logger.debug("Bitrix batch → %d commands", len(commands))
+
+    data = await call_bitrix("batch", {"halt": 0, "cmd": commands}, PRIORITY_LEAD_UPDATE)
+    if "error" in data:
+        raise RuntimeError(f"Bitrix batch error: {data.get('error_description') or data['error']}")
+    result = data.get("result", {})
+    return {
+        "result": result.get("result") or {},
+        "result_error": result.get("result_error") or {},
+    }
 
 def clean_message_for_bitrix(message: str) -> str:
     """
@@ -67,34 +209,149 @@ def clean_message_for_bitrix(message: str) -> str:
     return message
 
 
-async def handle_bitrix_event(event: str, dialog_id: str, message: str, user_id: str = None,bitrix_user_info: dict = None,    instructions: Optional[list[str]] = None):
+async def handle_bitrix_event(event: str, dialog_id: str, message: str, user_id: str = None,bitrix_user_info: Optional[BitrixEvent] = None,    instructions: Optional[list[str]] = None, fallback: bool = True):
+    # fallback=False: raise ChatlingUnavailable instead of sending the canned reply
  
     if event == "ONIMBOTMESSAGEADD" and dialog_id and  (message or instructions):
-       
-        reply = await get_chatling_response(user_message = message, bitrix_dialog_id=dialog_id, user_id=user_id,bitrix_user_info= bitrix_user_info,instructions=instructions)
+        if CHATLING_STREAMING:
+            chunks = stream_chatling_response(user_message = message, bitrix_dialog_id=dialog_id, user_id=user_id,bitrix_user_info= bitrix_user_info,instructions=instructions, fallback=fallback)
+            try:
+                reply = await relay_streaming_reply(dialog_id, chunks)
+                return {"status": "ok", "reply": reply}
+            except ChatlingStreamIncomplete as e:
+                if not fallback:
+                    # escalation: its rows stay pending and the retry sends the whole reply
+                    raise
+                # the customer has a cut-off answer: follow it with the whole one
+                logger.warning("Streamed reply to %s broke off, sending it again in full: %s", dialog_id, e)
+
+        reply = await get_chatling_response(user_message = message, bitrix_dialog_id=dialog_id, user_id=user_id,bitrix_user_info= bitrix_user_info,instructions=instructions, fallback=fallback)
         cleaned_response = clean_message_for_bitrix(reply)
         await send_message_to_bitrix(dialog_id, cleaned_response)
         return {"status": "ok", "reply": reply}
 
     return {"status": "ignored"}
 
+@metrics.timed("bitrix_send")
 async def send_message_to_bitrix(dialog_id: str, message: str):
 
-    logger.info(f"Sending to Bitrix: dialog_id={dialog_id}, message={message}")
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            response = await client.post(
-                f"{BITRIX_WEBHOOK_URL}imbot.message.add.json",
-                json={
-                    "BOT_ID": BOT_ID,
-                    "CLIENT_ID": CLIENT_ID,
-                    "DIALOG_ID": dialog_id,
-                    "MESSAGE": message
-                }
-            )
-            response.raise_for_status()
-            logger.info(f"Sent to Bitrix response: {response.json()}")
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Bitrix API error: {e.response.status_code} - {e.response.text}")
-        except Exception as e:
-            logger.error(f"Unexpected error sending to Bitrix: {str(e)}")
+    logger.info("Sending to Bitrix: dialog_id=%s, message=%r", dialog_id, message)
+    try:
+        data = await call_bitrix("imbot.message.add", {
+            "BOT_ID": BOT_ID,
+            "CLIENT_ID": CLIENT_ID,
+            "DIALOG_ID": dialog_id,
+            "MESSAGE": message
+        }, PRIORITY_REPLY)
+        logger.debug("Sent to Bitrix response: %s", data, extra=PAYLOAD)
+        return data.get("result")
+    except httpx.HTTPStatusError as e:
+        logger.error("Bitrix API error: %s", e.response.status_code)
+        logger.debug("Bitrix error body: %s", e.response.text, extra=PAYLOAD)
+    except Exception as e:
+        logger.error("Unexpected error sending to Bitrix: %s", e)
+
+
+async def update_bitrix_message(message_id, message: str):
+    try:
+        await call_bitrix("imbot.message.update", {
+            "BOT_ID": BOT_ID,
+            "CLIENT_ID": CLIENT_ID,
+            "MESSAGE_ID": message_id,
+            "MESSAGE": message
+        }, PRIORITY_REPLY)
+    except Exception as e:
+        logger.error("Error updating Bitrix message %s: %s", message_id, e)
+
+
+async def send_typing(dialog_id: str):
+    try:
+        await call_bitrix("imbot.chat.sendTyping", {
+            "BOT_ID": BOT_ID,
+            "CLIENT_ID": CLIENT_ID,
+            "DIALOG_ID": dialog_id
+        }, PRIORITY_REPLY)
+    except Exception as e:
+        logger.error("Error sending typing indicator to %s: %s", dialog_id, e)
+
+
+# 🔹 Streaming relay
+
+_SENTENCE_BOUNDARY = re.compile(r"[.!?…](?=\s)|\n")
+_stream_samples = {"first_visible": deque(maxlen=500), "total": deque(maxlen=500)}
+_stream_counts = {"incomplete": 0}
+
+
+def _last_boundary(text: str, start: int) -> int:
+    end = start
+    for match in _SENTENCE_BOUNDARY.finditer(text, start):
+        end = match.end()
+    return end
+
+
+async def _flush_stream(dialog_id: str, text: str, start: int, end: int, message_id):
+    if BITRIX_STREAM_MODE == "update" and message_id:
+        await update_bitrix_message(message_id, clean_message_for_bitrix(text[:end]))
+        return message_id
+    chunk = clean_message_for_bitrix(text[start:end])
+    if not chunk:
+        return message_id
+    new_id = await send_message_to_bitrix(dialog_id, chunk)
+    return message_id or new_id
+
+
+@metrics.timed("stream_relay")
+async def relay_streaming_reply(dialog_id: str, chunks) -> str:
+    """
+    Forward a streamed reply to Bitrix as it arrives: typing indicator first,
+    then every complete sentence (at most once per BITRIX_STREAM_FLUSH_SECONDS).
+    Records time to first visible text separately from total time. A
+    stream that breaks off raises ChatlingStreamIncomplete, with the tail
+    that was not yet flushed left unsent.
+    """
+    start = time.perf_counter()
+    await send_typing(dialog_id)
+
+    text = ""
+    sent_upto = 0
+    message_id = None
+    first_visible = None
+    last_flush = 0.0
+    try:
+        async for piece in chunks:
+            text += piece
+            boundary = _last_boundary(text, sent_upto)
+            if boundary <= sent_upto:
+                continue
+            if first_visible is not None and time.perf_counter() - last_flush < BITRIX_STREAM_FLUSH_SECONDS:
+                continue
+            message_id = await _flush_stream(dialog_id, text, sent_upto, boundary, message_id)
+            sent_upto = boundary
+            last_flush = time.perf_counter()
+            if first_visible is None:
+                first_visible = last_flush - start
+    except ChatlingStreamIncomplete:
+        _stream_counts["incomplete"] += 1
+        raise
+
+    if text[sent_upto:].strip():
+        message_id = await _flush_stream(dialog_id, text, sent_upto, len(text), message_id)
+        if first_visible is None:
+            first_visible = time.perf_counter() - start
+
+    total = time.perf_counter() - start
+    if first_visible is not None:
+        _stream_samples["first_visible"].append(first_visible)
+    _stream_samples["total"].append(total)
+    logger.info("Streamed reply to %s: first visible after %ss, total %.2fs", dialog_id, first_visible, total)
+    return text
+
+
+def streaming_stats() -> dict:
+    return {
+        **{
+            name: {"p50_seconds": _percentile(samples, 0.5), "p95_seconds": _percentile(samples, 0.95)}
+            for name, samples in _stream_samples.items()
+        },
+        **_stream_counts,
+    }
@@ -0,0 +1,124 @@
+"""
+Parser for Bitrix bot webhook bodies.
+
+Bitrix posts a form-encoded body with dozens of `data[...]` / `auth[...]`
+keys. `parse` scans it once and decodes only the keys the bot uses into a
+slotted BitrixEvent; values of other keys are never unquoted.
+CHAT_ENTITY_DATA_1 is split into entity type and lead ID on first access.
+"""
+from functools import lru_cache
+from typing import Optional
+from urllib.parse import unquote_plus
+
+# form key -> attribute
+_FIELDS = {
+    "event": "event",
+    "ts": "ts",
+    "data[PARAMS][DIALOG_ID]": "dialog_id",
+    "data[PARAMS][MESSAGE]": "message",
+    "data[PARAMS][MESSAGE_ID]": "message_id",
+    "data[PARAMS][FROM_USER_ID]": "from_user_id",
+    "data[PARAMS][CHAT_ENTITY_DATA_1]": "chat_entity_data",
+    "data[PARAMS][PARAMS][COMPONENT_ID]": "component_id",
+    "data[USER][WORK_POSITION]": "work_position",
+    "data[USER][NAME]": "user_name",
+    "data[USER][FIRST_NAME]": "first_name",
+    "data[USER][LAST_NAME]": "last_name",
+    "data[USER][EMAIL]": "email",
+    "data[USER][PHONE]": "phone",
+}
+
+
+@lru_cache(maxsize=1024)
+def _attr_for(raw_key: str) -> Optional[str]:
+    # Bitrix sends the same few dozen keys every time, so each is unquoted once
+    return _FIELDS.get(unquote_plus(raw_key))
+
+
+class BitrixEvent:
+    __slots__ = (
+        "event", "ts", "dialog_id", "message", "message_id", "from_user_id",
+        "chat_entity_data", "component_id", "work_position",
+        "user_name", "first_name", "last_name", "email", "phone",
+        "_entity",
+    )
+
+    event: str
+    ts: str
+    dialog_id: str
+    message: str
+    message_id: str
+    from_user_id: str
+    chat_entity_data: Optional[str]
+    component_id: str
+    work_position: Optional[str]
+    user_name: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    email: Optional[str]
+    phone: Optional[str]
+
+    def __init__(self):
+        self.event = ""
+        self.ts = ""
+        self.dialog_id = ""
+        self.message = ""
+        self.message_id = ""
+        self.from_user_id = ""
+        self.chat_entity_data = None
+        self.component_id = ""
+        self.work_position = None
+        self.user_name = None
+        self.first_name = None
+        self.last_name = None
+        self.email = None
+        self.phone = None
+        self._entity = None
+
+    def _entity_parts(self) -> tuple[Optional[str], Optional[str]]:
+        if self._entity is None:
+            parts = self.chat_entity_data.split("|") if self.chat_entity_data else []
+            self._entity = (
+                parts[1] if len(parts) > 1 else None,
+                parts[2] if len(parts) > 2 else None,
+            )
+        return self._entity
+
+    @property
+    def entity_type(self) -> Optional[str]:
+        return self._entity_parts()[0]
+
+    @property
+    def lead_id(self) -> Optional[str]:
+        entity_type, entity_id = self._entity_parts()
+        return entity_id if entity_type == "LEAD" else None
+
+    def __repr__(self) -> str:
+        return (
+            f"BitrixEvent(event={self.event!r}, dialog_id={self.dialog_id!r}, "
+            f"message_id={self.message_id!r}, from_user_id={self.from_user_id!r}, "
+            f"component_id={self.component_id!r}, message={self.message!r})"
+        )
+
+
+def parse(body: bytes | str) -> BitrixEvent:
+    """
+    Parse a webhook body. Matches `parse_qs(...)[key][0]` for the keys we
+    use: the first non-empty value wins and blank values count as missing.
+    """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    parsed = BitrixEvent()
+    seen = set()
+    for pair in body.split("&"):
+        key, _, value = pair.partition("=")
+        if not value:
+            continue
+        attr = _attr_for(key)
+        if attr is None or attr in seen:
+            continue
+        seen.add(attr)
+        setattr(parsed, attr, unquote_plus(value))
+        if len(seen) == len(_FIELDS):
+            break
+    return parsed
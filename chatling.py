@@ -2,98 +2,90 @@ import httpx
 import logging
 import json
 import os
-from dotenv import load_dotenv
-from supabase import create_client, Client
+import repository
+import prompts
+from bitrix_event import BitrixEvent
+import answer_cache
+import agent_context
+import metrics
+from chatling_client import post_chatling, stream_chatling, ChatlingUnavailable, ChatlingStreamIncomplete
 import re
-from typing import Optional
+import asyncio
+from logging_setup import PAYLOAD
+from typing import AsyncIterator, Optional
 
-load_dotenv()  
 
 logger = logging.getLogger("chatling")
-logging.basicConfig(level=logging.INFO)
 
 # Chatling v2 API details
 CHATLING_BOT_ID = os.environ.get("CHATLING_BOT_ID")
 CHATLING_API_KEY = os.environ.get("CHATLING_API_KEY")
-CHATLING_API_URL = f"https://api.chatling.ai/v2/chatbots/{CHATLING_BOT_ID}/ai/kb/chat"
+CHATLING_API_BASE = os.environ.get("CHATLING_API_BASE", "https://api.chatling.ai/v2").rstrip("/")
+CHATLING_API_URL = f"{CHATLING_API_BASE}/chatbots/{CHATLING_BOT_ID}/ai/kb/chat"
+# Relay replies to Bitrix while Chatling is still generating them
+CHATLING_STREAMING = os.environ.get("CHATLING_STREAMING", "false").lower() == "true"
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+# sentence (or line) plus the whitespace that follows it
+_SENTENCE_CHUNK = re.compile(r".*?(?:[.!?…]+(?:\s+|$)|\n+|$)", re.S)
 
-# 🔹 Finideas startup prompt
-BOT_PROMPT = """You are a Finideas sales representative.
+# Contact backfill: rows per Supabase page and concurrent Chatling creations
+CONTACT_BACKFILL_PAGE_SIZE = int(os.environ.get("CONTACT_BACKFILL_PAGE_SIZE", "500"))
+CONTACT_BACKFILL_CONCURRENCY = int(os.environ.get("CONTACT_BACKFILL_CONCURRENCY", "4"))
 
-Your main goal is to understand the visitor's Investment requirements, challenges, and financial goals — and then guide them step by step toward becoming a registered Finideas client.
+# bitrix_dialog_id -> task creating its Chatling contact (single-flight)
+_contact_creations: dict[str, asyncio.Task] = {}
+_contact_stats = {"created": 0, "coalesced": 0, "create_failed": 0, "backfilled": 0, "backfill_failed": 0}
 
-Start every new conversation by asking 2-3 short, friendly questions to understand their needs (for example, their investment goals, experience, or challenges). Keep it conversational and engaging.
+# Sent to the customer instead of an error when Chatling is unavailable
+CHATLING_FALLBACK_REPLY = os.environ.get(
+    "CHATLING_FALLBACK_REPLY",
+    "Thanks for your message! Our team will get back to you shortly."
+)
 
-After learning about their needs:
-- Check if the user has already seen our presentation, YouTube videos, or attended our webinar.  
-  If they haven't, politely motivate them to do so. 
-
-If the user *has* already seen our presentation or webinar:
-- Ask whether they have completed their KYC.  
-  - If no, explain the advantages of KYC — mention that it's free, simple, and unlocks the ability to explore our personalized investment solutions. Motivate them to complete it.  
-  - If they have already done KYC, acknowledge it positively and invite them to share their queries or areas where they'd like more clarity or guidance.
-
-Throughout the chat:
-- Keep responses short, clear, and natural — never robotic or overly formal.
-- Use a warm, consultative tone focused on understanding, helping, and creating trust — not on pushing sales.
-- End replies with open-ended questions to keep the visitor engaged and move them toward the next step in the journey.
-
-Motivate the user to save contact of this whatsapp chat for receiving important updates later. 
-
-This is the first question from the client:
-
-"""
-
-
-
-
-
-if not SUPABASE_URL or not SUPABASE_KEY:
-    logger.error("Supabase credentials not found. Please check your .env file.")
-else:
-    logger.info(f"Supabase URL loaded: {SUPABASE_URL}")
-    logger.info(f"Supabase Key present: {bool(SUPABASE_KEY)}")
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-async def get_chatling_response(
+async def _prepare_chatling_request(
     user_message: str,
     user_id: str = None,
     bitrix_dialog_id: str = None,
-    bitrix_user_info: dict = None,  # Pass Bitrix user info here
-    ai_model_id: int = 24, #using model GPT 4.1 nano
+    bitrix_user_info: Optional[BitrixEvent] = None,
+    ai_model_id: int = 24,
     language_id: int = None,
     temperature: float = None,
-    instructions: Optional[list[str]] = None, 
+    instructions: Optional[list[str]] = None,
 ):
+    """
+    Resolve the conversation/contact for a dialog and build the Chatling
+    payload. Also returns the buffered agent messages sent along, to clear
+    once Chatling has answered. Raises if the dialog's chat_mapping can't
+    be read.
+    """
     conversation_id = None
     chatling_contact_id = None
-
+    mapping = None
+    user_name = first_name = last_name = email = phone = None
 
     # Fallback: Use Bitrix user info if message has no info
     if bitrix_user_info:
-        user_name = bitrix_user_info.get("data[USER][NAME]", [None])[0]
-        first_name = bitrix_user_info.get("data[USER][FIRST_NAME]", [None])[0]
-        last_name = bitrix_user_info.get("data[USER][LAST_NAME]", [None])[0]
-        email = bitrix_user_info.get("data[USER][EMAIL]", [None])[0]   # if provided by Bitrix
-        phone = bitrix_user_info.get("data[USER][PHONE]", [None])[0]   # if provided by Bitrix
+        user_name = bitrix_user_info.user_name
+        first_name = bitrix_user_info.first_name
+        last_name = bitrix_user_info.last_name
+        email = bitrix_user_info.email   # if provided by Bitrix
+        phone = bitrix_user_info.phone   # if provided by Bitrix
 
 
-    try:
-        # Fetch existing conversation & contact from Supabase
-        result = supabase.table("chat_mapping").select("*").eq("bitrix_dialog_id", bitrix_dialog_id).execute()
-        logger.info(f"Supabase select result: {result}")
+    # Fetch existing conversation & contact from Supabase. A failed read is not
+    # "no mapping": going on would start a new conversation whose id then
+    # overwrites the dialog's real one, so the error goes to the caller.
+    mapping = await repository.get_chat_mapping(bitrix_dialog_id)
+    logger.debug("Supabase select result: %s", mapping, extra=PAYLOAD)
 
-        if result.data and len(result.data) > 0:
-            conversation_id = result.data[0].get("chatling_conversation_id")
-            chatling_contact_id = result.data[0].get("chatling_contact_id")
+    try:
+        if mapping:
+            conversation_id = mapping.get("chatling_conversation_id")
+            chatling_contact_id = mapping.get("chatling_contact_id")
 
             # If contact ID missing, create contact
             if not chatling_contact_id:
-                logger.info(f"⚡ Chatling contact missing for dialog {bitrix_dialog_id}. Creating new contact...")
+                logger.info("⚡ Chatling contact missing for dialog %s. Creating new contact...", bitrix_dialog_id)
                 chatling_contact_id = await get_or_create_chatling_contact(
                     name=user_name,
                     first_name = first_name,
@@ -103,12 +95,10 @@ async def get_chatling_response(
                     bitrix_dialog_id=bitrix_dialog_id,
                     bitrix_user_info = bitrix_user_info
                 )
-            logger.info(f"Found existing conversation: {conversation_id}, contact: {chatling_contact_id}")
+            logger.info("Found existing conversation: %s, contact: %s", conversation_id, chatling_contact_id)
         else:
             # No conversation exists; create new one
-            logger.info(f"No existing conversation for dialog {bitrix_dialog_id}. A new conversation will be created.")
-            user_message = BOT_PROMPT + user_message
-            logger.info(f"User message to be sent to bot:\n{user_message}")
+            logger.info("No existing conversation for dialog %s. A new conversation will be created.", bitrix_dialog_id)
             # Always create contact if missing
             chatling_contact_id = await get_or_create_chatling_contact(
                 name=user_name,
@@ -120,7 +110,7 @@ async def get_chatling_response(
                 bitrix_user_info = bitrix_user_info
             )
     except Exception as e:
-        logger.error(f"Error fetching from Supabase: {str(e)}")
+        logger.error("Error resolving Chatling contact for dialog %s: %s", bitrix_dialog_id, e)
 
     # # Determine message to send
     # if conversation_id is None:
@@ -130,13 +120,30 @@ async def get_chatling_response(
     #     # Existing conversation → send as is
     #     full_message = user_message
 
-        # Determine message to send
-    if conversation_id is None:
-        # First message in new conversation → prepend BOT_PROMPT
-        revised_message = BOT_PROMPT + user_message
-    else:
-        revised_message = user_message
-        instructions = instructions
+    # Instructions don't stay in the conversation history, so the sales prompt goes
+    # with every turn (the old code prepended it to the first message only, twice
+    # when no mapping existed, and the history carried it from there)
+    prompts_sent = {"sales": (1 if mapping else 2) if conversation_id is None else 0}
+    instructions = [prompts.instruction("sales")] + (instructions or [])
+    if instructions and prompts.BOT_PROMPT_consolidate in instructions:
+        prompts_sent["consolidate"] = 1
+    prompts.record_turn(bitrix_dialog_id, prompts_sent)
+    revised_message = user_message
+
+    # 🔹 A first question answered from the answer cache joins the conversation here
+    cached_turn = answer_cache.served(bitrix_dialog_id) if conversation_id is None else None
+    if cached_turn and user_message:
+        question, answer = cached_turn
+        revised_message = (
+            f"{prompts.instruction('cached_turn')}\nClient: {question}\nYou: {answer}\n\n"
+            f"Client's new message:\n{user_message}"
+        )
+
+    # 🔹 Internal-agent messages since the last reply ride along at no extra call
+    agent_entries = agent_context.pending(mapping) if user_message else []
+    if agent_entries:
+        instructions = (instructions or []) + [agent_context.instruction(agent_entries)]
+        logger.info("Sending %s buffered agent messages as context for dialog %s", len(agent_entries), bitrix_dialog_id)
 
 
     # Prepare payload for Chatling API
@@ -160,42 +167,247 @@ async def get_chatling_response(
         "Content-Type": "application/json"
     }
 
-    logger.info(f"➡️ Sending message to Chatling API\nURL: {CHATLING_API_URL}\nPayload: {json.dumps(payload, indent=2)}")
+    return payload, headers, conversation_id, chatling_contact_id, agent_entries
+
+
+def _conversation_id_of(data: dict):
+    inner = data.get("data")
+    if isinstance(inner, dict) and inner.get("conversation_id"):
+        return inner["conversation_id"]
+    return data.get("conversation_id")
+
+
+async def _save_new_conversation(bitrix_dialog_id: str, data: dict, conversation_id, chatling_contact_id):
+    """Save the conversation ID if Chatling created one; returns the ID now in use."""
+    new_conversation_id = _conversation_id_of(data)
+    if new_conversation_id and not conversation_id:
+        answer_cache.carried(bitrix_dialog_id)
+        try:
+            insert_result = await repository.upsert_chat_mapping({
+                "bitrix_dialog_id": bitrix_dialog_id,
+                "chatling_conversation_id": new_conversation_id,
+                "chatling_contact_id": chatling_contact_id
+            })
+            logger.debug("Supabase insert/upsert result: %s", insert_result, extra=PAYLOAD)
+        except Exception as e:
+            logger.error("Error inserting into Supabase: %s", e)
+    return conversation_id or new_conversation_id
+
+
+async def _standalone_question(user_message: str, bitrix_dialog_id: str, instructions) -> bool:
+    """True when the answer can't depend on conversation context, so the answer cache applies."""
+    if not answer_cache.cacheable(user_message):
+        return False
+    if instructions:
+        answer_cache.bypass()
+        return False
+    try:
+        mapping = await repository.get_chat_mapping(bitrix_dialog_id)
+    except Exception as e:
+        logger.error("Answer cache context check failed for dialog %s: %s", bitrix_dialog_id, e)
+        return False
+    context = answer_cache.served(bitrix_dialog_id) or agent_context.pending(mapping)
+    if context or (mapping and mapping.get("chatling_conversation_id")):
+        answer_cache.bypass()
+        return False
+    return True
+
+
+@metrics.timed("chatling")
+async def get_chatling_response(
+    user_message: str,
+    user_id: str = None,
+    bitrix_dialog_id: str = None,
+    bitrix_user_info: Optional[BitrixEvent] = None,  # Pass Bitrix user info here
+    ai_model_id: int = 24, #using model GPT 4.1 nano
+    language_id: int = None,
+    temperature: float = None,
+    instructions: Optional[list[str]] = None, 
+    fallback: bool = True,
+):
+    """
+    The Chatling reply for a message. With `fallback` (customer turns) any
+    failure answers CHATLING_FALLBACK_REPLY; without it (escalations, which
+    keep their pending rows and retry) it raises ChatlingUnavailable.
+    """
+    standalone = await _standalone_question(user_message, bitrix_dialog_id, instructions)
+    if standalone:
+        cached = answer_cache.get(user_message)
+        if cached is not None:
+            logger.info("Answered dialog %s from the answer cache", bitrix_dialog_id)
+            answer_cache.record_served(bitrix_dialog_id, user_message, cached)
+            return cached
+
+    try:
+        payload, headers, conversation_id, chatling_contact_id, agent_entries = await _prepare_chatling_request(
+            user_message, user_id, bitrix_dialog_id, bitrix_user_info,
+            ai_model_id, language_id, temperature, instructions
+        )
+    except Exception as e:
+        logger.error("chat_mapping read failed for dialog %s, Chatling not called: %s", bitrix_dialog_id, e)
+        return _failed(fallback, e)
+
+    logger.info("➡️ Sending message to Chatling API for dialog %s", bitrix_dialog_id)
+    logger.debug("Chatling payload: %s", payload, extra=PAYLOAD)
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
+    try:
+        response = await post_chatling(CHATLING_API_URL, headers, payload, hedge=True)
+        logger.info("⬅️ Chatling response [%s] for dialog %s", response.status_code, bitrix_dialog_id)
+        logger.debug("Chatling response body: %s", response.text, extra=PAYLOAD)
+        response.raise_for_status()
         try:
-            response = await client.post(CHATLING_API_URL, headers=headers, json=payload)
-            logger.info(f"⬅️ Chatling response [{response.status_code}]: {response.text}")
+            data = response.json()
+        except Exception as e:
+            logger.error("Failed to parse Chatling JSON response: %s", e)
+            logger.debug("Unparseable Chatling response text: %s", response.text, extra=PAYLOAD)
+            return _failed(fallback, e)
+
+        await _save_new_conversation(bitrix_dialog_id, data, conversation_id, chatling_contact_id)
+
+        reply = data.get("data", {}).get("response")
+        if not reply:
+            return "No reply from Chatling."
+        await agent_context.flushed(bitrix_dialog_id, agent_entries)
+        if standalone:
+            answer_cache.put(user_message, reply)
+        return reply
+
+    except ChatlingUnavailable as e:
+        logger.error("Chatling unavailable: %s", e)
+        return _failed(fallback, e)
+    except httpx.HTTPStatusError as e:
+        logger.error("Chatling API error: %s", e.response.status_code)
+        logger.debug("Chatling error body: %s", e.response.text, extra=PAYLOAD)
+        return _failed(fallback, e)
+    except Exception as e:
+        logger.error("Unexpected error sending to Chatling: %s", e)
+        return _failed(fallback, e)
+
+
+def _failed(fallback: bool, error: Exception) -> str:
+    if not fallback:
+        if isinstance(error, ChatlingUnavailable):
+            raise error
+        raise ChatlingUnavailable(str(error)) from error
+    return CHATLING_FALLBACK_REPLY
+
+
+def split_sentences(text: str) -> list[str]:
+    """Split text into sentence-sized chunks, keeping the trailing whitespace."""
+    return [chunk for chunk in _SENTENCE_CHUNK.findall(text) if chunk]
+
+
+def _stream_event_text(event: dict) -> str:
+    # Accept the common shapes of a streamed delta
+    data = event.get("data") if isinstance(event.get("data"), dict) else event
+    for key in ("delta", "token", "content", "text", "response"):
+        value = data.get(key)
+        if isinstance(value, str):
+            return value
+    return ""
+
+
+async def stream_chatling_response(
+    user_message: str,
+    user_id: str = None,
+    bitrix_dialog_id: str = None,
+    bitrix_user_info: Optional[BitrixEvent] = None,
+    ai_model_id: int = 24,
+    language_id: int = None,
+    temperature: float = None,
+    instructions: Optional[list[str]] = None,
+    fallback: bool = True,
+) -> AsyncIterator[str]:
+    """
+    Yield the Chatling reply incrementally. Uses a server-sent-event stream
+    when the API answers with one; otherwise the full reply is yielded in
+    sentence-sized chunks. Yields CHATLING_FALLBACK_REPLY if nothing could
+    be received, or raises ChatlingUnavailable without `fallback`. Raises
+    ChatlingStreamIncomplete if the stream breaks off after the first chunk
+    (transport error, or no final `[DONE]` event).
+    """
+    standalone = await _standalone_question(user_message, bitrix_dialog_id, instructions)
+    if standalone:
+        cached = answer_cache.get(user_message)
+        if cached is not None:
+            logger.info("Answered dialog %s from the answer cache", bitrix_dialog_id)
+            answer_cache.record_served(bitrix_dialog_id, user_message, cached)
+            for chunk in split_sentences(cached):
+                yield chunk
+            return
+
+    try:
+        payload, headers, conversation_id, chatling_contact_id, agent_entries = await _prepare_chatling_request(
+            user_message, user_id, bitrix_dialog_id, bitrix_user_info,
+            ai_model_id, language_id, temperature, instructions
+        )
+    except Exception as e:
+        logger.error("chat_mapping read failed for dialog %s, Chatling not called: %s", bitrix_dialog_id, e)
+        yield _failed(fallback, e)
+        return
+    payload["stream"] = True
+    logger.info("➡️ Streaming message from Chatling API for dialog %s", bitrix_dialog_id)
+
+    yielded = False
+    complete = False
+    finished = False
+    parts = []
+    try:
+        async with stream_chatling(CHATLING_API_URL, headers, payload) as response:
             response.raise_for_status()
-            try:
+            if response.headers.get("content-type", "").startswith("text/event-stream"):
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    raw = line[5:].strip()
+                    if raw == "[DONE]":
+                        finished = True
+                        continue
+                    if not raw:
+                        continue
+                    try:
+                        event = json.loads(raw)
+                    except ValueError:
+                        continue
+                    conversation_id = await _save_new_conversation(
+                        bitrix_dialog_id, event, conversation_id, chatling_contact_id
+                    )
+                    text = _stream_event_text(event)
+                    if text:
+                        yielded = True
+                        parts.append(text)
+                        yield text
+                complete = finished
+            else:
+                await response.aread()
                 data = response.json()
-            except Exception as e:
-                logger.error(f"Failed to parse Chatling JSON response: {str(e)} | Response text: {response.text}")
-                return f"Failed to parse Chatling response."
-            
-
-            # Save new conversation ID if Chatling created one
-            new_conversation_id = data.get("data", {}).get("conversation_id")
-            if new_conversation_id and not conversation_id:
-                try:
-                    insert_result = supabase.table("chat_mapping").upsert({
-                        "bitrix_dialog_id": bitrix_dialog_id,
-                        "chatling_conversation_id": new_conversation_id,
-                        "chatling_contact_id": chatling_contact_id
-                    }).execute()
-                    logger.info(f"Supabase insert/upsert result: {insert_result}")
-                except Exception as e:
-                    logger.error(f"Error inserting into Supabase: {str(e)}")
-
-            reply = data.get("data", {}).get("response", "No reply from Chatling.")
-            return reply
-
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Chatling API error: {e.response.status_code} - {e.response.text}")
-            return f"Chatling API error: {e.response.status_code} - {e.response.text}"
-        except Exception as e:
-            logger.error(f"Unexpected error sending to Chatling: {str(e)}")
-            return f"Unexpected error: {str(e)}"
+                await _save_new_conversation(bitrix_dialog_id, data, conversation_id, chatling_contact_id)
+                reply = data.get("data", {}).get("response") or "No reply from Chatling."
+                parts.append(reply)
+                for chunk in split_sentences(reply):
+                    yielded = True
+                    yield chunk
+                finished = True
+                complete = bool(data.get("data", {}).get("response"))
+    except ChatlingUnavailable as e:
+        logger.error("Chatling unavailable while streaming: %s", e)
+    except httpx.HTTPStatusError as e:
+        logger.error("Chatling API error while streaming: %s", e.response.status_code)
+    except Exception as e:
+        logger.error("Unexpected error streaming from Chatling: %s", e)
+
+    if not yielded:
+        if not fallback:
+            raise ChatlingUnavailable(f"no reply streamed for dialog {bitrix_dialog_id}")
+        yield CHATLING_FALLBACK_REPLY
+        return
+    if not finished:
+        # part of the reply is already out; the caller decides how to finish it
+        raise ChatlingStreamIncomplete(f"Chatling stream for dialog {bitrix_dialog_id} broke off")
+    if complete:
+        await agent_context.flushed(bitrix_dialog_id, agent_entries)
+    if standalone and complete:
+        answer_cache.put(user_message, "".join(parts))
 
 
 # async def get_or_create_chatling_contact(name=None, phone=None, email=None, bitrix_dialog_id=None):
@@ -213,39 +425,101 @@ async def get_chatling_response(
 async def get_or_create_chatling_contact(name=None,first_name=None,last_name=None, phone=None, email=None, bitrix_dialog_id=None,bitrix_user_info=None):
     # Check Supabase first
     try:
-        logger.info(f"🔹 get_or_create_chatling_contact called with bitrix_dialog_id={bitrix_dialog_id}, name={name}, phone={phone}, email={email}")
-        existing = supabase.table("chat_mapping").select("chatling_contact_id").eq("bitrix_dialog_id", bitrix_dialog_id).execute()
-        logger.info(f"Supabase check for existing contact returned: {existing.data}")
+        logger.info("🔹 get_or_create_chatling_contact called with bitrix_dialog_id=%s, name=%s, phone=%s, email=%s", bitrix_dialog_id, name, phone, email, extra=PAYLOAD)
+        existing = await repository.get_chat_mapping(bitrix_dialog_id)
+        logger.debug("Supabase check for existing contact returned: %s", existing, extra=PAYLOAD)
     except Exception as e:
-        logger.error(f"Error fetching from Supabase: {str(e)}")
-        existing = None
+        # unknown, not missing: creating one here could duplicate the dialog's contact
+        logger.error("Error fetching from Supabase: %s", e)
+        raise
 
     chatling_contact_id = None
-    if existing and existing.data and len(existing.data) > 0:
-        chatling_contact_id = existing.data[0].get("chatling_contact_id")
+    if existing:
+        chatling_contact_id = existing.get("chatling_contact_id")
         if chatling_contact_id:
-            logger.info(f"✅ Existing Chatling contact found: {chatling_contact_id}")
+            logger.info("✅ Existing Chatling contact found: %s", chatling_contact_id)
             return chatling_contact_id
     
 
-        # Create new contact
-    logger.info(f"⚡ No existing contact found. Creating new Chatling contact...")
+    # Join a creation already in flight for this dialog instead of making a second contact
+    task = _contact_creations.get(bitrix_dialog_id)
+    if task is not None:
+        _contact_stats["coalesced"] += 1
+        logger.info("Waiting for in-flight Chatling contact creation for dialog %s", bitrix_dialog_id)
+    else:
+        task = asyncio.create_task(_create_and_store_contact(bitrix_dialog_id, first_name, last_name, phone, email))
+        _contact_creations[bitrix_dialog_id] = task
+        task.add_done_callback(lambda _: _contact_creations.pop(bitrix_dialog_id, None))
+    # shield: a cancelled caller must not cancel the creation other callers wait on
+    return await asyncio.shield(task)
+
+
+async def _create_and_store_contact(bitrix_dialog_id, first_name, last_name, phone, email):
+    logger.info("⚡ No existing contact found. Creating new Chatling contact...")
     contact_id = await create_chatling_contact(first_name=first_name,last_name = last_name or "", phone=phone or "", email=email or "")
+    if not contact_id:
+        _contact_stats["create_failed"] += 1
+        return None
+    _contact_stats["created"] += 1
 
-    if contact_id:
-        try:
-            supabase.table("chat_mapping").upsert({
-            "bitrix_dialog_id": bitrix_dialog_id,
-            "chatling_contact_id": contact_id
-            }).execute()
+    try:
+        await repository.upsert_chat_mapping({
+        "bitrix_dialog_id": bitrix_dialog_id,
+        "chatling_contact_id": contact_id
+        })
 
-            logger.info(f"✅ Supabase updated with new Chatling contact: {contact_id}")
-        except Exception as e:
-            logger.error(f"Error updating Supabase with new contact: {str(e)}")
+        logger.info("✅ Supabase updated with new Chatling contact: %s", contact_id)
+    except Exception as e:
+        logger.error("Error updating Supabase with new contact: %s", e)
 
     return contact_id
 
 
+async def backfill_missing_contacts() -> int:
+    """
+    Create Chatling contacts for every chat_mapping row that has none, with
+    bounded concurrency, so a returning dialog's first reply doesn't wait on
+    contact creation. Returns the number of contacts created.
+    """
+    semaphore = asyncio.Semaphore(CONTACT_BACKFILL_CONCURRENCY)
+
+    async def backfill(row: dict) -> bool:
+        first_name, _, last_name = (row.get("name") or "").strip().partition(" ")
+        async with semaphore:
+            try:
+                contact_id = await get_or_create_chatling_contact(
+                    name=row.get("name"),
+                    first_name=first_name or None,
+                    last_name=last_name,
+                    phone=row.get("phone"),
+                    email=row.get("email"),
+                    bitrix_dialog_id=row["bitrix_dialog_id"],
+                )
+            except Exception as e:
+                logger.error("Contact backfill failed for dialog %s: %s", row['bitrix_dialog_id'], e)
+                contact_id = None
+        _contact_stats["backfilled" if contact_id else "backfill_failed"] += 1
+        return bool(contact_id)
+
+    created = 0
+    after = None
+    while True:
+        rows = await repository.get_mappings_without_contact(after=after, limit=CONTACT_BACKFILL_PAGE_SIZE)
+        if not rows:
+            break
+        results = await asyncio.gather(*(backfill(row) for row in rows))
+        created += sum(results)
+        after = rows[-1]["bitrix_dialog_id"]
+        if len(rows) < CONTACT_BACKFILL_PAGE_SIZE:
+            break
+    logger.info("Contact backfill finished: %s contacts created", created)
+    return created
+
+
+def contact_stats() -> dict:
+    return {**_contact_stats, "in_flight": len(_contact_creations)}
+
+
     # Else create new contact in Chatling
     # contact_id = await create_chatling_contact(name=name, phone=phone, email=email)
 
@@ -253,7 +527,7 @@ async def create_chatling_contact(first_name=None,last_name=None, phone=None, em
     """
     Create a new Chatling Contact and return the contact_id
     """
-    url = f"https://api.chatling.ai/v2/chatbots/{CHATLING_BOT_ID}/contacts"
+    url = f"{CHATLING_API_BASE}/chatbots/{CHATLING_BOT_ID}/contacts"
     headers = {
         "Authorization": f"Bearer {CHATLING_API_KEY}",
         "Content-Type": "application/json"
@@ -268,20 +542,19 @@ async def create_chatling_contact(first_name=None,last_name=None, phone=None, em
         }
     }
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        try:
-            logger.info(f"➡️ Sending Chatling contact create request")
-            logger.info(f"URL: {url}")
-            logger.info(f"Payload: {json.dumps(payload, indent=2)}")
-
-            resp = await client.post(url, headers=headers, json=payload)
-            logger.info(f"⬅️ Chatling contact create response [{resp.status_code}] {resp.text}")
-            resp.raise_for_status()
-            data = resp.json()
-            contact_id = data.get("data", {}).get("id")
-            logger.info(f"Created Chatling contact: {contact_id}")
-            return contact_id
-        except Exception as e:
-            logger.error(f"Error creating Chatling contact: {e} | Response: {resp.text if 'resp' in locals() else 'no response'}")
-            return None
-        
+    try:
+        logger.info("➡️ Sending Chatling contact create request")
+        logger.debug("Chatling contact payload: %s", payload, extra=PAYLOAD)
+
+        resp = await post_chatling(url, headers, payload)
+        logger.info("⬅️ Chatling contact create response [%s]", resp.status_code)
+        logger.debug("Chatling contact create body: %s", resp.text, extra=PAYLOAD)
+        resp.raise_for_status()
+        data = resp.json()
+        contact_id = data.get("data", {}).get("id")
+        logger.info("Created Chatling contact: %s", contact_id)
+        return contact_id
+    except Exception as e:
+        logger.error("Error creating Chatling contact: %s", e)
+        return None
+    
@@ -0,0 +1,228 @@
+"""
+Resilient transport for Chatling API calls.
+
+`post_chatling` wraps the pooled Chatling client with:
+  - retries with full-jitter exponential backoff on 429/5xx and network errors
+  - a circuit breaker that fails fast (ChatlingUnavailable) after repeated failures
+  - latency tracking (p50/p95/p99 of successful calls)
+  - optional hedging: a second request fired after a p95-based delay, first
+    answer wins. Chatling records every request as a conversation turn, so
+    hedging trades a possible duplicate turn for bounded tail latency.
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import httpx
+
+from http_clients import get_chatling_client
+
+logger = logging.getLogger("chatling-client")
+
+CHATLING_MAX_RETRIES = int(os.getenv("CHATLING_MAX_RETRIES", "2"))
+CHATLING_RETRY_BASE_SECONDS = float(os.getenv("CHATLING_RETRY_BASE_SECONDS", "0.5"))
+CHATLING_BREAKER_FAILURES = int(os.getenv("CHATLING_BREAKER_FAILURES", "5"))
+CHATLING_BREAKER_RESET_SECONDS = float(os.getenv("CHATLING_BREAKER_RESET_SECONDS", "30"))
+CHATLING_HEDGE_ENABLED = os.getenv("CHATLING_HEDGE_ENABLED", "false").lower() == "true"
+CHATLING_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("CHATLING_HEDGE_MIN_DELAY_SECONDS", "2"))
+CHATLING_HEDGE_MIN_SAMPLES = 20
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class ChatlingUnavailable(Exception):
+    """Chatling could not be reached: breaker open or retries exhausted."""
+
+
+class ChatlingStreamIncomplete(ChatlingUnavailable):
+    """A streamed reply broke off after part of it had been yielded."""
+
+
+_latencies: deque = deque(maxlen=500)
+_breaker = {"failures": 0, "opened_at": None, "probing": False}
+_stats = {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0, "hedged": 0, "hedge_wins": 0}
+
+
+# 🔹 Circuit breaker
+
+def _breaker_allows() -> bool:
+    opened_at = _breaker["opened_at"]
+    if opened_at is None:
+        return True
+    # half-open: one probe at a time once the reset window has passed,
+    # everyone else fails fast until it has a result
+    return not _breaker["probing"] and time.monotonic() - opened_at >= CHATLING_BREAKER_RESET_SECONDS
+
+
+def _admit() -> bool:
+    """Raise ChatlingUnavailable unless the breaker lets this request through; True if it is the probe."""
+    if not _breaker_allows():
+        _stats["short_circuited"] += 1
+        raise ChatlingUnavailable("Chatling circuit breaker is open")
+    _stats["requests"] += 1
+    if _breaker["opened_at"] is None:
+        return False
+    _breaker["probing"] = True
+    logger.info("Chatling circuit breaker half-open, sending one probe")
+    return True
+
+
+def _record_success(latency: float):
+    _latencies.append(latency)
+    if _breaker["opened_at"] is not None:
+        logger.info("Chatling circuit breaker closed")
+    _breaker["failures"] = 0
+    _breaker["opened_at"] = None
+
+
+def _record_failure():
+    _stats["failures"] += 1
+    _breaker["failures"] += 1
+    if _breaker["failures"] >= CHATLING_BREAKER_FAILURES:
+        if _breaker["opened_at"] is None:
+            logger.error(f"Chatling circuit breaker opened after {_breaker['failures']} failures")
+        _breaker["opened_at"] = time.monotonic()
+
+
+def breaker_state() -> str:
+    if _breaker["opened_at"] is None:
+        return "closed"
+    return "half-open" if _breaker["probing"] or _breaker_allows() else "open"
+
+
+# 🔹 Latency percentiles
+
+def percentile(pct: float) -> float | None:
+    if not _latencies:
+        return None
+    ordered = sorted(_latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def _hedge_delay() -> float | None:
+    if len(_latencies) < CHATLING_HEDGE_MIN_SAMPLES:
+        return None
+    return max(percentile(0.95), CHATLING_HEDGE_MIN_DELAY_SECONDS)
+
+
+# 🔹 Requests
+
+async def _attempt(url: str, headers: dict, payload: dict) -> httpx.Response:
+    client = get_chatling_client()
+    start = time.perf_counter()
+    response = await client.post(url, headers=headers, json=payload)
+    if response.status_code in RETRYABLE_STATUS:
+        raise httpx.HTTPStatusError(
+            f"Retryable Chatling status {response.status_code}", request=response.request, response=response
+        )
+    _record_success(time.perf_counter() - start)
+    return response
+
+
+async def _hedged_attempt(url: str, headers: dict, payload: dict) -> httpx.Response:
+    delay = _hedge_delay()
+    first = asyncio.create_task(_attempt(url, headers, payload))
+    if delay is None:
+        return await first
+    done, _ = await asyncio.wait({first}, timeout=delay)
+    if done:
+        return first.result()
+
+    _stats["hedged"] += 1
+    second = asyncio.create_task(_attempt(url, headers, payload))
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.cancel()
+                if task is second:
+                    _stats["hedge_wins"] += 1
+                return task.result()
+            error = task.exception()
+    raise error
+
+
+def _retry_delay(attempt: int, error: Exception) -> float:
+    if isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429:
+        retry_after = error.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            # never longer than the largest backoff: a webhook is waiting on this
+            return min(float(retry_after), CHATLING_RETRY_BASE_SECONDS * 2 ** max(CHATLING_MAX_RETRIES - 1, 0))
+    return random.uniform(0, CHATLING_RETRY_BASE_SECONDS * 2 ** attempt)
+
+
+async def post_chatling(url: str, headers: dict, payload: dict, hedge: bool = False) -> httpx.Response:
+    """
+    POST to Chatling with retries, circuit breaking and optional hedging.
+    Non-retryable responses (e.g. 4xx) are returned as-is for the caller to
+    handle; raises ChatlingUnavailable when Chatling cannot be reached.
+    """
+    probe = _admit()
+    try:
+        return await _post_with_retries(url, headers, payload, hedge)
+    finally:
+        if probe:
+            _breaker["probing"] = False
+
+
+async def _post_with_retries(url: str, headers: dict, payload: dict, hedge: bool) -> httpx.Response:
+    last_error = None
+    for attempt in range(CHATLING_MAX_RETRIES + 1):
+        if attempt:
+            _stats["retries"] += 1
+            delay = _retry_delay(attempt - 1, last_error)
+            logger.warning(f"Retrying Chatling request in {delay:.2f}s (attempt {attempt + 1}): {last_error}")
+            await asyncio.sleep(delay)
+        try:
+            if hedge and CHATLING_HEDGE_ENABLED:
+                return await _hedged_attempt(url, headers, payload)
+            return await _attempt(url, headers, payload)
+        except (httpx.HTTPStatusError, httpx.TransportError) as e:
+            last_error = e
+            _record_failure()
+            if not _breaker_allows():
+                break
+
+    raise ChatlingUnavailable(f"Chatling request failed: {last_error}")
+
+
+@asynccontextmanager
+async def stream_chatling(url: str, headers: dict, payload: dict):
+    """
+    Open a streaming POST to Chatling behind the circuit breaker. No retries:
+    once bytes have been relayed a retry would duplicate them.
+    """
+    probe = _admit()
+    client = get_chatling_client()
+    start = time.perf_counter()
+    try:
+        async with client.stream("POST", url, headers=headers, json=payload) as response:
+            if response.status_code in RETRYABLE_STATUS:
+                raise ChatlingUnavailable(f"Chatling stream failed with status {response.status_code}")
+            yield response
+    except (ChatlingUnavailable, httpx.TransportError) as e:
+        _record_failure()
+        if isinstance(e, ChatlingUnavailable):
+            raise
+        raise ChatlingUnavailable(f"Chatling stream failed: {e}") from e
+    finally:
+        if probe:
+            _breaker["probing"] = False
+    _record_success(time.perf_counter() - start)
+
+
+def stats() -> dict:
+    return {
+        **_stats,
+        "breaker": breaker_state(),
+        "latency_p50": percentile(0.5),
+        "latency_p95": percentile(0.95),
+        "latency_p99": percentile(0.99),
+    }
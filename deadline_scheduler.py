@@ -0,0 +1,123 @@
+"""
+In-process deadline scheduler for stopped-chat escalations.
+
+Keeps one deadline per dialog in a min-heap and sleeps until the earliest
+one, so escalations fire at their exact deadline without polling the
+pending_messages table. Scheduling is O(log n); cancelling is O(1) (the
+heap entry is marked dead and skipped when it surfaces).
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable
+
+logger = logging.getLogger("deadline-scheduler")
+
+Callback = Callable[[list[str]], Awaitable]
+
+# heap entries: [deadline (epoch seconds), sequence, dialog_id, alive]
+_heap: list[list] = []
+_entries: dict[str, list] = {}
+_sequence = itertools.count()
+_wakeup: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+_running: set[asyncio.Task] = set()
+_callback: Callback | None = None
+_stats = {"scheduled": 0, "cancelled": 0, "fired": 0}
+
+
+def schedule(dialog_id: str, deadline: float, replace: bool = False):
+    """
+    Set a dialog's deadline (epoch seconds). An existing deadline is kept
+    unless `replace` is True.
+    """
+    existing = _entries.get(dialog_id)
+    if existing is not None:
+        if not replace:
+            return
+        existing[3] = False
+    entry = [deadline, next(_sequence), dialog_id, True]
+    _entries[dialog_id] = entry
+    heapq.heappush(_heap, entry)
+    _stats["scheduled"] += 1
+    if _heap[0] is entry and _wakeup is not None:
+        _wakeup.set()
+
+
+def cancel(dialog_id: str):
+    entry = _entries.pop(dialog_id, None)
+    if entry is None:
+        return
+    entry[3] = False
+    _stats["cancelled"] += 1
+    # Rebuild once dead entries dominate so the heap doesn't grow unbounded
+    if len(_heap) > 64 and len(_heap) > 2 * len(_entries):
+        _heap[:] = [e for e in _heap if e[3]]
+        heapq.heapify(_heap)
+
+
+def deadline_for(dialog_id: str) -> float | None:
+    entry = _entries.get(dialog_id)
+    return entry[0] if entry else None
+
+
+def _pop_due(now: float) -> list[str]:
+    due = []
+    while _heap and (not _heap[0][3] or _heap[0][0] <= now):
+        entry = heapq.heappop(_heap)
+        if entry[3]:
+            entry[3] = False
+            _entries.pop(entry[2], None)
+            due.append(entry[2])
+    return due
+
+
+async def _run():
+    while True:
+        due = _pop_due(time.time())
+        if due:
+            _stats["fired"] += len(due)
+            task = asyncio.create_task(_fire(due))
+            _running.add(task)
+            task.add_done_callback(_running.discard)
+            continue
+        _wakeup.clear()
+        timeout = _heap[0][0] - time.time() if _heap else None
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _fire(dialog_ids: list[str]):
+    try:
+        await _callback(dialog_ids)
+    except Exception as e:
+        logger.error(f"Deadline callback failed for {dialog_ids}: {e}")
+
+
+async def start(callback: Callback):
+    global _task, _wakeup, _callback
+    _callback = callback
+    if _task is None or _task.done():
+        _wakeup = asyncio.Event()
+        _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, *_running, return_exceptions=True)
+    _task = None
+
+
+def stats() -> dict:
+    next_deadline = min((e[0] for e in _entries.values()), default=None)
+    return {
+        **_stats,
+        "pending": len(_entries),
+        "next_in_seconds": round(next_deadline - time.time(), 1) if next_deadline else None,
+    }
@@ -0,0 +1,93 @@
+"""
+Deduplication of redelivered Bitrix events.
+
+Bitrix redelivers ONIMBOTMESSAGEADD when the handler is slow. Each event is
+keyed on its MESSAGE_ID (or a hash of dialog, author, text and timestamp
+when the ID is missing) and remembered in a bounded in-memory window.
+With DEDUP_PERSIST=true first-seen keys are also claimed in the
+processed_events table (migrations/001_processed_events.sql) so restarts
+and other workers see them too. A key is released again with `forget` when
+its event was not processed (queue full, handler error), so Bitrix's retry
+gets through.
+"""
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import repository
+from bitrix_event import BitrixEvent
+
+logger = logging.getLogger("dedup")
+
+DEDUP_WINDOW_SIZE = int(os.getenv("DEDUP_WINDOW_SIZE", "10000"))
+DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", "3600"))
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "false").lower() == "true"
+
+_seen: "OrderedDict[str, float]" = OrderedDict()
+_stats = {"checked": 0, "duplicates": 0, "forgotten": 0, "persist_errors": 0}
+
+
+def event_key(parsed: BitrixEvent) -> Optional[str]:
+    if parsed.message_id:
+        return f"msg:{parsed.message_id}"
+    if not parsed.dialog_id:
+        return None
+    parts = (parsed.dialog_id, parsed.from_user_id, parsed.message, parsed.ts)
+    return "hash:" + hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def _remember(key: str) -> bool:
+    """Record a key; returns True if it was already in the window."""
+    now = time.monotonic()
+    # Every key has the same TTL, so the oldest entries expire first
+    while _seen:
+        expires_at = next(iter(_seen.values()))
+        if expires_at > now and len(_seen) < DEDUP_WINDOW_SIZE:
+            break
+        _seen.popitem(last=False)
+    if key in _seen:
+        return True
+    _seen[key] = now + DEDUP_TTL_SECONDS
+    return False
+
+
+async def is_duplicate(parsed: BitrixEvent) -> bool:
+    """True if this event was already received; marks it as seen otherwise."""
+    key = event_key(parsed)
+    if key is None:
+        return False
+    _stats["checked"] += 1
+    if _remember(key):
+        _stats["duplicates"] += 1
+        return True
+    if DEDUP_PERSIST:
+        try:
+            if not await repository.claim_event(key, parsed.dialog_id):
+                _stats["duplicates"] += 1
+                return True
+        except Exception as e:
+            _stats["persist_errors"] += 1
+            logger.error(f"Failed to persist event key {key}: {e}")
+    return False
+
+
+async def forget(parsed: BitrixEvent):
+    """Un-see an event that was rejected or failed, so its redelivery is handled."""
+    key = event_key(parsed)
+    if key is None:
+        return
+    _seen.pop(key, None)
+    _stats["forgotten"] += 1
+    if DEDUP_PERSIST:
+        try:
+            await repository.release_event(key)
+        except Exception as e:
+            _stats["persist_errors"] += 1
+            logger.error(f"Failed to release event key {key}: {e}")
+
+
+def stats() -> dict:
+    return {**_stats, "window": len(_seen)}
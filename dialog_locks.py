@@ -0,0 +1,53 @@
+"""
+Keyed async locks: one FIFO lock per dialog_id.
+
+Events for the same dialog run strictly one after another (asyncio.Lock
+wakes waiters in arrival order), events for different dialogs never wait
+on each other. Locks are reference counted and dropped once idle.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger("dialog-locks")
+
+DIALOG_LOCK_WARN_SECONDS = float(os.getenv("DIALOG_LOCK_WARN_SECONDS", "5"))
+
+# dialog_id -> [lock, number of holders + waiters]
+_locks: dict[str, list] = {}
+_stats = {"acquired": 0, "contended": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+
+@asynccontextmanager
+async def dialog_lock(dialog_id: str):
+    entry = _locks.get(dialog_id)
+    if entry is None:
+        entry = _locks[dialog_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    lock = entry[0]
+    try:
+        contended = lock.locked()
+        start = time.perf_counter()
+        await lock.acquire()
+        waited = time.perf_counter() - start
+        _stats["acquired"] += 1
+        if contended:
+            _stats["contended"] += 1
+            _stats["wait_seconds_total"] += waited
+            _stats["wait_seconds_max"] = max(_stats["wait_seconds_max"], waited)
+            if waited >= DIALOG_LOCK_WARN_SECONDS:
+                logger.warning(f"Dialog {dialog_id} waited {waited:.2f}s for its previous event")
+        try:
+            yield
+        finally:
+            lock.release()
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _locks.pop(dialog_id, None)
+
+
+def stats() -> dict:
+    return {**_stats, "active_dialogs": len(_locks)}
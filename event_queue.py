@@ -0,0 +1,104 @@
+"""
+In-process work queue for webhook events (WEBHOOK_MODE=queue).
+
+The webhook handler submits a job and returns immediately; a pool of
+workers runs it. With EVENT_PER_DIALOG_ORDERING enabled every dialog is
+pinned to one worker's shard, so jobs from the same dialog run in order
+while different dialogs run in parallel.
+"""
+import asyncio
+import logging
+import math
+import os
+import zlib
+from typing import Awaitable, Callable
+
+logger = logging.getLogger("event-queue")
+
+EVENT_QUEUE_MAXSIZE = int(os.getenv("EVENT_QUEUE_MAXSIZE", "1000"))
+EVENT_WORKERS = int(os.getenv("EVENT_WORKERS", "8"))
+EVENT_PER_DIALOG_ORDERING = os.getenv("EVENT_PER_DIALOG_ORDERING", "true").lower() == "true"
+EVENT_QUEUE_SHUTDOWN_TIMEOUT = float(os.getenv("EVENT_QUEUE_SHUTDOWN_TIMEOUT", "30"))
+
+Job = Callable[[], Awaitable]
+
+_queues: list[asyncio.Queue] = []
+_workers: list[asyncio.Task] = []
+_stats = {"submitted": 0, "rejected": 0, "processed": 0, "failed": 0}
+
+
+def _shard_for(dialog_id: str) -> asyncio.Queue:
+    if len(_queues) == 1:
+        return _queues[0]
+    return _queues[zlib.crc32(dialog_id.encode("utf-8")) % len(_queues)]
+
+
+async def start():
+    if _workers:
+        return
+    workers = max(EVENT_WORKERS, 1)
+    if EVENT_PER_DIALOG_ORDERING:
+        shard_size = max(math.ceil(EVENT_QUEUE_MAXSIZE / workers), 1)
+        _queues.extend(asyncio.Queue(maxsize=shard_size) for _ in range(workers))
+        _workers.extend(asyncio.create_task(_run(q, i)) for i, q in enumerate(_queues))
+    else:
+        _queues.append(asyncio.Queue(maxsize=EVENT_QUEUE_MAXSIZE))
+        _workers.extend(asyncio.create_task(_run(_queues[0], i)) for i in range(workers))
+    logger.info(
+        f"Event queue started: workers={workers}, maxsize={EVENT_QUEUE_MAXSIZE}, "
+        f"per_dialog_ordering={EVENT_PER_DIALOG_ORDERING}"
+    )
+
+
+def submit(dialog_id: str, job: Job) -> bool:
+    """Queue a job for a dialog. Returns False when the queue is full."""
+    if not _queues:
+        raise RuntimeError("event_queue.start() has not been called")
+    try:
+        _shard_for(dialog_id or "").put_nowait((dialog_id, job))
+    except asyncio.QueueFull:
+        _stats["rejected"] += 1
+        logger.warning(f"Event queue full, rejecting event for dialog {dialog_id}")
+        return False
+    _stats["submitted"] += 1
+    return True
+
+
+async def stop():
+    """Let queued jobs finish (up to the shutdown timeout), then stop the workers."""
+    if not _workers:
+        return
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(*(q.join() for q in _queues)),
+            timeout=EVENT_QUEUE_SHUTDOWN_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logger.error(f"Event queue not drained within {EVENT_QUEUE_SHUTDOWN_TIMEOUT}s, {depth()} events dropped")
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _queues.clear()
+    logger.info(f"Event queue stopped: {stats()}")
+
+
+async def _run(queue: asyncio.Queue, worker_id: int):
+    while True:
+        dialog_id, job = await queue.get()
+        try:
+            await job()
+            _stats["processed"] += 1
+        except Exception as e:
+            _stats["failed"] += 1
+            logger.error(f"Event worker {worker_id} failed for dialog {dialog_id}: {e}")
+        finally:
+            queue.task_done()
+
+
+def depth() -> int:
+    return sum(q.qsize() for q in _queues)
+
+
+def stats() -> dict:
+    return {**_stats, "depth": depth(), "workers": len(_workers)}
@@ -0,0 +1,87 @@
+import httpx
+import logging
+import os
+
+logger = logging.getLogger("http-clients")
+
+# Connection pool settings shared by every upstream
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+
+# Per-upstream timeouts (seconds)
+BITRIX_TIMEOUT_SECONDS = float(os.getenv("BITRIX_TIMEOUT_SECONDS", "30"))
+CHATLING_TIMEOUT_SECONDS = float(os.getenv("CHATLING_TIMEOUT_SECONDS", "30"))
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+
+_TIMEOUTS = {
+    "bitrix": BITRIX_TIMEOUT_SECONDS,
+    "chatling": CHATLING_TIMEOUT_SECONDS,
+}
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def _http2_available() -> bool:
+    if not HTTP2_ENABLED:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("HTTP2_ENABLED is set but the 'h2' package is missing; falling back to HTTP/1.1")
+        return False
+    return True
+
+
+def _build_client(name: str) -> httpx.AsyncClient:
+    timeout = _TIMEOUTS[name]
+    return httpx.AsyncClient(
+        http2=_http2_available(),
+        timeout=httpx.Timeout(timeout, connect=min(HTTP_CONNECT_TIMEOUT_SECONDS, timeout)),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """
+    Return the pooled client for an upstream ("bitrix" or "chatling").
+    Clients are normally opened in the app lifespan; outside of it
+    (scripts, one-off calls) one is created on first use.
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = _build_client(name)
+        _clients[name] = client
+    return client
+
+
+def get_bitrix_client() -> httpx.AsyncClient:
+    return get_client("bitrix")
+
+
+def get_chatling_client() -> httpx.AsyncClient:
+    return get_client("chatling")
+
+
+async def start_http_clients():
+    for name in _TIMEOUTS:
+        get_client(name)
+    logger.info(
+        f"HTTP clients ready: upstreams={list(_clients)}, http2={_http2_available()}, "
+        f"max_connections={HTTP_MAX_CONNECTIONS}, keepalive={HTTP_MAX_KEEPALIVE_CONNECTIONS}"
+    )
+
+
+async def close_http_clients():
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.error(f"Error closing {name} HTTP client: {e}")
+    _clients.clear()
+    logger.info("HTTP clients closed")
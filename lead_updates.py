@@ -0,0 +1,116 @@
+"""
+Coalesced, off-critical-path Bitrix lead field updates.
+
+`request_update` only records the wish to set a field and returns at once.
+Leads already flagged with the same value are skipped; the rest are sent
+by a background flusher as Bitrix `batch` calls of up to 50 commands.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import metrics
+from bitrix import call_bitrix_batch
+
+logger = logging.getLogger("lead-updates")
+
+BITRIX_BATCH_LIMIT = 50  # hard limit of the Bitrix batch method
+LEAD_UPDATE_FLUSH_SECONDS = float(os.getenv("LEAD_UPDATE_FLUSH_SECONDS", "2"))
+LEAD_FLAG_CACHE_SIZE = int(os.getenv("LEAD_FLAG_CACHE_SIZE", "50000"))
+
+# (lead_id, field, value) -> None, oldest first
+_flagged: "OrderedDict[tuple, None]" = OrderedDict()
+_pending: "OrderedDict[tuple, None]" = OrderedDict()
+_wakeup: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+_stats = {"requested": 0, "skipped": 0, "batched": 0, "batch_calls": 0, "failed": 0}
+
+
+def _ensure_started():
+    global _wakeup, _task
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_run())
+
+
+async def start():
+    _ensure_started()
+
+
+def request_update(lead_id: str, field_name: str, value):
+    """Queue a lead field update unless it is already applied or queued."""
+    key = (str(lead_id), field_name, value)
+    _stats["requested"] += 1
+    if key in _flagged or key in _pending:
+        _stats["skipped"] += 1
+        return
+    _pending[key] = None
+    _ensure_started()
+    if len(_pending) >= BITRIX_BATCH_LIMIT:
+        _wakeup.set()
+
+
+def _mark_flagged(key: tuple):
+    _flagged[key] = None
+    _flagged.move_to_end(key)
+    while len(_flagged) > LEAD_FLAG_CACHE_SIZE:
+        _flagged.popitem(last=False)
+
+
+async def flush():
+    """Send everything queued, in batches of up to 50 commands."""
+    if not _pending:
+        return
+    with metrics.timer("lead_update"):
+        await _flush()
+
+
+async def _flush():
+    while _pending:
+        keys = []
+        while _pending and len(keys) < BITRIX_BATCH_LIMIT:
+            keys.append(_pending.popitem(last=False)[0])
+        commands = {
+            f"u{i}": "crm.lead.update?" + urlencode({"id": lead_id, f"fields[{field_name}]": value})
+            for i, (lead_id, field_name, value) in enumerate(keys)
+        }
+        try:
+            response = await call_bitrix_batch(commands)
+        except Exception as e:
+            _stats["failed"] += len(keys)
+            logger.error(f"Lead update batch of {len(keys)} failed: {e}")
+            continue
+        _stats["batch_calls"] += 1
+        for i, key in enumerate(keys):
+            if f"u{i}" in response["result_error"] or not response["result"].get(f"u{i}"):
+                _stats["failed"] += 1
+                logger.error(f"Lead {key[0]} update failed: {response['result_error'].get(f'u{i}')}")
+            else:
+                _stats["batched"] += 1
+                _mark_flagged(key)
+
+
+async def _run():
+    while True:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), LEAD_UPDATE_FLUSH_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        await flush()
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    await flush()
+
+
+def stats() -> dict:
+    return {**_stats, "pending": len(_pending), "flagged": len(_flagged)}
@@ -0,0 +1,280 @@
+"""
+Durable local copy of chat_mapping in SQLite (WAL), synced to Supabase
+write-behind.
+
+With LOCAL_STORE_ENABLED=true repository.py reads chat_mapping rows from
+here before going to Supabase and writes them here first; a background task
+pushes changed fields to Supabase in batched upserts. A reply for a known
+dialog then needs no Supabase round trip and keeps its Chatling
+conversation through a Supabase outage.
+
+Rows track which fields changed since the last sync, so a batch upsert only
+sends those and never overwrites columns another worker set. A row is
+"complete" once its full Supabase state is known; partial rows (e.g. a
+status update for a dialog never read here) are written back but not served.
+
+Workers on one host can share the file. Separate instances each keep their
+own copy, so as with mapping_cache a row changed elsewhere is seen here
+after the next startup reconcile. SQLite calls run on a single-thread
+executor, so waiting on another worker's write lock (up to busy_timeout)
+never blocks the event loop.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger("local-store")
+
+LOCAL_STORE_ENABLED = os.getenv("LOCAL_STORE_ENABLED", "false").lower() == "true"
+LOCAL_STORE_PATH = os.getenv("LOCAL_STORE_PATH", "chat_mapping.sqlite3")
+LOCAL_STORE_SYNC_SECONDS = float(os.getenv("LOCAL_STORE_SYNC_SECONDS", "2"))
+LOCAL_STORE_SYNC_BATCH = int(os.getenv("LOCAL_STORE_SYNC_BATCH", "500"))
+LOCAL_STORE_RECONCILE_ON_STARTUP = os.getenv("LOCAL_STORE_RECONCILE_ON_STARTUP", "true").lower() == "true"
+
+KEY = "bitrix_dialog_id"
+
+Push = Callable[[list[dict]], Awaitable]
+Pull = Callable[[Optional[str], int], Awaitable[list[dict]]]
+
+_conn: sqlite3.Connection | None = None
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-store")
+_task: asyncio.Task | None = None
+_push: Push | None = None
+_pull: Pull | None = None
+_stats = {"hits": 0, "misses": 0, "writes": 0, "synced": 0, "sync_failures": 0, "reconciled": 0}
+
+
+def _connection() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(LOCAL_STORE_PATH, check_same_thread=False, isolation_level=None)
+        _conn.execute("pragma journal_mode=wal")
+        # WAL + NORMAL: commits don't fsync; a power loss can drop the last
+        # few writes, which are still pending for Supabase anyway
+        _conn.execute("pragma synchronous=normal")
+        _conn.execute("pragma busy_timeout=5000")
+        _conn.execute(
+            "create table if not exists chat_mapping ("
+            " bitrix_dialog_id text primary key,"
+            " row text not null,"
+            " dirty text not null default '[]',"
+            " complete integer not null default 0,"
+            " version integer not null default 0)"
+        )
+        _conn.execute("create index if not exists chat_mapping_dirty on chat_mapping (dirty) where dirty != '[]'")
+    return _conn
+
+
+def _load(conn: sqlite3.Connection, dialog_id: str):
+    found = conn.execute(
+        "select row, dirty, complete from chat_mapping where bitrix_dialog_id = ?", (dialog_id,)
+    ).fetchone()
+    if found is None:
+        return None, [], False
+    return json.loads(found[0]), json.loads(found[1]), bool(found[2])
+
+
+def _save(conn: sqlite3.Connection, dialog_id: str, row: dict, dirty: list, complete: bool):
+    conn.execute(
+        "insert into chat_mapping (bitrix_dialog_id, row, dirty, complete, version) values (?, ?, ?, ?, 1)"
+        " on conflict (bitrix_dialog_id) do update set"
+        " row = excluded.row, dirty = excluded.dirty, complete = excluded.complete, version = version + 1",
+        (dialog_id, json.dumps(row, default=str), json.dumps(sorted(dirty)), int(complete)),
+    )
+
+
+async def _in_thread(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, func, *args)
+
+
+def _get(dialog_id: str) -> Optional[dict]:
+    with _lock:
+        row, _, complete = _load(_connection(), dialog_id)
+    if row is None or not complete:
+        _stats["misses"] += 1
+        return None
+    _stats["hits"] += 1
+    return row
+
+
+def _write(dialog_id: str, fields: dict, complete: bool) -> tuple[dict, bool]:
+    with _lock:
+        conn = _connection()
+        conn.execute("begin immediate")
+        try:
+            row, dirty, was_complete = _load(conn, dialog_id)
+            row = {**(row or {}), **fields, KEY: dialog_id}
+            dirty = set(dirty) | (set(fields) - {KEY})
+            complete = complete or was_complete
+            _save(conn, dialog_id, row, list(dirty), complete)
+            conn.execute("commit")
+        except Exception:
+            conn.execute("rollback")
+            raise
+    _stats["writes"] += 1
+    return row, complete
+
+
+def _remember(row: dict) -> dict:
+    dialog_id = row[KEY]
+    with _lock:
+        conn = _connection()
+        conn.execute("begin immediate")
+        try:
+            local, dirty, _ = _load(conn, dialog_id)
+            merged = {**row, **{field: local[field] for field in dirty if local and field in local}}
+            _save(conn, dialog_id, merged, dirty, True)
+            conn.execute("commit")
+        except Exception:
+            conn.execute("rollback")
+            raise
+    return merged
+
+
+def _remember_all(rows: list[dict]):
+    for row in rows:
+        _remember(row)
+
+
+async def get(dialog_id: str) -> Optional[dict]:
+    """The dialog's row if its full state is known locally."""
+    return await _in_thread(_get, dialog_id)
+
+
+async def write(dialog_id: str, fields: dict, complete: bool = False) -> tuple[dict, bool]:
+    """
+    Apply changed fields locally and queue them for Supabase. `complete`
+    marks the result as the dialog's full state (e.g. a freshly inserted
+    row). Returns the merged row and whether it is complete.
+    """
+    return await _in_thread(_write, dialog_id, fields, complete)
+
+
+async def remember(row: dict) -> dict:
+    """Record a row read from Supabase; fields changed locally but not yet synced win. Returns the merged row."""
+    return await _in_thread(_remember, row)
+
+
+def _dirty_batch(limit: int) -> list[tuple[str, dict, list, int]]:
+    with _lock:
+        found = _connection().execute(
+            "select bitrix_dialog_id, row, dirty, version from chat_mapping where dirty != '[]' limit ?", (limit,)
+        ).fetchall()
+    return [(dialog_id, json.loads(row), json.loads(dirty), version) for dialog_id, row, dirty, version in found]
+
+
+def _mark_synced(synced: list[tuple[str, int]]):
+    with _lock:
+        conn = _connection()
+        # a row written again since it was read stays dirty for the next pass
+        conn.executemany(
+            "update chat_mapping set dirty = '[]' where bitrix_dialog_id = ? and version = ?", synced
+        )
+
+
+async def sync() -> int:
+    """Push every locally changed field to Supabase; returns rows synced."""
+    total = 0
+    while True:
+        batch = await _in_thread(_dirty_batch, LOCAL_STORE_SYNC_BATCH)
+        if not batch:
+            return total
+        # one upsert per set of changed fields so no column is sent as null
+        groups: dict[tuple, list] = {}
+        for dialog_id, row, dirty, version in batch:
+            groups.setdefault(tuple(dirty), []).append((dialog_id, row, version))
+        failed = False
+        for fields, entries in groups.items():
+            rows = [{KEY: dialog_id, **{f: row.get(f) for f in fields}} for dialog_id, row, _ in entries]
+            try:
+                await _push(rows)
+            except Exception as e:
+                _stats["sync_failures"] += 1
+                logger.error(f"Local store sync of {len(rows)} chat_mapping rows failed: {e}")
+                failed = True
+                continue
+            await _in_thread(_mark_synced, [(dialog_id, version) for dialog_id, _, version in entries])
+            _stats["synced"] += len(rows)
+            total += len(rows)
+        if failed or len(batch) < LOCAL_STORE_SYNC_BATCH:
+            return total
+
+
+async def reconcile():
+    """Startup: push local changes, then pull every Supabase row into the store."""
+    await sync()
+    after = None
+    while True:
+        rows = await _pull(after, LOCAL_STORE_SYNC_BATCH)
+        await _in_thread(_remember_all, rows)
+        _stats["reconciled"] += len(rows)
+        if len(rows) < LOCAL_STORE_SYNC_BATCH:
+            break
+        after = rows[-1][KEY]
+    logger.info(f"Local store reconciled {_stats['reconciled']} chat_mapping rows from Supabase")
+
+
+async def _run():
+    if LOCAL_STORE_RECONCILE_ON_STARTUP:
+        try:
+            await reconcile()
+        except Exception as e:
+            logger.error(f"Local store reconcile failed: {e}")
+    while True:
+        await asyncio.sleep(LOCAL_STORE_SYNC_SECONDS)
+        try:
+            await sync()
+        except Exception as e:
+            logger.error(f"Local store sync failed: {e}")
+
+
+async def start(push: Push, pull: Pull):
+    global _task, _push, _pull
+    _push, _pull = push, pull
+    await _in_thread(_connection)
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_run())
+
+
+async def stop():
+    """Stop the sync loop after a final push."""
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+    if _push is not None:
+        try:
+            await sync()
+        except Exception as e:
+            logger.error(f"Final local store sync failed: {e}")
+    await _in_thread(_close)
+
+
+def _close():
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+def stats() -> dict:
+    counts = {}
+    # skip the counts rather than wait on the event loop behind a busy write
+    if _conn is not None and _lock.acquire(blocking=False):
+        try:
+            rows, dirty = _conn.execute(
+                "select count(*), count(*) filter (where dirty != '[]') from chat_mapping"
+            ).fetchone()
+            counts = {"rows": rows, "dirty": dirty}
+        finally:
+            _lock.release()
+    return {**_stats, **counts, "path": LOCAL_STORE_PATH}
@@ -0,0 +1,121 @@
+"""
+Background writer for debug_logs.
+
+Rows are queued by `log()` and written by a single worker in bulk inserts,
+flushed when a batch fills up or the flush interval passes. When the queue
+is full, DEBUG_LOG_OVERFLOW decides what happens:
+  drop_new    - discard the incoming row (default, never delays the caller)
+  drop_oldest - discard the oldest queued row to make room
+  block       - wait for room (backpressure on the caller)
+"""
+import asyncio
+import logging
+import os
+
+import repository
+
+logger = logging.getLogger("log-sink")
+
+DEBUG_LOG_QUEUE_SIZE = int(os.getenv("DEBUG_LOG_QUEUE_SIZE", "1000"))
+DEBUG_LOG_BATCH_SIZE = int(os.getenv("DEBUG_LOG_BATCH_SIZE", "50"))
+DEBUG_LOG_FLUSH_SECONDS = float(os.getenv("DEBUG_LOG_FLUSH_SECONDS", "2"))
+DEBUG_LOG_OVERFLOW = os.getenv("DEBUG_LOG_OVERFLOW", "drop_new").lower()
+DEBUG_LOG_SHUTDOWN_TIMEOUT = float(os.getenv("DEBUG_LOG_SHUTDOWN_TIMEOUT", "10"))
+
+_STOP = object()
+
+_queue: asyncio.Queue | None = None
+_worker: asyncio.Task | None = None
+_stats = {"enqueued": 0, "dropped": 0, "written": 0, "failed": 0, "batches": 0}
+
+
+def _ensure_started() -> asyncio.Queue:
+    global _queue, _worker
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=DEBUG_LOG_QUEUE_SIZE)
+    if _worker is None or _worker.done():
+        _worker = asyncio.create_task(_run(_queue))
+    return _queue
+
+
+async def start():
+    _ensure_started()
+    logger.info(
+        f"debug_logs sink started: queue={DEBUG_LOG_QUEUE_SIZE}, batch={DEBUG_LOG_BATCH_SIZE}, "
+        f"flush={DEBUG_LOG_FLUSH_SECONDS}s, overflow={DEBUG_LOG_OVERFLOW}"
+    )
+
+
+async def log(row: dict):
+    queue = _ensure_started()
+    if DEBUG_LOG_OVERFLOW == "block":
+        await queue.put(row)
+        _stats["enqueued"] += 1
+        return
+    try:
+        queue.put_nowait(row)
+    except asyncio.QueueFull:
+        _stats["dropped"] += 1
+        if DEBUG_LOG_OVERFLOW != "drop_oldest":
+            return
+        queue.get_nowait()
+        queue.put_nowait(row)
+    _stats["enqueued"] += 1
+
+
+async def stop():
+    """Flush everything still queued and stop the worker."""
+    global _queue, _worker
+    if _queue is None or _worker is None:
+        return
+    await _queue.put(_STOP)
+    try:
+        await asyncio.wait_for(_worker, timeout=DEBUG_LOG_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error(f"debug_logs sink did not flush within {DEBUG_LOG_SHUTDOWN_TIMEOUT}s, {_queue.qsize()} rows lost")
+        _worker.cancel()
+    _queue = None
+    _worker = None
+    logger.info(f"debug_logs sink stopped: {stats()}")
+
+
+async def _flush(batch: list[dict]):
+    if not batch:
+        return
+    try:
+        await repository.insert_debug_logs(batch)
+        _stats["written"] += len(batch)
+        _stats["batches"] += 1
+    except Exception as e:
+        _stats["failed"] += len(batch)
+        logger.error(f"Failed to insert {len(batch)} debug logs: {e}")
+
+
+async def _run(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        row = await queue.get()
+        if row is _STOP:
+            return
+        batch = [row]
+        deadline = loop.time() + DEBUG_LOG_FLUSH_SECONDS
+        stopping = False
+        while len(batch) < DEBUG_LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is _STOP:
+                stopping = True
+                break
+            batch.append(row)
+        await _flush(batch)
+        if stopping:
+            return
+
+
+def stats() -> dict:
+    return {**_stats, "queued": _queue.qsize() if _queue else 0}
@@ -0,0 +1,130 @@
+"""
+Process-wide logging setup.
+
+`configure` replaces the per-module basicConfig calls: records are put on an
+in-memory queue by a QueueHandler and formatted/written by a QueueListener
+thread, so request handlers never block on stdout or file I/O. Messages
+are truncated to LOG_MAX_MESSAGE_CHARS, and records logged with
+`extra=PAYLOAD` (full request/response bodies) are sampled at
+LOG_PAYLOAD_SAMPLE_RATE.
+
+    LOG_LEVEL=INFO LOG_LEVELS="chatling=WARNING,bitrix=DEBUG" LOG_FORMAT=json
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# comma-separated logger=LEVEL overrides
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# text | json
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_FILE = os.getenv("LOG_FILE")
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", "2000"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1"))
+
+# Pass as `extra=PAYLOAD` on logs that dump whole payloads so they can be sampled
+PAYLOAD = {"payload": True}
+
+TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+
+# attributes every LogRecord has; anything else came in through `extra`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName"}
+
+_listener: logging.handlers.QueueListener | None = None
+_stats = {"truncated": 0, "sampled_out": 0}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _PayloadSampler(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "payload", False) and random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+            _stats["sampled_out"] += 1
+            return False
+        return True
+
+
+class _TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """Merges args and truncates in the caller; formatting happens on the listener thread."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if len(message) > LOG_MAX_MESSAGE_CHARS:
+            _stats["truncated"] += 1
+            message = f"{message[:LOG_MAX_MESSAGE_CHARS]}… [+{len(message) - LOG_MAX_MESSAGE_CHARS} chars]"
+        record.msg, record.args = message, None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        return record
+
+
+def _parse_levels(spec: str) -> dict[str, str]:
+    levels = {}
+    for item in spec.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure():
+    """Install the queue-backed root handler. Safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        return
+
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _TruncatingQueueHandler(log_queue)
+    queue_handler.addFilter(_PayloadSampler())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in _parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown)
+
+
+def shutdown():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def stats() -> dict:
+    return {**_stats, "level": LOG_LEVEL, "format": LOG_FORMAT, "payload_sample_rate": LOG_PAYLOAD_SAMPLE_RATE}
@@ -1,45 +1,115 @@
+from dotenv import load_dotenv
+
+# 🔹 Load .env once, before any module below reads its settings at import
+load_dotenv()
+
 from fastapi import FastAPI, Request
-from urllib.parse import parse_qs
+from fastapi.responses import JSONResponse, PlainTextResponse
+from functools import partial
 import logging
-from dotenv import load_dotenv
-from bitrix import handle_bitrix_event, update_lead_field
-import sys
-from supabase import create_client
+import logging_setup
+from logging_setup import PAYLOAD
+from bitrix import handle_bitrix_event, scheduler_stats, stop_scheduler, streaming_stats
+from http_clients import start_http_clients, close_http_clients
+import repository
+import log_sink
+import event_queue
+import dialog_locks
+import mapping_cache
+import dedup
+import deadline_scheduler
+import lead_updates
+import chatling_client
+import chatling
+import prompts
+import bitrix_event
+from bitrix_event import BitrixEvent
+import answer_cache
+import agent_context
+import metrics
+import local_store
+from dialog_locks import dialog_lock
 from datetime import datetime, timezone
 import os
+import socket
 
-BOT_PROMPT = """You are receiving this message as you are monitoring the chat. 
-You need to respond only to client while the message give is just for your reference as the internal team has already ansewerd to client. 
-If you answer internal user question also it will confuse client which we dont want
-So Do not reply. Just keep this as context only."""
-
-load_dotenv()
-monitor_task = None  # global reference to running monitor task
-
-# ✅ Initialize Supabase
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 # Load from environment with defaults
 MESSAGE_TIMEOUT_MINUTES = int(os.getenv("MESSAGE_TIMEOUT_MINUTES", "60"))
+# Delay before retrying a dialog whose escalation failed
 MONITOR_SLEEP_SECONDS = int(os.getenv("MONITOR_SLEEP_SECONDS", "60"))
+MONITOR_CONCURRENCY = int(os.getenv("MONITOR_CONCURRENCY", "10"))
+# How stopped-chat messages are stored: "append" (one row per message),
+# "rpc" (atomic server-side append) or "concat" (legacy read-modify-write)
+PENDING_STORAGE_MODE = os.getenv("PENDING_STORAGE_MODE", "append").lower()
+# "sync" answers Bitrix after the reply is sent, "queue" acknowledges at once
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "sync").lower()
+# Lease pending_messages rows before escalating (migrations/003_claim_pending_messages.sql)
+# so several workers/instances never escalate the same dialog
+MONITOR_ROW_CLAIMS = os.getenv("MONITOR_ROW_CLAIMS", "false").lower() == "true"
+MONITOR_CLAIM_LEASE_SECONDS = int(os.getenv("MONITOR_CLAIM_LEASE_SECONDS", "300"))
+# With row claims: how often to sweep for overdue rows no worker has scheduled (0 = never)
+MONITOR_SWEEP_SECONDS = int(os.getenv("MONITOR_SWEEP_SECONDS", "300"))
+MONITOR_SWEEP_LIMIT = int(os.getenv("MONITOR_SWEEP_LIMIT", "100"))
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+# Create missing Chatling contacts for existing dialogs in the background at startup
+CONTACT_BACKFILL_ON_STARTUP = os.getenv("CONTACT_BACKFILL_ON_STARTUP", "false").lower() == "true"
+# Run the internal-reply, new-dialog and escalation flows as one Supabase RPC each
+# (migrations/004_flow_rpcs.sql) instead of several round trips
+FLOW_RPCS = os.getenv("FLOW_RPCS", "false").lower() == "true"
+# Rows per request when rebuilding deadlines at startup
+DEADLINE_LOAD_PAGE_SIZE = int(os.getenv("DEADLINE_LOAD_PAGE_SIZE", "500"))
+
+async def log_to_supabase(dialog_id: str, user_id: str, event: str, stage: str, details: dict):
+    await log_sink.log({
+        "dialog_id": dialog_id,
+        "user_id": user_id,
+        "event": event,
+        "stage": stage,
+        "details": details
+    })
+
+
+# 🔹 Internal user replied: drop the dialog's pending messages and log it
+async def reset_pending_for_internal_reply(dialog_id: str, user_id: str, event: str) -> list[dict]:
+    if FLOW_RPCS:
+        # the RPC writes the debug_logs row in the same transaction
+        deleted = await repository.reset_pending_messages(dialog_id, user_id, event)
+    else:
+        deleted = await repository.delete_unflushed_pending(dialog_id)
+    deadline_scheduler.cancel(dialog_id)
+
+    if deleted:
+        record_ids = [row["id"] for row in deleted]
+        logger.info("Deleted pending_messages ids=%s for dialog %s", record_ids, dialog_id)
+        if not FLOW_RPCS:
+            await log_to_supabase(dialog_id, user_id, event, "deleted_pending", {
+                "pending_ids": record_ids,
+                "delete_resp": deleted
+            })
+    else:
+        logger.info("No pending_messages found for dialog %s, nothing to reset", dialog_id)
+        if not FLOW_RPCS:
+            await log_to_supabase(dialog_id, user_id, event, "no_pending", {
+                "note": "No pending_messages found while internal user replied"
+            })
+    return deleted
 
-def log_to_supabase(dialog_id: str, user_id: str, event: str, stage: str, details: dict):
-    try:
-        supabase.table("debug_logs").insert({
-            "dialog_id": dialog_id,
-            "user_id": user_id,
-            "event": event,
-            "stage": stage,
-            "details": details
-        }).execute()
-    except Exception as e:
-        logger.error(f"Failed to insert debug log: {e}")
 
+# 🔹 The dialog's chat_status, creating its chat_mapping row on first contact
+async def ensure_chat_mapping(dialog_id: str, row: dict) -> str:
+    if FLOW_RPCS:
+        mapping, created = await repository.get_or_create_chat_mapping({"bitrix_dialog_id": dialog_id, **row})
+        if created:
+            logger.info("No record found for dialog %s, inserted new mapping", dialog_id)
+        return mapping.get("chat_status") or "active"
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise RuntimeError("Missing SUPABASE_URL or SUPABASE_KEY in environment")
+    existing = await repository.get_chat_mapping(dialog_id)
+    if existing:
+        return existing.get("chat_status", "active")
+    logger.info("No record found for dialog %s, inserting new mapping...", dialog_id)
+    await repository.insert_chat_mapping({"bitrix_dialog_id": dialog_id, **row})
+    return "active"
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 from contextlib import asynccontextmanager
 
@@ -47,233 +117,233 @@ from contextlib import asynccontextmanager
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup logic
-    # asyncio.create_task(monitor_pending_messages())
-    logger.info("Background task for monitoring pending_messages started")
+    await start_http_clients()
+    if local_store.LOCAL_STORE_ENABLED:
+        await local_store.start(repository.upsert_chat_mappings, repository.get_chat_mappings_page)
+    await log_sink.start()
+    await lead_updates.start()
+    if WEBHOOK_MODE == "queue":
+        await event_queue.start()
+    await deadline_scheduler.start(escalate_due_dialogs)
+    # Supabase client + leftover deadlines load in the background so the first
+    # request is served without waiting for the SDK import
+    startup_task = asyncio.create_task(load_pending_deadlines())
+    backfill_task = None
+    sweep_task = None
+    if MONITOR_ROW_CLAIMS and MONITOR_SWEEP_SECONDS > 0:
+        sweep_task = asyncio.create_task(sweep_overdue_pending())
+    if CONTACT_BACKFILL_ON_STARTUP:
+        backfill_task = asyncio.create_task(chatling.backfill_missing_contacts())
 
     yield  # 👈 this is where the app runs
 
     # Shutdown logic (optional)
     logger.info("Shutting down app...")
+    for task in (startup_task, backfill_task, sweep_task):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await deadline_scheduler.stop()
+    await event_queue.stop()
+    await lead_updates.stop()
+    await stop_scheduler()
+    await log_sink.stop()
+    await close_http_clients()
+    if local_store.LOCAL_STORE_ENABLED:
+        await local_store.stop()
+    repository.shutdown()
 
 
 # 🟢 Initialize FastAPI with lifespan
 app = FastAPI(lifespan=lifespan)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-    stream=sys.stdout
-)
+logging_setup.configure()
 logger = logging.getLogger("bitrix-handler")
 
 
 logger.info(
-    f"Monitor configured with timeout={MESSAGE_TIMEOUT_MINUTES} minutes, "
-    f"sleep={MONITOR_SLEEP_SECONDS} seconds"
+    "Monitor configured with timeout=%s minutes, retry=%s seconds",
+    MESSAGE_TIMEOUT_MINUTES, MONITOR_SLEEP_SECONDS
 )
 
 @app.post("/bitrix-handler")
 async def bitrix_webhook(request: Request):
-    global monitor_task 
     # Read and parse request
     body_bytes = await request.body()
-    body_str = body_bytes.decode("utf-8", errors="replace")
-    logger.info(f"Raw body from Bitrix: {body_str}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw body from Bitrix: %s", body_bytes.decode('utf-8', errors='replace'), extra=PAYLOAD)
+
+    with metrics.timer("parse"):
+        parsed = bitrix_event.parse(body_bytes)
+    logger.info("Parsed Bitrix event: %r", parsed, extra=PAYLOAD)
+
+    # 🔹 Drop Bitrix redeliveries before any Supabase/Chatling work
+    if parsed.event == "ONIMBOTMESSAGEADD" and await dedup.is_duplicate(parsed):
+        logger.info("Duplicate Bitrix event ignored: %s", dedup.event_key(parsed))
+        metrics.count_event("duplicate")
+        return {"status": "ignored", "reason": "duplicate event"}
+
+    if WEBHOOK_MODE != "queue":
+        try:
+            return await process_bitrix_event(parsed)
+        except Exception:
+            # not handled, so Bitrix's redelivery must not count as a duplicate
+            if parsed.event == "ONIMBOTMESSAGEADD":
+                await dedup.forget(parsed)
+            raise
+
+    # 🔹 Respond-fast mode: validate, enqueue, acknowledge
+    event = parsed.event
+    dialog_id = parsed.dialog_id
+    if not event:
+        return {"status": "ignored", "reason": "missing event"}
+    if not event_queue.submit(dialog_id, partial(process_bitrix_event, parsed)):
+        if event == "ONIMBOTMESSAGEADD":
+            await dedup.forget(parsed)
+        metrics.count_event("rejected")
+        return JSONResponse(status_code=503, content={"status": "busy", "reason": "event queue full"})
+    return {"status": "queued"}
+
+
+async def process_bitrix_event(parsed: BitrixEvent):
+    # 🔹 Serialize events per dialog, keep different dialogs parallel
+    dialog_id = parsed.dialog_id
+    async with dialog_lock(dialog_id):
+        try:
+            result = await _process_bitrix_event(parsed)
+        except Exception:
+            metrics.count_event("error")
+            raise
+    metrics.count_event(_outcome(result))
+    return result
+
 
-    parsed = parse_qs(body_str)
-    logger.info(f"Parsed form data from Bitrix: {parsed}")
+def _outcome(result: dict) -> str:
+    if result.get("reason") == "auto stopped":
+        return "stopped"
+    if result.get("status") == "ok":
+        return "replied" if "reply" in result else "handled"
+    return result.get("status", "unknown")
 
+
+async def _process_bitrix_event(parsed: BitrixEvent):
     # Extract core fields
-    event = parsed.get("event", [""])[0]
-    message = parsed.get("data[PARAMS][MESSAGE]", [""])[0].strip()
-    dialog_id = parsed.get("data[PARAMS][DIALOG_ID]", [""])[0]
-    user_id = parsed.get("data[PARAMS][FROM_USER_ID]", [""])[0]
-    work_position = parsed.get("data[USER][WORK_POSITION]", [None])[0]
-    user_name = parsed.get("data[USER][NAME]", [None])[0]
-    first_name = parsed.get("data[USER][FIRST_NAME]", [None])[0]
-    last_name = parsed.get("data[USER][LAST_NAME]", [None])[0]
-    email = parsed.get("data[USER][EMAIL]", [None])[0]   # if provided by Bitrix
-    phone = parsed.get("data[USER][PHONE]", [None])[0]   # if provided by Bitrix
-
-    logger.info(f"Event: {event}, Message: {message}, Dialog ID: {dialog_id}, User ID: {user_id}")
-
-        # 🔹 Extract LEAD ID from CHAT_ENTITY_DATA_1
-    chat_entity_data = parsed.get("data[PARAMS][CHAT_ENTITY_DATA_1]", [None])[0]
-    lead_id = None
-    if chat_entity_data:
-        parts = chat_entity_data.split("|")
-        if len(parts) > 2 and parts[1] == "LEAD":
-            lead_id = parts[2]  # 558568
-
-    logger.info(f"Event: {event}, Message: {message}, Dialog ID: {dialog_id}, Lead ID: {lead_id}")
-
-    # 🔹 If we have a lead, update the custom True/False field
+    event = parsed.event
+    message = parsed.message.strip()
+    dialog_id = parsed.dialog_id
+    user_id = parsed.from_user_id
+    work_position = parsed.work_position
+    user_name = parsed.user_name
+    first_name = parsed.first_name
+    last_name = parsed.last_name
+    email = parsed.email   # if provided by Bitrix
+    phone = parsed.phone   # if provided by Bitrix
+
+        # 🔹 Extract LEAD ID from CHAT_ENTITY_DATA_1 (e.g. "...|LEAD|558568|...")
+    lead_id = parsed.lead_id
+
+    logger.info("Event: %s, Dialog ID: %s, User ID: %s, Lead ID: %s, Message: %r", event, dialog_id, user_id, lead_id, message, extra=PAYLOAD)
+
+    # 🔹 If we have a lead, update the custom True/False field (batched in the background)
     if lead_id:
-        await update_lead_field(lead_id, "UF_CRM_1592568003637", 1)
+        lead_updates.request_update(lead_id, "UF_CRM_1592568003637", 1)
 
         # 🔹 Detect HiddenMessage (whisper mode)
-    component_id = parsed.get("data[PARAMS][PARAMS][COMPONENT_ID]", [""])[0]
+    component_id = parsed.component_id
     if component_id == "HiddenMessage":
         if message.lower() == "stop auto":
-            supabase.table("chat_mapping").update({"chat_status": "stopped"}).eq("bitrix_dialog_id", dialog_id).execute()
-            logger.info(f"Chat {dialog_id} set to STOPPED")
+            await repository.update_chat_mapping(dialog_id, {"chat_status": "stopped"})
+            logger.info("Chat %s set to STOPPED", dialog_id)
             return {"status": "ok", "action": "stop auto"}
         elif message.lower() == "start auto":
-            supabase.table("chat_mapping").update({"chat_status": "active"}).eq("bitrix_dialog_id", dialog_id).execute()
-            logger.info(f"Chat {dialog_id} set to ACTIVE")
+            await repository.update_chat_mapping(dialog_id, {"chat_status": "active"})
+            logger.info("Chat %s set to ACTIVE", dialog_id)
             return {"status": "ok", "action": "start auto"}
         else:
-            logger.info(f"Ignored hidden message: {message}")
+            logger.info("Ignored hidden message: %s", message, extra=PAYLOAD)
             return {"status": "ignored", "reason": "other hidden message"}
 
     # Handle only real messages
     if event == "ONIMBOTMESSAGEADD":
-        log_to_supabase(dialog_id, user_id, event, "received", {
+        await log_to_supabase(dialog_id, user_id, event, "received", {
         "message": message,
         "work_position": work_position,
         "component_id": component_id
         })
          
         if not message:
-            logger.info(f"Ignoring ONIMBOTMESSAGEADD with empty message for dialog {dialog_id}")
+            logger.info("Ignoring ONIMBOTMESSAGEADD with empty message for dialog %s", dialog_id)
             return {"status": "ignored", "reason": "empty message"}
         
             # 🟢 If message is from INTERNAL USER (work_position present, not HiddenMessage)
         if work_position and component_id != "HiddenMessage":
-            logger.info(f"Internal user {user_id} responded in dialog {dialog_id} with message: {message!r}")
+            logger.info("Internal user %s responded in dialog %s", user_id, dialog_id)
 
             try:
-                # fetch latest pending_messages row for this dialog
-                existing_pm = supabase.table("pending_messages") \
-                    .select("id, created_at, message") \
-                    .eq("dialog_id", dialog_id) \
-                    .eq("flushed", False) \
-                    .order("created_at", desc=True) \
-                    .limit(1) \
-                    .execute()
-
-                logger.info(f"Latest pending_messages for {dialog_id}: {existing_pm.data}")
-
-                if existing_pm.data:
-                    record_id = existing_pm.data[0]["id"]
-                    # new_time = datetime.now(timezone.utc).isoformat()
-
-                    # delete pending_message record
-                    delete_resp = supabase.table("pending_messages") \
-                        .delete() \
-                        .eq("id", record_id) \
-                        .execute()
-
-                    logger.info(
-                        f"Deleted pending_messages id={record_id}. "
-                        f"Delete response: {delete_resp.data}"
-                    )
+                # delete every unflushed pending_messages row for this dialog
+                await reset_pending_for_internal_reply(dialog_id, user_id, event)
+            except Exception as e:
+                logger.error("Error resetting created_at for dialog %s: %s", dialog_id, e)
 
-                    log_to_supabase(dialog_id, user_id, event, "deleted_pending", {
-                        "pending_id": record_id,
-                        "delete_resp": delete_resp.data
-                    })
-                else:
-                    logger.info(f"No pending_messages found for dialog {dialog_id}, nothing to reset")
-                    log_to_supabase(dialog_id, user_id, event, "no_pending", {
-                        "note": "No pending_messages found while internal user replied"
-                    })
+            # 🔹 Keep the message as context for the bot's next reply in this dialog
+            # (sent with that turn's instructions, not as a Chatling call of its own)
+            if agent_context.AGENT_CONTEXT_ENABLED:
+                try:
+                    await agent_context.add(dialog_id, user_id, message)
+                except Exception as e:
+                    logger.error("Error buffering agent message for dialog %s: %s", dialog_id, e)
 
-            except Exception as e:
-                logger.error(f"Error resetting created_at for dialog {dialog_id}: {str(e)}")
-            
-            
-            # logger.info(f"Reached user_id ==24:{user_id}")
-
-
-            # if user_id == "24":
-            #     try:
-            #         logger.info(f"Reached inside user_id ==24:{user_id}")
-                   
-            #         await handle_bitrix_event(
-            #                 event="ONIMBOTMESSAGEADD",
-            #                 dialog_id=dialog_id,
-            #                 message= "",
-            #                 user_id=user_id,
-            #                 bitrix_user_info=parsed,
-            #                 instructions=[
-            #                    f"Internal context from admin (User {user_id}): {message}. Do not respond directly, only use this for context."
-            #                     ]
-            #                 )
-            #         logger.info(f"Forwarded internal user 24 message to Chatling: {message!r}")
-            #         return {"status": "ok", "action": "forwarded internal user 24"}
-            #     except Exception as e:
-            #         logger.error(f"Error forwarding internal message for context: {e}")
-            # # Instead of ignoring → send to Chatling but mark as context-only
-            # else:
             return {"status": "ok", "action": "reset timer"}
-            logger.info(f"Ignore internal user: {message!r}")
-
-        # Check if record exists
-        existing = supabase.table("chat_mapping").select("*").eq("bitrix_dialog_id", dialog_id).execute()
-
-        if not existing.data:  # no record found → insert
-            logger.info(f"No record found for dialog {dialog_id}, inserting new mapping...")
-            supabase.table("chat_mapping").insert({
-                "bitrix_dialog_id": dialog_id,
-                "chatling_conversation_id": None,  # will be filled later
-                "name": user_name or f"{first_name} {last_name}".strip(),
-                "phone": phone,
-                "email": email,
-                "chat_status": "active"
-            }).execute()
-            chat_status = "active"
-        else:  # record exists → reuse it
-            chat_status = existing.data[0].get("chat_status", "active")
+
+        # Reuse the dialog's record, inserting it on first contact
+        chat_status = await ensure_chat_mapping(dialog_id, {
+            "chatling_conversation_id": None,  # will be filled later
+            "name": user_name or f"{first_name} {last_name}".strip(),
+            "phone": phone,
+            "email": email,
+            "chat_status": "active"
+        })
 
 
         if chat_status == "stopped":
-            logger.info(f"Chat {dialog_id} is in STOPPED mode, ignoring message")
+            logger.info("Chat %s is in STOPPED mode, ignoring message", dialog_id)
                     # 🔹 Store / Append to pending_messages
         # 🔹 Store / Append to pending_messages
             try:
-                existing_pm = supabase.table("pending_messages") \
-                    .select("id,message") \
-                    .eq("dialog_id", dialog_id) \
-                    .eq("flushed", False) \
-                    .limit(1) \
-                    .execute()
-
-                logger.info(f"Fetched existing pending_messages for {dialog_id}: {existing_pm.data}")
-
-                if not existing_pm.data:
-                    # No record yet → insert new one
-                    supabase.table("pending_messages").insert({
-                        "dialog_id": dialog_id,
-                        "user_id": user_id,
-                        "message": message
-                    }).execute()
-                    logger.info(f"Inserted new pending_messages row for dialog {dialog_id} with message: {message}")
-
-                    # 🟢 Start monitor task if not running
-                    if monitor_task is None or monitor_task.done():
-                        monitor_task = asyncio.create_task(monitor_pending_messages())
-                        logger.info("Started monitor_pending_messages task because table is not empty")
+                if PENDING_STORAGE_MODE == "append":
+                    # One row per message; escalation joins them in created_at order
+                    await repository.insert_pending(dialog_id, user_id, message)
+                    logger.info("Appended pending_messages row for dialog %s", dialog_id)
+                elif PENDING_STORAGE_MODE == "rpc":
+                    record_id = await repository.append_pending_message(dialog_id, user_id, message)
+                    logger.info("Appended to pending_messages id=%s for dialog %s via RPC", record_id, dialog_id)
                 else:
-                    record = existing_pm.data[0]
-                    record_id = record["id"]
-                    old_msg = record.get("message") or ""
-                    logger.info(f"Existing message for dialog {dialog_id} (id={record_id}): {old_msg!r}")
+                    existing_pm = await repository.get_unflushed_pending(dialog_id)
+
+                    logger.debug("Fetched existing pending_messages for %s: %s", dialog_id, existing_pm, extra=PAYLOAD)
 
-                    new_msg = (old_msg + "\n" + message).strip()
-                    logger.info(f"Appending new message. Combined message for dialog {dialog_id}: {new_msg!r}")
+                    if not existing_pm:
+                        # No record yet → insert new one
+                        await repository.insert_pending(dialog_id, user_id, message)
+                        logger.info("Inserted new pending_messages row for dialog %s", dialog_id)
+                    else:
+                        record = existing_pm
+                        record_id = record["id"]
+                        old_msg = record.get("message") or ""
+                        logger.debug("Existing message for dialog %s (id=%s): %r", dialog_id, record_id, old_msg, extra=PAYLOAD)
 
-                    update_resp = supabase.table("pending_messages") \
-                        .update({"message": new_msg}) \
-                        .eq("id", record_id) \
-                        .execute()
+                        new_msg = (old_msg + "\n" + message).strip()
+                        logger.debug("Appending new message. Combined message for dialog %s: %r", dialog_id, new_msg, extra=PAYLOAD)
 
-                    logger.info(f"Update response from Supabase: {update_resp.data}")
-                
+                        update_resp = await repository.update_pending_message(record_id, new_msg)
 
+                        logger.debug("Update response from Supabase: %s", update_resp.data, extra=PAYLOAD)
+
+                # 🟢 Escalate once the timeout passes; the first message sets the deadline
+                deadline_scheduler.schedule(dialog_id, time.time() + MESSAGE_TIMEOUT_MINUTES * 60)
 
             except Exception as e:
-                logger.error(f"Error storing pending_messages for dialog {dialog_id}: {str(e)}")
+                logger.error("Error storing pending_messages for dialog %s: %s", dialog_id, e)
 
             return {"status": "ignored", "reason": "auto stopped"}
 
@@ -286,25 +356,26 @@ async def bitrix_webhook(request: Request):
         
         # Optional: filter for specific keywords
         # if "hello chatbot" in message.lower():
-        logger.info(f"Processing message for dialog {dialog_id}")
+        logger.info("Processing message for dialog %s", dialog_id)
         try:
-            response = await handle_bitrix_event(
-                event=event,
-                dialog_id=dialog_id,
-                message=message,
-                user_id=user_id,
-                bitrix_user_info=parsed
-            )
+            with metrics.timer("handle_event"):
+                response = await handle_bitrix_event(
+                    event=event,
+                    dialog_id=dialog_id,
+                    message=message,
+                    user_id=user_id,
+                    bitrix_user_info=parsed
+                )
             return response
         except Exception as e:
-            logger.error(f"Error handling Bitrix event: {str(e)}")
+            logger.error("Error handling Bitrix event: %s", e)
             return {"status": "error", "reason": str(e)}
     # else:
         #     logger.info(f"Message ignored due to keyword filter: {message}")
         #     return {"status": "ignored", "reason": "keyword not found"}
 
     # Ignore non-message events
-    logger.info(f"Ignoring non-message event {event} for dialog {dialog_id}")
+    logger.info("Ignoring non-message event %s for dialog %s", event, dialog_id)
     return {"status": "ignored", "reason": "non-message event or empty message"}
 
 
@@ -312,12 +383,12 @@ async def bitrix_webhook(request: Request):
 @app.post("/frejun-handler")
 async def frejun_webhook(request: Request):
     body = await request.json()
-    logger.info(f"Frejun webhook received: {body}")
+    logger.info("Frejun webhook received: %s", body, extra=PAYLOAD)
     try:
         response = await handle_frejun_event(body)
         return response
     except Exception as e:
-        logger.error(f"Error handling Frejun webhook: {str(e)}")
+        logger.error("Error handling Frejun webhook: %s", e)
         return {"status": "error", "reason": str(e)}
 
 
@@ -327,123 +398,287 @@ async def frejun_webhook(request: Request):
 def health():
     return {"status": "alive"}
 
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/prompts/report")
+def prompt_report():
+    return prompts.savings_report()
+
+
+@app.get("/stats")
+def stats():
+    return {
+        "dialog_locks": dialog_locks.stats(),
+        "agent_context": agent_context.stats(),
+        "event_queue": event_queue.stats(),
+        "mapping_cache": mapping_cache.stats(),
+        "local_store": local_store.stats() if local_store.LOCAL_STORE_ENABLED else None,
+        "debug_log_sink": log_sink.stats(),
+        "dedup": dedup.stats(),
+        "deadlines": {
+            **deadline_scheduler.stats(),
+            "worker_id": WORKER_ID,
+            "row_claims": MONITOR_ROW_CLAIMS,
+            "unfinished_escalations": len(_unfinished_escalations),
+        },
+        "lead_updates": lead_updates.stats(),
+        "bitrix_scheduler": scheduler_stats(),
+        "chatling": chatling_client.stats(),
+        "contacts": chatling.contact_stats(),
+        "streaming": streaming_stats(),
+        "answer_cache": answer_cache.stats(),
+        "logging": logging_setup.stats(),
+    }
+
 import asyncio
+import time
 from datetime import datetime, timedelta, timezone
 
-BOT_PROMPT_consolidate = """The user sent the following messages, which were delayed in reaching you. 
-Please read them all together and reply in a single, coherent response. 
-Do not answer each message individually.
-"""
-
+async def escalate_dialog(dialog_id: str, rows: list[dict], cutoff: datetime, semaphore: asyncio.Semaphore) -> list:
+    """
+    Send one dialog's overdue messages to Chatling as a single consolidated turn.
+    Returns the pending_messages ids to delete, or [] if escalation failed.
+    """
+    msg_ids = [row["id"] for row in rows]
+    messages_to_send = [row["message"] for row in rows if row.get("message")]
+
+    async with semaphore:
+        await log_to_supabase(dialog_id, "system", "monitor", "escalating", {
+            "msg_ids": msg_ids,
+            "message": "\n".join(messages_to_send),
+            "cutoff": cutoff.isoformat()
+        })
 
+        combined_message = "\n".join(messages_to_send)
+        logger.info("Escalating dialog %s (msg_ids=%s) to Chatling.ai", dialog_id, msg_ids)
 
-# 🟢 Background task to check pending messages
-async def monitor_pending_messages():
-    global monitor_task
-    while True:
         try:
-            now = datetime.now(timezone.utc)
-            cutoff = now - timedelta(minutes=MESSAGE_TIMEOUT_MINUTES)
-            cutoff_str = cutoff.strftime("%Y-%m-%d %H:%M:%S%z")
-            logger.info(f"Cutoff: {cutoff} ({cutoff_str})")
-
-
-            # Fetch all messages older than 60 mins
-            result = supabase.table("pending_messages") \
-                .select("id, dialog_id, message, created_at") \
-                .eq("flushed", False) \
-                .lte("created_at", cutoff_str) \
-                .execute()
-            
-            # logger.info(f"Escalating dialog {dialog_id} (msg_id={msg_id}) with message={message!r} to Chatling.ai")
-
-
-            if result.data:
-                logger.info(f"Found {len(result.data)} pending_messages older than {MESSAGE_TIMEOUT_MINUTES} mins")
-
-                messages_to_send = []
-
-                for row in result.data:
-                    dialog_id = row["dialog_id"]
-                    msg_id = row["id"]
-                    message = row["message"]
-
-                    log_to_supabase(dialog_id, "system", "monitor", "escalating", {
-                        "msg_id": msg_id,
-                        "message": message,
-                        "cutoff": cutoff.isoformat()
-                    })
-
-                    # # 🔹 Only process chat72172
-                    # if dialog_id != "chat72172":
-                    #     logger.info(f"Skipping dialog {dialog_id}, only monitoring chat72172")
-                    #     continue
-                    
-                    messages_to_send.append(message)
-
-                    if messages_to_send:
-                        combined_message = BOT_PROMPT_consolidate + "\n\n" + "\n".join(messages_to_send)
-                    logger.info(f"Escalating dialog {dialog_id} (msg_id={msg_id}) to Chatling.ai")
-
-                    try:
-                        # 🔹 Send to Chatling.ai
-                        response = await handle_bitrix_event(
-                            event="ONIMBOTMESSAGEADD",
-                            dialog_id=dialog_id,
-                            message=combined_message,
-                            user_id="system",   # system trigger
-                            bitrix_user_info={}
-                        )
-                        logger.info(f"Chatling response: {response}")
-
-                        log_to_supabase(dialog_id, "system", "monitor", "chatling_response", {
-                            "msg_id": msg_id,
-                            "response": response
-                        })
-
-                        # 🔹 Mark chat as active again
-                        supabase.table("chat_mapping") \
-                            .update({"chat_status": "active"}) \
-                            .eq("bitrix_dialog_id", dialog_id) \
-                            .execute()
-
-                        # 🔹 Delete the pending message record
-                        supabase.table("pending_messages") \
-                            .delete() \
-                            .eq("id", msg_id) \
-                            .execute()
-                        
-                        # 🟢 log after deletion
-                        log_to_supabase(dialog_id, "system", "monitor", "deleted_pending", {
-                            "msg_id": msg_id
-                        })
-
-                        logger.info(f"Dialog {dialog_id}: set ACTIVE + deleted pending_messages id={msg_id}")
-
-                    except Exception as e:
-                        logger.error(f"Error escalating dialog {dialog_id}: {str(e)}")
-                        log_to_supabase(dialog_id, user_id, "monitor", "error", {
-                            "msg_id": msg_id,
-                            "error": str(e)
-                        })
-
-            else:
-                logger.info(f"No pending_messages older than {MESSAGE_TIMEOUT_MINUTES} mins found")
-
-                count_check = supabase.table("pending_messages").select("id", count="exact").eq("flushed", False).execute()
-                if count_check.count == 0:
-                    logger.info("pending_messages table is empty. Stopping monitor task.")
-                    monitor_task = None
-                    return  
+            # 🔹 Send to Chatling.ai
+            async with dialog_lock(dialog_id):
+                with metrics.timer("handle_event"):
+                    response = await handle_bitrix_event(
+                        event="ONIMBOTMESSAGEADD",
+                        dialog_id=dialog_id,
+                        message=combined_message,
+                        user_id="system",   # system trigger
+                        bitrix_user_info=None,
+                        instructions=[prompts.instruction("consolidate")],
+                        # Chatling down: keep the rows and retry instead of sending the canned reply
+                        fallback=False
+                    )
+            logger.debug("Chatling response: %s", response, extra=PAYLOAD)
+
+            await log_to_supabase(dialog_id, "system", "monitor", "chatling_response", {
+                "msg_ids": msg_ids,
+                "response": response
+            })
+            metrics.count_event("escalated")
+            return msg_ids
 
         except Exception as e:
-            logger.error(f"Error in monitor_pending_messages: {str(e)}")
-            log_to_supabase("system", "system", "monitor", "fatal_error", {
+            logger.error("Error escalating dialog %s: %s", dialog_id, e)
+            metrics.count_event("error")
+            await log_to_supabase(dialog_id, "system", "monitor", "error", {
+                "msg_ids": msg_ids,
                 "error": str(e)
             })
+            return []
+
+
+async def escalate_overdue(rows: list[dict], cutoff: datetime) -> list[str]:
+    """
+    Escalate overdue rows, dialogs in parallel (bounded), then bulk-update and bulk-delete.
+    Returns the dialog ids that were escalated.
+    """
+    by_dialog: dict[str, list[dict]] = {}
+    for row in sorted(rows, key=lambda r: (r.get("created_at") or "", r["id"])):
+        by_dialog.setdefault(row["dialog_id"], []).append(row)
 
-        await asyncio.sleep(MONITOR_SLEEP_SECONDS)  # check every 1 min
+    semaphore = asyncio.Semaphore(MONITOR_CONCURRENCY)
+    results = await asyncio.gather(*(
+        escalate_dialog(dialog_id, dialog_rows, cutoff, semaphore)
+        for dialog_id, dialog_rows in by_dialog.items()
+    ))
 
+    escalated = {dialog_id: msg_ids for dialog_id, msg_ids in zip(by_dialog, results) if msg_ids}
+    if not escalated:
+        return []
+
+    try:
+        await finish_escalation(escalated)
+    except Exception as e:
+        # the replies are already in Bitrix: finalize dialog by dialog, never resend
+        logger.error("Error finalizing escalation for %s dialogs, finalizing one by one: %s", len(escalated), e)
+        await log_to_supabase("system", "system", "monitor", "error", {
+            "dialog_ids": list(escalated),
+            "error": str(e)
+        })
+        return await finish_each_escalation(escalated)
+
+    logger.info("Set ACTIVE + deleted pending_messages for %s dialogs", len(escalated))
+    return list(escalated)
+
+
+# 🔹 Dialogs whose escalation reply was sent but not finalized: dialog_id -> msg_ids.
+# Their deadline retries only the status update and delete. Kept in memory, so a
+# restart before the retry succeeds still resends those replies.
+_unfinished_escalations: dict[str, list] = {}
+
+
+async def finish_each_escalation(escalated: dict[str, list]) -> list[str]:
+    """Finalize dialogs one at a time; returns the finished ones, keeps the rest for a retry."""
+    finished = []
+    for dialog_id, ids in escalated.items():
+        try:
+            await finish_escalation({dialog_id: ids})
+            finished.append(dialog_id)
+        except Exception as e:
+            logger.error("Error finalizing escalation of dialog %s, will retry: %s", dialog_id, e)
+            _unfinished_escalations[dialog_id] = ids
+    return finished
+
+
+async def retry_unfinished_escalations(dialog_ids) -> list[str]:
+    due = {dialog_id: _unfinished_escalations.pop(dialog_id) for dialog_id in dialog_ids if dialog_id in _unfinished_escalations}
+    if not due:
+        return []
+    logger.info("Retrying finalize of %s already escalated dialogs", len(due))
+    return await finish_each_escalation(due)
+
+
+def _not_yet_sent(rows: list[dict]) -> list[dict]:
+    sent = {msg_id for ids in _unfinished_escalations.values() for msg_id in ids}
+    return [row for row in rows if row["id"] not in sent]
+
+
+# 🔹 Escalated dialogs: mark them active again, delete their pending rows and log it
+async def finish_escalation(escalated: dict[str, list]):
+    msg_ids = [msg_id for ids in escalated.values() for msg_id in ids]
+    if FLOW_RPCS:
+        # one transaction, debug_logs rows included
+        await repository.finish_escalation(list(escalated), msg_ids)
+        return
+
+    await repository.update_chat_status_bulk(list(escalated), "active")
+    await repository.delete_pending_bulk(msg_ids)
+
+    # 🟢 log after deletion
+    for dialog_id, ids in escalated.items():
+        await log_to_supabase(dialog_id, "system", "monitor", "deleted_pending", {
+            "msg_ids": ids
+        })
+
+
+# 🟢 Deadline callback: escalate dialogs whose pending messages timed out
+async def escalate_due_dialogs(dialog_ids: list[str]):
+    with metrics.timer("monitor_pass"):
+        await _escalate_due_dialogs(dialog_ids)
+
+
+async def _escalate_due_dialogs(dialog_ids: list[str]):
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=MESSAGE_TIMEOUT_MINUTES)
+    escalated = []
+    try:
+        escalated = await retry_unfinished_escalations(dialog_ids)
+        if MONITOR_ROW_CLAIMS:
+            rows = await repository.claim_pending_messages(dialog_ids, WORKER_ID, MONITOR_CLAIM_LEASE_SECONDS)
+        else:
+            rows = await repository.get_unflushed_pending_for_dialogs(dialog_ids)
+        rows = _not_yet_sent(rows)
+        # dialogs without rows have nothing left to send (or another worker holds them)
+        with_rows = {row["dialog_id"] for row in rows}
+        escalated += [
+            dialog_id for dialog_id in dialog_ids
+            if dialog_id not in with_rows and dialog_id not in _unfinished_escalations and dialog_id not in escalated
+        ]
+        if rows:
+            logger.info("Deadline reached for %s dialogs, %s pending_messages to escalate", len(dialog_ids), len(rows))
+            escalated += await escalate_overdue(rows, cutoff)
+    except Exception as e:
+        logger.error("Error in escalate_due_dialogs: %s", e)
+        await log_to_supabase("system", "system", "monitor", "fatal_error", {
+            "error": str(e)
+        })
+
+    # 🔹 Retry failed dialogs later instead of rescanning the table
+    for dialog_id in set(dialog_ids) - set(escalated):
+        deadline_scheduler.schedule(dialog_id, time.time() + MONITOR_SLEEP_SECONDS)
+
+
+# 🟢 With row claims: pick up overdue rows whose deadline lives in no running worker
+# (e.g. a worker that crashed while holding them, once its lease expired)
+async def sweep_overdue_pending():
+    while True:
+        await asyncio.sleep(MONITOR_SWEEP_SECONDS)
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=MESSAGE_TIMEOUT_MINUTES)
+        try:
+            with metrics.timer("monitor_pass"):
+                rows = await repository.claim_overdue_pending_messages(
+                    cutoff.isoformat(), WORKER_ID, MONITOR_CLAIM_LEASE_SECONDS, MONITOR_SWEEP_LIMIT
+                )
+                if not rows:
+                    continue
+                dialog_ids = {row["dialog_id"] for row in rows}
+                logger.info("Sweep claimed %s overdue pending_messages in %s dialogs", len(rows), len(dialog_ids))
+                escalated = await retry_unfinished_escalations(dialog_ids)
+                rows = _not_yet_sent(rows)
+                if rows:
+                    escalated += await escalate_overdue(rows, cutoff)
+        except Exception as e:
+            logger.error("Error sweeping overdue pending_messages: %s", e)
+            continue
+        for dialog_id in dialog_ids - set(escalated):
+            deadline_scheduler.schedule(dialog_id, time.time() + MONITOR_SLEEP_SECONDS)
+
+
+# 🟢 Startup: rebuild deadlines from rows left over from before the restart
+async def load_pending_deadlines():
+    try:
+        await repository.warm_up()
+        heads = await get_pending_heads()
+    except Exception as e:
+        logger.error("Failed to load pending_messages deadlines: %s", e)
+        return
+
+    timeout = MESSAGE_TIMEOUT_MINUTES * 60
+    for row in heads:
+        created_at = datetime.fromisoformat(row["created_at"])
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        # the oldest row per dialog sets its deadline; a webhook may already
+        # have scheduled a later one while this loaded
+        deadline = created_at.timestamp() + timeout
+        current = deadline_scheduler.deadline_for(row["dialog_id"])
+        if current is None or deadline < current:
+            deadline_scheduler.schedule(row["dialog_id"], deadline, replace=True)
+    logger.info("Loaded %s pending_messages deadlines", deadline_scheduler.stats()['pending'])
+
+
+# 🔹 Oldest unflushed row per dialog, page by page: a single select stops at
+# PostgREST's max-rows cap and the dialogs past it would never get a deadline
+async def get_pending_heads() -> list[dict]:
+    heads, after = [], None
+    try:
+        while True:
+            page = await repository.get_pending_heads_page(after, DEADLINE_LOAD_PAGE_SIZE)
+            if not page:
+                return heads
+            heads += page
+            after = page[-1]["dialog_id"]
+    except Exception as e:
+        logger.warning("pending_message_heads unavailable (migration 006), paging every unflushed row: %s", e)
+
+    rows, offset = [], 0
+    while True:
+        page = await repository.get_unflushed_pending_heads(offset, DEADLINE_LOAD_PAGE_SIZE)
+        if not page:
+            return rows
+        rows += page
+        offset += len(page)
 
 
 @app.get("/oauth")
@@ -459,7 +694,7 @@ async def oauth_redirect(request: Request):
         if not code:
             return {"status": "error", "reason": "missing code"}
 
-        logger.info(f"✅ Received OAuth code from Bitrix: {code}, state={state}")
+        logger.info("✅ Received OAuth code from Bitrix: %s, state=%s", code, state)
 
         return {
             "status": "success",
@@ -468,5 +703,5 @@ async def oauth_redirect(request: Request):
         }
 
     except Exception as e:
-        logger.error(f"Error in /oauth redirect: {str(e)}")
+        logger.error("Error in /oauth redirect: %s", e)
         return {"status": "error", "reason": str(e)}
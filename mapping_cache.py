@@ -0,0 +1,94 @@
+"""
+In-process TTL/LRU cache of chat_mapping rows keyed by bitrix_dialog_id.
+
+repository.py reads through this cache and writes every row it upserts or
+updates back into it, so a warm dialog needs no Supabase read at all.
+
+With several uvicorn workers each process has its own cache. Register a
+publisher with `set_invalidation_publisher` (e.g. Redis pub/sub) to fan out
+local writes, and call `invalidate` when another worker reports one.
+"""
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+logger = logging.getLogger("mapping-cache")
+
+MAPPING_CACHE_SIZE = int(os.getenv("MAPPING_CACHE_SIZE", "5000"))
+MAPPING_CACHE_TTL_SECONDS = float(os.getenv("MAPPING_CACHE_TTL_SECONDS", "300"))
+
+_rows: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+_publisher: Optional[Callable[[str], None]] = None
+_stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+
+def _lookup(dialog_id: str) -> Optional[dict]:
+    entry = _rows.get(dialog_id)
+    if entry is None:
+        return None
+    expires_at, row = entry
+    if expires_at < time.monotonic():
+        del _rows[dialog_id]
+        return None
+    _rows.move_to_end(dialog_id)
+    return dict(row)
+
+
+def get(dialog_id: str) -> Optional[dict]:
+    row = _lookup(dialog_id)
+    _stats["hits" if row is not None else "misses"] += 1
+    return row
+
+
+def put(dialog_id: str, row: dict, publish: bool = True):
+    if MAPPING_CACHE_SIZE <= 0:
+        return
+    _rows[dialog_id] = (time.monotonic() + MAPPING_CACHE_TTL_SECONDS, dict(row))
+    _rows.move_to_end(dialog_id)
+    while len(_rows) > MAPPING_CACHE_SIZE:
+        _rows.popitem(last=False)
+        _stats["evictions"] += 1
+    if publish:
+        _publish(dialog_id)
+
+
+def merge(dialog_id: str, fields: dict, publish: bool = True):
+    """Apply a partial update to a cached row; unknown rows are dropped instead."""
+    cached = _lookup(dialog_id)
+    if cached is None:
+        invalidate(dialog_id, publish=publish)
+        return
+    cached.update(fields)
+    put(dialog_id, cached, publish=publish)
+
+
+def invalidate(dialog_id: str, publish: bool = False):
+    if _rows.pop(dialog_id, None) is not None:
+        _stats["invalidations"] += 1
+    if publish:
+        _publish(dialog_id)
+
+
+def clear():
+    _rows.clear()
+
+
+def set_invalidation_publisher(publisher: Optional[Callable[[str], None]]):
+    """Register a callable that tells other workers a dialog's row changed."""
+    global _publisher
+    _publisher = publisher
+
+
+def _publish(dialog_id: str):
+    if _publisher is None:
+        return
+    try:
+        _publisher(dialog_id)
+    except Exception as e:
+        logger.error(f"Mapping cache invalidation publish failed for {dialog_id}: {e}")
+
+
+def stats() -> dict:
+    return {**_stats, "size": len(_rows)}
@@ -0,0 +1,109 @@
+"""
+In-process Prometheus metrics, rendered by GET /metrics.
+
+Latency histograms per reply stage and per Supabase operation, plus event
+outcome counters. Recording is a bisect and two integer increments; the
+text exposition is only built when /metrics is scraped.
+
+    with metrics.timer("chatling"):
+        ...
+    @metrics.timed("bitrix_send")
+    async def send(...): ...
+    metrics.count_event("ignored")
+"""
+import bisect
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+# seconds; covers cache hits (~1 ms) up to slow Chatling replies
+METRICS_BUCKETS = tuple(
+    float(b) for b in os.getenv(
+        "METRICS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30"
+    ).split(",")
+)
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "observations")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRICS_BUCKETS) + 1)
+        self.total = 0.0
+        self.observations = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.observations += 1
+
+
+# metric name -> (help, label name, {label value: Histogram})
+_histograms: dict[str, tuple[str, str, dict[str, Histogram]]] = {
+    "bot_stage_duration_seconds": ("Time spent per reply stage.", "stage", {}),
+    "bot_supabase_duration_seconds": ("Time per Supabase round trip.", "op", {}),
+}
+_events: dict[str, int] = {}
+
+
+def observe(stage: str, seconds: float, metric: str = "bot_stage_duration_seconds"):
+    series = _histograms[metric][2]
+    histogram = series.get(stage)
+    if histogram is None:
+        histogram = series[stage] = Histogram()
+    histogram.observe(seconds)
+
+
+def observe_supabase(op: str, seconds: float):
+    observe(op, seconds, "bot_supabase_duration_seconds")
+
+
+@contextmanager
+def timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def timed(stage: str):
+    """Decorator: time every call of an async function under `stage`."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timer(stage):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_event(outcome: str):
+    _events[outcome] = _events.get(outcome, 0) + 1
+
+
+def _format_le(bound: float) -> str:
+    return repr(bound) if bound != int(bound) else f"{bound:.1f}"
+
+
+def render() -> str:
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, (help_text, label, series) in _histograms.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for value, histogram in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label}="{value}",le="{_format_le(bound)}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{label}="{value}",le="+Inf"}} {histogram.observations}')
+            lines.append(f'{name}_sum{{{label}="{value}"}} {histogram.total}')
+            lines.append(f'{name}_count{{{label}="{value}"}} {histogram.observations}')
+
+    lines.append("# HELP bot_events_total Bitrix events handled, by outcome.")
+    lines.append("# TYPE bot_events_total counter")
+    for outcome, count in sorted(_events.items()):
+        lines.append(f'bot_events_total{{outcome="{outcome}"}} {count}')
+    return "\n".join(lines) + "\n"
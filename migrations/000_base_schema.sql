@@ -0,0 +1,37 @@
+-- Tables the bot reads and writes, as they exist in Supabase.
+-- Kept for reference and for setting up a fresh/local database;
+-- every statement is idempotent.
+
+create table if not exists chat_mapping (
+    bitrix_dialog_id text primary key,
+    chatling_conversation_id text,
+    chatling_contact_id text,
+    name text,
+    phone text,
+    email text,
+    chat_status text not null default 'active',
+    created_at timestamptz not null default now()
+);
+
+create table if not exists pending_messages (
+    id bigserial primary key,
+    dialog_id text not null,
+    user_id text,
+    message text,
+    flushed boolean not null default false,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists pending_messages_dialog_idx
+    on pending_messages (dialog_id, created_at)
+    where not flushed;
+
+create table if not exists debug_logs (
+    id bigserial primary key,
+    dialog_id text,
+    user_id text,
+    event text,
+    stage text,
+    details jsonb,
+    created_at timestamptz not null default now()
+);
@@ -0,0 +1,13 @@
+-- Bitrix event keys already handled, used by dedup.py when DEDUP_PERSIST=true
+-- so redelivered ONIMBOTMESSAGEADD events are recognised across restarts and workers.
+
+create table if not exists processed_events (
+    event_key text primary key,
+    dialog_id text,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists processed_events_created_idx on processed_events (created_at);
+
+-- Rows only matter for as long as Bitrix may redeliver; prune old ones periodically:
+-- delete from processed_events where created_at < now() - interval '1 day';
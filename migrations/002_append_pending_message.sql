@@ -0,0 +1,34 @@
+-- Atomic server-side append for PENDING_STORAGE_MODE=rpc.
+-- Appends a message to the dialog's unflushed pending_messages row (or creates
+-- it) in one round trip; the advisory lock serialises concurrent appends for
+-- the same dialog so no message is lost.
+
+create or replace function append_pending_message(p_dialog_id text, p_user_id text, p_message text)
+returns bigint
+language plpgsql
+as $$
+declare
+    v_id bigint;
+begin
+    perform pg_advisory_xact_lock(hashtext('pending_messages:' || p_dialog_id));
+
+    update pending_messages
+       set message = case when coalesce(message, '') = '' then p_message
+                          else message || E'\n' || p_message end
+     where id = (
+        select id from pending_messages
+         where dialog_id = p_dialog_id and not flushed
+         order by created_at
+         limit 1
+     )
+    returning id into v_id;
+
+    if v_id is null then
+        insert into pending_messages (dialog_id, user_id, message)
+        values (p_dialog_id, p_user_id, p_message)
+        returning id into v_id;
+    end if;
+
+    return v_id;
+end;
+$$;
@@ -0,0 +1,67 @@
+-- Row claiming for stopped-chat escalation with several workers/instances
+-- (MONITOR_ROW_CLAIMS=true). A worker leases every unflushed row of a dialog
+-- before escalating it, so each dialog is escalated by exactly one worker.
+-- Leases expire, so rows held by a crashed worker are picked up by the
+-- periodic sweep of another one.
+
+alter table pending_messages add column if not exists claimed_by text;
+alter table pending_messages add column if not exists claimed_until timestamptz;
+
+-- Claims whole dialogs: a dialog is skipped while another worker's lease on
+-- any of its rows is live. Dialogs are locked in sorted order with the same
+-- advisory key as append_pending_message, so claims never interleave with
+-- an append or with each other.
+create or replace function claim_pending_messages(p_dialog_ids text[], p_worker text, p_lease_seconds int default 300)
+returns setof pending_messages
+language plpgsql
+as $$
+declare
+    v_dialog text;
+begin
+    for v_dialog in select distinct d from unnest(p_dialog_ids) as d order by d loop
+        perform pg_advisory_xact_lock(hashtext('pending_messages:' || v_dialog));
+
+        continue when exists (
+            select 1 from pending_messages
+             where dialog_id = v_dialog and not flushed
+               and claimed_by is distinct from p_worker
+               and claimed_until > now()
+        );
+
+        return query
+            with claimed as (
+                update pending_messages
+                   set claimed_by = p_worker,
+                       claimed_until = now() + make_interval(secs => p_lease_seconds)
+                 where dialog_id = v_dialog and not flushed
+                returning *
+            )
+            select * from claimed;
+    end loop;
+end;
+$$;
+
+-- Sweep: claim up to p_limit dialogs whose oldest unclaimed row is older than p_cutoff.
+create or replace function claim_overdue_pending_messages(
+    p_cutoff timestamptz, p_worker text, p_lease_seconds int default 300, p_limit int default 100
+)
+returns setof pending_messages
+language sql
+as $$
+    select * from claim_pending_messages(
+        array(
+            select dialog_id from pending_messages
+             where not flushed and (claimed_until is null or claimed_until <= now())
+             group by dialog_id
+            having min(created_at) <= p_cutoff
+             order by min(created_at)
+             limit p_limit
+        ),
+        p_worker,
+        p_lease_seconds
+    );
+$$;
+
+create index if not exists pending_messages_claim_idx
+    on pending_messages (created_at)
+    where not flushed;
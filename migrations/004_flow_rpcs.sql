@@ -0,0 +1,81 @@
+-- One-round-trip versions of the multi-step flows in main.py (FLOW_RPCS=true).
+-- Each function is a single transaction, so a flow happens completely or not
+-- at all, and the debug_logs row is written with the change it describes.
+
+-- New dialog: the dialog's mapping, inserting p_row first if there is none.
+-- Returns the row plus "created". A concurrent insert of the same dialog
+-- waits on the conflict and then reads the winner's row.
+create or replace function get_or_create_chat_mapping(p_row jsonb)
+returns jsonb
+language plpgsql
+as $$
+declare
+    v_row chat_mapping;
+begin
+    insert into chat_mapping (bitrix_dialog_id, chatling_conversation_id, name, phone, email, chat_status)
+    values (
+        p_row->>'bitrix_dialog_id',
+        p_row->>'chatling_conversation_id',
+        p_row->>'name',
+        p_row->>'phone',
+        p_row->>'email',
+        coalesce(p_row->>'chat_status', 'active')
+    )
+    on conflict (bitrix_dialog_id) do nothing
+    returning * into v_row;
+
+    if found then
+        return to_jsonb(v_row) || jsonb_build_object('created', true);
+    end if;
+
+    select * into v_row from chat_mapping where bitrix_dialog_id = p_row->>'bitrix_dialog_id';
+    return to_jsonb(v_row) || jsonb_build_object('created', false);
+end;
+$$;
+
+-- Internal user replied: drop the dialog's unflushed pending messages and
+-- log what was dropped. Returns the deleted rows.
+create or replace function reset_pending_messages(p_dialog_id text, p_user_id text, p_event text)
+returns setof pending_messages
+language sql
+as $$
+    with deleted as (
+        delete from pending_messages
+         where dialog_id = p_dialog_id and not flushed
+        returning *
+    ), logged as (
+        insert into debug_logs (dialog_id, user_id, event, stage, details)
+        select p_dialog_id, p_user_id, p_event,
+               case when count(*) > 0 then 'deleted_pending' else 'no_pending' end,
+               case when count(*) > 0
+                    then jsonb_build_object('pending_ids', jsonb_agg(id order by id),
+                                            'delete_resp', jsonb_agg(to_jsonb(deleted) order by id))
+                    else jsonb_build_object('note', 'No pending_messages found while internal user replied')
+               end
+          from deleted
+    )
+    select * from deleted;
+$$;
+
+-- Escalation done: set the dialogs active again, delete the escalated rows
+-- and log one deleted_pending row per dialog. Returns the deleted ids.
+create or replace function finish_escalation(p_dialog_ids text[], p_msg_ids bigint[])
+returns setof bigint
+language sql
+as $$
+    with activated as (
+        update chat_mapping set chat_status = 'active'
+         where bitrix_dialog_id = any(p_dialog_ids)
+    ), deleted as (
+        delete from pending_messages
+         where id = any(p_msg_ids)
+        returning id, dialog_id
+    ), logged as (
+        insert into debug_logs (dialog_id, user_id, event, stage, details)
+        select dialog_id, 'system', 'monitor', 'deleted_pending',
+               jsonb_build_object('msg_ids', jsonb_agg(id order by id))
+          from deleted
+         group by dialog_id
+    )
+    select id from deleted;
+$$;
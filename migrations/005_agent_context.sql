@@ -0,0 +1,6 @@
+-- Internal-agent messages waiting to go to Chatling as instructions with the
+-- dialog's next customer turn (AGENT_CONTEXT_ENABLED=true, see agent_context.py).
+-- A list of {"user_id", "text", "at"} objects, oldest first; emptied once
+-- Chatling has answered with them.
+
+alter table chat_mapping add column if not exists agent_context jsonb not null default '[]'::jsonb;
@@ -0,0 +1,11 @@
+-- Oldest unflushed message per dialog, for rebuilding escalation deadlines at
+-- startup (main.load_pending_deadlines). One row per dialog instead of one
+-- per message, read in pages, so a backlog bigger than PostgREST's max-rows
+-- cap (1000 by default) still gets a deadline for every dialog. Served by
+-- pending_messages_dialog_idx from 000_base_schema.sql.
+
+create or replace view pending_message_heads as
+select dialog_id, min(created_at) as created_at
+  from pending_messages
+ where not flushed
+ group by dialog_id;
@@ -0,0 +1,154 @@
+"""
+Prompts sent to Chatling, kept in one place with a version tag each.
+
+Prompts go out as Chatling `instructions` (not glued onto the customer's
+message). Instructions apply to a single turn and are not kept in the
+conversation history, so the sales prompt is sent on every turn to keep its
+rules in force; the consolidation prompt goes only with escalations.
+
+`savings_report()` compares, per conversation, the prompt tokens sent this
+way with the old prepend-to-message approach. There a prompt was sent once
+in the first message body (twice when the dialog had no mapping yet) and
+then replayed with the history on every later turn. The difference is
+positive only for those duplicated copies and for consolidation prompts,
+which used to stay in the history after their escalation.
+"""
+import logging
+import os
+from collections import OrderedDict
+from functools import lru_cache
+
+logger = logging.getLogger("prompts")
+
+# Credits Chatling bills per 1000 prompt tokens for the configured model (0 = unknown)
+CHATLING_CREDITS_PER_1K_TOKENS = float(os.getenv("CHATLING_CREDITS_PER_1K_TOKENS", "0"))
+PROMPT_REPORT_MAX_CONVERSATIONS = int(os.getenv("PROMPT_REPORT_MAX_CONVERSATIONS", "10000"))
+
+# 🔹 Finideas startup prompt (first turn of a new conversation)
+BOT_PROMPT = """You are a Finideas sales representative.
+
+Your main goal is to understand the visitor's Investment requirements, challenges, and financial goals — and then guide them step by step toward becoming a registered Finideas client.
+
+Start every new conversation by asking 2-3 short, friendly questions to understand their needs (for example, their investment goals, experience, or challenges). Keep it conversational and engaging.
+
+After learning about their needs:
+- Check if the user has already seen our presentation, YouTube videos, or attended our webinar.  
+  If they haven't, politely motivate them to do so. 
+
+If the user *has* already seen our presentation or webinar:
+- Ask whether they have completed their KYC.  
+  - If no, explain the advantages of KYC — mention that it's free, simple, and unlocks the ability to explore our personalized investment solutions. Motivate them to complete it.  
+  - If they have already done KYC, acknowledge it positively and invite them to share their queries or areas where they'd like more clarity or guidance.
+
+Throughout the chat:
+- Keep responses short, clear, and natural — never robotic or overly formal.
+- Use a warm, consultative tone focused on understanding, helping, and creating trust — not on pushing sales.
+- End replies with open-ended questions to keep the visitor engaged and move them toward the next step in the journey.
+
+Motivate the user to save contact of this whatsapp chat for receiving important updates later.
+"""
+
+# 🔹 Escalation of messages held while the chat was stopped
+BOT_PROMPT_consolidate = """The user sent the following messages, which were delayed in reaching you. 
+Please read them all together and reply in a single, coherent response. 
+Do not answer each message individually.
+"""
+
+# 🔹 Internal-team messages sent along with the next customer turn (agent_context.py)
+AGENT_CONTEXT_PROMPT = """Below are messages our internal team wrote in this chat since your last reply. They are for your reference only.
+The team has already answered the client on these points, so do not repeat or answer them and do not mention the internal team.
+Reply only to the client's latest message, consistent with what the team said.
+"""
+
+# 🔹 Header for a question answered from the answer cache, written into the
+# dialog's first Chatling message so the conversation history includes it
+CACHED_TURN_PROMPT = """Earlier in this chat, before this conversation started, the client asked the question below and was sent the answer below.
+Treat it as part of this conversation: do not greet the client again or repeat that answer.
+"""
+
+PROMPTS = {
+    "sales": {"version": "sales-v2", "text": BOT_PROMPT},
+    "consolidate": {"version": "consolidate-v1", "text": BOT_PROMPT_consolidate},
+    "agent_context": {"version": "agent-context-v1", "text": AGENT_CONTEXT_PROMPT},
+    "cached_turn": {"version": "cached-turn-v1", "text": CACHED_TURN_PROMPT},
+}
+
+
+@lru_cache(maxsize=256)
+def token_count(text: str) -> int:
+    """Token count of a prompt; uses tiktoken when installed, else ~4 chars per token."""
+    try:
+        import tiktoken
+    except ImportError:
+        return max(1, round(len(text) / 4))
+    return len(tiktoken.get_encoding("cl100k_base").encode(text))
+
+
+def instruction(name: str) -> str:
+    return PROMPTS[name]["text"]
+
+
+def version(name: str) -> str:
+    return PROMPTS[name]["version"]
+
+
+# 🔹 Savings accounting
+# dialog_id -> {"turns", "prompt_tokens_sent", "prompt_tokens_legacy", "versions"}
+_conversations: "OrderedDict[str, dict]" = OrderedDict()
+
+
+def _conversation(dialog_id: str) -> dict:
+    conv = _conversations.get(dialog_id)
+    if conv is None:
+        conv = _conversations[dialog_id] = {
+            "turns": 0, "prompt_tokens_sent": 0, "prompt_tokens_legacy": 0,
+            "history_tokens": 0, "versions": [],
+        }
+        while len(_conversations) > PROMPT_REPORT_MAX_CONVERSATIONS:
+            _conversations.popitem(last=False)
+    _conversations.move_to_end(dialog_id)
+    return conv
+
+
+def record_turn(dialog_id: str, prompts_sent: dict[str, int]):
+    """
+    Account one Chatling turn. `prompts_sent` maps each prompt sent as an
+    instruction on this turn to how many new copies of it the old code would
+    have put into the message body (0 when it was already in the history).
+    """
+    conv = _conversation(dialog_id)
+    conv["turns"] += 1
+    # the old approach replays every prompt already in the history on this turn
+    conv["prompt_tokens_legacy"] += conv["history_tokens"]
+    for name, legacy_copies in prompts_sent.items():
+        tokens = token_count(instruction(name))
+        conv["prompt_tokens_sent"] += tokens
+        conv["prompt_tokens_legacy"] += tokens * legacy_copies
+        conv["history_tokens"] += tokens * legacy_copies
+        conv["versions"].append(version(name))
+
+
+def savings_report(limit: int = 50) -> dict:
+    def summary(conv: dict) -> dict:
+        saved = conv["prompt_tokens_legacy"] - conv["prompt_tokens_sent"]
+        return {
+            "turns": conv["turns"],
+            "prompt_tokens_sent": conv["prompt_tokens_sent"],
+            "prompt_tokens_legacy": conv["prompt_tokens_legacy"],
+            "tokens_saved": saved,
+            "credits_saved": round(saved / 1000 * CHATLING_CREDITS_PER_1K_TOKENS, 3),
+            "prompt_versions": sorted(set(conv["versions"])),
+        }
+
+    per_conversation = {dialog_id: summary(conv) for dialog_id, conv in _conversations.items()}
+    totals = {
+        key: sum(c[key] for c in per_conversation.values())
+        for key in ("turns", "prompt_tokens_sent", "prompt_tokens_legacy", "tokens_saved", "credits_saved")
+    }
+    recent = dict(list(per_conversation.items())[-limit:])
+    return {
+        "prompts": {name: {"version": p["version"], "tokens": token_count(p["text"])} for name, p in PROMPTS.items()},
+        "conversations": len(per_conversation),
+        "totals": totals,
+        "recent": recent,
+    }
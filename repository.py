@@ -0,0 +1,383 @@
+"""
+Async data-access layer for the Supabase tables used by the bot
+(chat_mapping, pending_messages, debug_logs).
+
+The supabase-py client is synchronous, so every `.execute()` runs on a
+bounded thread pool instead of the event loop. The SDK is heavy to import,
+so the shared client is only created on first use (or by `warm_up`).
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import mapping_cache
+import local_store
+import metrics
+
+logger = logging.getLogger("repository")
+
+SUPABASE_URL = os.getenv("SUPABASE_URL")
+SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+SUPABASE_MAX_WORKERS = int(os.getenv("SUPABASE_MAX_WORKERS", "8"))
+
+_client = None
+_client_lock = threading.Lock()
+
+_executor = ThreadPoolExecutor(max_workers=SUPABASE_MAX_WORKERS, thread_name_prefix="supabase")
+
+
+def client():
+    """The shared Supabase client; imports the SDK and connects on first call."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if not SUPABASE_URL or not SUPABASE_KEY:
+                    raise RuntimeError("Missing SUPABASE_URL or SUPABASE_KEY in environment")
+                from supabase import create_client
+                _client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _client
+
+
+async def warm_up():
+    """Create the client on the thread pool so the first request doesn't pay for it."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, client)
+
+
+async def _execute(query, op: str = "query"):
+    """Run a built supabase query on the thread pool and return its response."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, query.execute)
+    finally:
+        metrics.observe_supabase(op, time.perf_counter() - start)
+
+
+def shutdown():
+    _executor.shutdown(wait=False)
+
+
+# 🔹 chat_mapping (read-through mapping_cache, every write refreshes it)
+
+def _cache_written_rows(result, fallback: dict):
+    rows = getattr(result, "data", None) or []
+    if rows:
+        for row in rows:
+            mapping_cache.put(row["bitrix_dialog_id"], row)
+    else:
+        mapping_cache.merge(fallback["bitrix_dialog_id"], fallback)
+
+
+async def _write_local(dialog_id: str, fields: dict, complete: bool = False):
+    """Write-behind path (LOCAL_STORE_ENABLED): SQLite now, Supabase on the next sync."""
+    row, complete = await local_store.write(dialog_id, fields, complete=complete)
+    if complete:
+        mapping_cache.put(dialog_id, row)
+    else:
+        # only the written fields are known; the next read fetches the full row
+        mapping_cache.invalidate(dialog_id, publish=True)
+    return SimpleNamespace(data=[row])
+
+
+async def get_chat_mapping(dialog_id: str) -> dict | None:
+    cached = mapping_cache.get(dialog_id)
+    if cached is not None:
+        return cached
+    if local_store.LOCAL_STORE_ENABLED:
+        row = await local_store.get(dialog_id)
+        if row is not None:
+            mapping_cache.put(dialog_id, row, publish=False)
+            return row
+    result = await _execute(
+        client().table("chat_mapping").select("*").eq("bitrix_dialog_id", dialog_id),
+        op="get_chat_mapping",
+    )
+    row = result.data[0] if result.data else None
+    if row:
+        if local_store.LOCAL_STORE_ENABLED:
+            row = await local_store.remember(row)
+        mapping_cache.put(dialog_id, row, publish=False)
+    return row
+
+
+async def insert_chat_mapping(row: dict):
+    if local_store.LOCAL_STORE_ENABLED:
+        # a new dialog: the inserted fields plus column defaults are its full state
+        return await _write_local(row["bitrix_dialog_id"], {"chat_status": "active", **row}, complete=True)
+    result = await _execute(client().table("chat_mapping").insert(row), op="insert_chat_mapping")
+    _cache_written_rows(result, row)
+    return result
+
+
+async def upsert_chat_mapping(row: dict):
+    if local_store.LOCAL_STORE_ENABLED:
+        return await _write_local(row["bitrix_dialog_id"], row)
+    result = await _execute(client().table("chat_mapping").upsert(row), op="upsert_chat_mapping")
+    _cache_written_rows(result, row)
+    return result
+
+
+async def update_chat_mapping(dialog_id: str, fields: dict):
+    if local_store.LOCAL_STORE_ENABLED:
+        return await _write_local(dialog_id, fields)
+    result = await _execute(
+        client().table("chat_mapping").update(fields).eq("bitrix_dialog_id", dialog_id),
+        op="update_chat_mapping",
+    )
+    _cache_written_rows(result, {"bitrix_dialog_id": dialog_id, **fields})
+    return result
+
+
+async def update_chat_status_bulk(dialog_ids: list[str], status: str):
+    if local_store.LOCAL_STORE_ENABLED:
+        for dialog_id in dialog_ids:
+            await _write_local(dialog_id, {"chat_status": status})
+        return SimpleNamespace(data=[])
+    result = await _execute(
+        client().table("chat_mapping").update({"chat_status": status}).in_("bitrix_dialog_id", dialog_ids),
+        op="update_chat_status_bulk",
+    )
+    for dialog_id in dialog_ids:
+        mapping_cache.merge(dialog_id, {"chat_status": status})
+    return result
+
+
+async def upsert_chat_mappings(rows: list[dict]):
+    """Batch upsert straight to Supabase; every row must carry the same keys (local_store sync)."""
+    return await _execute(client().table("chat_mapping").upsert(rows), op="upsert_chat_mappings")
+
+
+async def get_chat_mappings_page(after: str | None = None, limit: int = 500) -> list[dict]:
+    """One page of chat_mapping rows ordered by dialog id (local_store reconcile)."""
+    query = client().table("chat_mapping").select("*").order("bitrix_dialog_id").limit(limit)
+    if after is not None:
+        query = query.gt("bitrix_dialog_id", after)
+    result = await _execute(query, op="get_chat_mappings_page")
+    return result.data or []
+
+
+async def get_mappings_without_contact(after: str | None = None, limit: int = 500) -> list[dict]:
+    """One page of chat_mapping rows missing chatling_contact_id, keyed by dialog id."""
+    query = (
+        client().table("chat_mapping")
+        .select("bitrix_dialog_id, name, phone, email")
+        .is_("chatling_contact_id", "null")
+        .order("bitrix_dialog_id")
+        .limit(limit)
+    )
+    if after is not None:
+        query = query.gt("bitrix_dialog_id", after)
+    result = await _execute(query, op="get_mappings_without_contact")
+    return result.data or []
+
+
+# 🔹 pending_messages
+
+async def get_unflushed_pending(dialog_id: str) -> dict | None:
+    result = await _execute(
+        client().table("pending_messages")
+        .select("id,message")
+        .eq("dialog_id", dialog_id)
+        .eq("flushed", False)
+        .limit(1),
+        op="get_unflushed_pending",
+    )
+    return result.data[0] if result.data else None
+
+
+async def get_unflushed_pending_for_dialogs(dialog_ids: list[str]) -> list[dict]:
+    result = await _execute(
+        client().table("pending_messages")
+        .select("id, dialog_id, message, created_at")
+        .eq("flushed", False)
+        .in_("dialog_id", dialog_ids)
+        .order("created_at")
+        .order("id"),
+        op="get_unflushed_pending_for_dialogs",
+    )
+    return result.data or []
+
+
+async def get_pending_heads_page(after: str | None = None, limit: int = 500) -> list[dict]:
+    """One page of (dialog_id, oldest unflushed created_at) by dialog id (migrations/006_pending_message_heads.sql)."""
+    query = client().table("pending_message_heads").select("dialog_id, created_at").order("dialog_id").limit(limit)
+    if after is not None:
+        query = query.gt("dialog_id", after)
+    result = await _execute(query, op="get_pending_heads_page")
+    return result.data or []
+
+
+async def get_unflushed_pending_heads(offset: int = 0, limit: int = 500) -> list[dict]:
+    """One page of dialog_id/created_at over every unflushed row, oldest first (startup without migration 006)."""
+    result = await _execute(
+        client().table("pending_messages")
+        .select("dialog_id, created_at")
+        .eq("flushed", False)
+        .order("created_at")
+        .order("id")
+        .range(offset, offset + limit - 1),
+        op="get_unflushed_pending_heads",
+    )
+    return result.data or []
+
+
+async def insert_pending(dialog_id: str, user_id: str, message: str):
+    return await _execute(
+        client().table("pending_messages").insert({
+            "dialog_id": dialog_id,
+            "user_id": user_id,
+            "message": message
+        }),
+        op="insert_pending",
+    )
+
+
+async def append_pending_message(dialog_id: str, user_id: str, message: str):
+    """Atomic server-side append (migrations/002_append_pending_message.sql); returns the row id."""
+    result = await _execute(
+        client().rpc("append_pending_message", {
+            "p_dialog_id": dialog_id,
+            "p_user_id": user_id,
+            "p_message": message
+        }),
+        op="append_pending_message",
+    )
+    return result.data
+
+
+async def claim_pending_messages(dialog_ids: list[str], worker_id: str, lease_seconds: int) -> list[dict]:
+    """Lease the unflushed rows of dialogs no other worker holds (migrations/003_claim_pending_messages.sql)."""
+    result = await _execute(
+        client().rpc("claim_pending_messages", {
+            "p_dialog_ids": dialog_ids,
+            "p_worker": worker_id,
+            "p_lease_seconds": lease_seconds
+        }),
+        op="claim_pending_messages",
+    )
+    return result.data or []
+
+
+async def claim_overdue_pending_messages(cutoff: str, worker_id: str, lease_seconds: int, limit: int) -> list[dict]:
+    """Lease the rows of up to `limit` dialogs whose oldest unclaimed message is older than `cutoff`."""
+    result = await _execute(
+        client().rpc("claim_overdue_pending_messages", {
+            "p_cutoff": cutoff,
+            "p_worker": worker_id,
+            "p_lease_seconds": lease_seconds,
+            "p_limit": limit
+        }),
+        op="claim_overdue_pending_messages",
+    )
+    return result.data or []
+
+
+async def update_pending_message(record_id, message: str):
+    return await _execute(
+        client().table("pending_messages").update({"message": message}).eq("id", record_id),
+        op="update_pending_message",
+    )
+
+
+async def delete_unflushed_pending(dialog_id: str) -> list[dict]:
+    result = await _execute(
+        client().table("pending_messages").delete().eq("dialog_id", dialog_id).eq("flushed", False),
+        op="delete_unflushed_pending",
+    )
+    return result.data or []
+
+
+async def delete_pending_bulk(record_ids: list):
+    return await _execute(
+        client().table("pending_messages").delete().in_("id", record_ids),
+        op="delete_pending_bulk",
+    )
+
+
+# 🔹 Whole flows in one round trip (migrations/004_flow_rpcs.sql)
+
+async def get_or_create_chat_mapping(row: dict) -> tuple[dict, bool]:
+    """The dialog's mapping, inserting `row` first if there is none; returns (row, created)."""
+    dialog_id = row["bitrix_dialog_id"]
+    cached = mapping_cache.get(dialog_id)
+    if cached is not None:
+        return cached, False
+    if local_store.LOCAL_STORE_ENABLED:
+        local = await local_store.get(dialog_id)
+        if local is not None:
+            mapping_cache.put(dialog_id, local, publish=False)
+            return local, False
+    result = await _execute(
+        client().rpc("get_or_create_chat_mapping", {"p_row": row}),
+        op="get_or_create_chat_mapping",
+    )
+    found = dict(result.data)
+    created = found.pop("created", False)
+    if local_store.LOCAL_STORE_ENABLED:
+        found = await local_store.remember(found)
+    mapping_cache.put(dialog_id, found, publish=created)
+    return found, created
+
+
+async def reset_pending_messages(dialog_id: str, user_id: str, event: str) -> list[dict]:
+    """Delete the dialog's unflushed rows and write the matching debug_logs row; returns the deleted rows."""
+    result = await _execute(
+        client().rpc("reset_pending_messages", {
+            "p_dialog_id": dialog_id,
+            "p_user_id": user_id,
+            "p_event": event
+        }),
+        op="reset_pending_messages",
+    )
+    return result.data or []
+
+
+async def finish_escalation(dialog_ids: list[str], msg_ids: list):
+    """Set dialogs active, delete their escalated rows and log it, in one transaction."""
+    remote_dialog_ids = dialog_ids
+    if local_store.LOCAL_STORE_ENABLED:
+        # chat_mapping is written locally and synced later; the RPC only deletes and logs
+        for dialog_id in dialog_ids:
+            await _write_local(dialog_id, {"chat_status": "active"})
+        remote_dialog_ids = []
+    result = await _execute(
+        client().rpc("finish_escalation", {"p_dialog_ids": remote_dialog_ids, "p_msg_ids": msg_ids}),
+        op="finish_escalation",
+    )
+    for dialog_id in remote_dialog_ids:
+        mapping_cache.merge(dialog_id, {"chat_status": "active"})
+    return result
+
+
+# 🔹 debug_logs
+
+async def insert_debug_logs(rows: list[dict]):
+    return await _execute(client().table("debug_logs").insert(rows), op="insert_debug_logs")
+
+
+# 🔹 processed_events
+
+async def claim_event(event_key: str, dialog_id: str) -> bool:
+    """Insert an event key; False when it was already there."""
+    result = await _execute(
+        client().table("processed_events").upsert(
+            {"event_key": event_key, "dialog_id": dialog_id},
+            on_conflict="event_key",
+            ignore_duplicates=True,
+        ),
+        op="claim_event",
+    )
+    return bool(result.data)
+
+
+async def release_event(event_key: str):
+    """Remove a claimed event key so a redelivery is processed again."""
+    return await _execute(
+        client().table("processed_events").delete().eq("event_key", event_key),
+        op="release_event",
+    )
@@ -0,0 +1,59 @@
+"""
+Local stand-in for the Chatling v2 API that streams its reply token by token.
+
+Run it and point the bot at it to exercise the streaming relay end to end:
+
+    uvicorn stub_chatling_server:app --port 8081
+    CHATLING_API_BASE=http://127.0.0.1:8081/v2 CHATLING_STREAMING=true uvicorn main:app
+
+Requests with "stream": true get a text/event-stream of
+`data: {"delta": "..."}` events (the first one carries the conversation_id);
+other requests get the regular JSON body. STUB_TOKEN_DELAY_SECONDS sets the
+pause between tokens.
+"""
+import asyncio
+import json
+import os
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+STUB_TOKEN_DELAY_SECONDS = float(os.getenv("STUB_TOKEN_DELAY_SECONDS", "0.05"))
+STUB_REPLY = os.getenv(
+    "STUB_REPLY",
+    "Thanks for reaching out to Finideas! Have you had a chance to watch our webinar yet? "
+    "It explains our strategy step by step. Once you've seen it, completing your KYC is free and quick."
+)
+
+app = FastAPI()
+
+
+def _tokens(text: str):
+    words = text.split(" ")
+    for i, word in enumerate(words):
+        yield word if i == len(words) - 1 else word + " "
+
+
+@app.post("/v2/chatbots/{bot_id}/ai/kb/chat")
+async def chat(bot_id: str, request: Request):
+    payload = await request.json()
+    conversation_id = payload.get("conversation_id") or str(uuid.uuid4())
+
+    if not payload.get("stream"):
+        await asyncio.sleep(STUB_TOKEN_DELAY_SECONDS * len(STUB_REPLY.split(" ")))
+        return {"status": "success", "data": {"conversation_id": conversation_id, "response": STUB_REPLY}}
+
+    async def events():
+        yield f"data: {json.dumps({'conversation_id': conversation_id})}\n\n"
+        for token in _tokens(STUB_REPLY):
+            await asyncio.sleep(STUB_TOKEN_DELAY_SECONDS)
+            yield f"data: {json.dumps({'delta': token})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v2/chatbots/{bot_id}/contacts")
+async def create_contact(bot_id: str):
+    return {"status": "success", "data": {"id": str(uuid.uuid4())}}